@@ -0,0 +1,51 @@
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+
+# measures the import of the download driver (run_download.py, as cron runs it) in fresh interpreters,
+# and checks that the heavy packages the ticker and last trade runs do not need are not loaded. exits
+# with 1 if the budget is exceeded.
+
+_ROOT = str(pathlib.Path(__file__).resolve().parent.parent)
+_DRIVERS = str(pathlib.Path(__file__).resolve().parent)
+
+_ENTRY_IMPORT = 'import run_download'
+_HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'pymongo', 'scipy']
+
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, {drivers!r})
+t = time.perf_counter()
+{entry_import}
+elapsed = time.perf_counter() - t
+print(json.dumps({{'sec': elapsed, 'heavy': [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+
+def measure_once() -> dict:
+
+    probe = _PROBE.format(drivers=_DRIVERS, entry_import=_ENTRY_IMPORT, heavy=repr(_HEAVY_MODULES))
+    out = subprocess.run([sys.executable, '-c', probe], cwd=_ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', help='number of fresh interpreters', type=int, default=5)
+    parser.add_argument('--budget-ms', help='maximum median import time in milliseconds', type=float, default=150)
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.repeat)]
+    median_ms = 1000.0 * statistics.median(r['sec'] for r in runs)
+    heavy = sorted(set(m for r in runs for m in r['heavy']))
+
+    print('import time (median of ' + str(args.repeat) + '): ' + str(round(median_ms, 1)) + ' ms')
+    print('heavy modules loaded: ' + (', '.join(heavy) if heavy else 'none'))
+
+    if heavy or median_ms > args.budget_ms:
+        print('FAILED: budget ' + str(args.budget_ms) + ' ms, no heavy modules')
+        sys.exit(1)
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, List
+
+from xcrytoz.analytics import VolatilitySurfaceDeribit
+from xcrytoz.deribit_data import ConverterToDF, OptionSnapshot, TickerBatchDownloader
+from xcrytoz.deribit_data.batch_managers import BatchFileManager
+from xcrytoz.deribit_data.downloader import DeribitDownloader_Simple
+
+from synthetic import FakeDeribitServer, SyntheticDeribitData  # next to this script
+
+# times the hot paths on synthetic chains at several scales and writes the results as json, so that
+# runs of two commits can be compared (--compare). exits with 1 if a benchmark is slower than the
+# baseline by more than --tolerance.
+
+_ROOT = str(pathlib.Path(__file__).resolve().parent.parent)
+
+# name: (n_expiries, n_strikes, n_snapshots, trades per hour)
+SCALES = {
+    'small': (4, 10, 12, 1000),
+    'medium': (10, 30, 48, 5000),
+    'large': (20, 60, 144, 20000),
+}
+
+
+def time_it(fn: Callable, repeat: int) -> dict:
+
+    fn()  # warm up (imports, caches)
+    secs = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        secs.append(time.perf_counter() - t)
+
+    return {'repeat': repeat, 'min_sec': min(secs), 'median_sec': statistics.median(secs),
+            'mean_sec': statistics.mean(secs)}
+
+
+def run_scale(scale: str, repeat: int, work_folder: str) -> List[dict]:
+
+    n_expiries, n_strikes, n_snapshots, trades_per_hour = SCALES[scale]
+    data = SyntheticDeribitData('BTC', n_expiries=n_expiries, n_strikes=n_strikes)
+    ts = data.timestamp
+    batch = data.get_ticker_batch(ts)
+    params = {'n_expiries': n_expiries, 'n_strikes': n_strikes, 'n_options': len(batch['tickers']),
+              'n_snapshots': n_snapshots, 'trades_per_hour': trades_per_hour}
+
+    root_folder = os.path.join(work_folder, scale)
+    downloader = TickerBatchDownloader(root_folder, ts)
+    os.makedirs(downloader.save_folder, exist_ok=True)
+    attribs = {'batch_id': downloader.batch_id, 'time_start': 0, 'time_end': 0}
+
+    def write_zip():
+        return downloader._write_batch(batch, attribs, 'BTC', 'option')
+
+    bfm = BatchFileManager(root_folder)
+    path = os.path.relpath(write_zip(), root_folder)
+
+    # a folder of snapshots for the scan
+    for t, b in data.iter_ticker_batches(n_snapshots):
+        d = TickerBatchDownloader(root_folder, t)
+        os.makedirs(d.save_folder, exist_ok=True)
+        d._write_batch(b, attribs, 'BTC', 'option')
+
+    def build():
+        VolatilitySurfaceDeribit('BTC', ts, batch).build()
+
+    benchmarks = [
+        ('tick_info_to_df', lambda: ConverterToDF.tick_info_to_df(batch)),
+        ('snapshot_from_deribit', lambda: OptionSnapshot.from_deribit(batch)),
+        ('surface_build', build),
+        ('write_zip', write_zip),
+        ('batch_read', lambda: bfm.read(path)),
+        ('get_ticker_batch_file_infos', bfm.get_ticker_batch_file_infos),
+    ]
+
+    with FakeDeribitServer({'BTC': data}, trades_per_hour=trades_per_hour) as server:
+
+        ws_downloader = DeribitDownloader_Simple(keep_alive=True, url=server.url)
+        hour = 3600000
+        benchmarks += [
+            ('download_tickers', lambda: ws_downloader.download_tickers('BTC', 'option', sleep_in_sec=0.0)),
+            ('download_last_trades', lambda: ws_downloader.download_last_trades('BTC', 'option', ts, ts + hour)),
+        ]
+
+        results = []
+        for name, fn in benchmarks:
+            r = {'name': name, 'scale': scale, 'params': params}
+            r.update(time_it(fn, repeat))
+            print(scale.ljust(8) + name.ljust(30) + str(round(1000 * r['median_sec'], 2)).rjust(10) + ' ms')
+            results.append(r)
+
+        ws_downloader.close()
+
+    return results
+
+
+def get_commit() -> str:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def compare(results: List[dict], baseline_path: str, tolerance: float) -> bool:
+    ''' prints median ratios to the baseline. false if any is above 1 + tolerance. '''
+
+    with open(baseline_path, 'r') as f:
+        baseline = {(r['scale'], r['name']): r for r in json.load(f)['results']}
+
+    ok = True
+    print('\nvs ' + baseline_path)
+    for r in results:
+        b = baseline.get((r['scale'], r['name']))
+        if b is None:
+            continue
+        ratio = r['median_sec'] / b['median_sec']
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            ok = False
+        print(r['scale'].ljust(8) + r['name'].ljust(30) + str(round(ratio, 3)).rjust(10) + flag)
+
+    return ok
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', help='scales to run', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+    parser.add_argument('--repeat', help='timed runs per benchmark', type=int, default=5)
+    parser.add_argument('--output', help='json file for the results (default: benchmark_<commit>.json)', default=None)
+    parser.add_argument('--compare', help='json file of a previous run to compare with', default=None)
+    parser.add_argument('--tolerance', help='allowed slowdown vs the baseline, e.g. 0.2 for 20%%',
+                        type=float, default=0.2)
+    args = parser.parse_args()
+
+    commit = get_commit()
+    work_folder = tempfile.mkdtemp(prefix='xcrytoz_bench_')
+    try:
+        results = [r for scale in args.scales for r in run_scale(scale, args.repeat, work_folder)]
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    output = args.output or 'benchmark_' + commit + '.json'
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'timestamp': datetime.utcnow().isoformat(),
+                   'python': platform.python_version(), 'machine': platform.machine(),
+                   'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                   'results': results}, f, indent=4)
+    print('wrote ' + output)
+
+    if args.compare is not None and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -2,11 +2,14 @@ import argparse
 import os
 import pathlib
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from xcrytoz.common_utils import Converter, get_logger
-from xcrytoz.deribit_data import (LastTradeBatchDownloader,
-                                  TickerBatchDownloader)
+from xcrytoz.deribit_data import (BackfillPlanner, BackfillRunner,
+                                  JobScheduler, LastTradeBatchDownloader,
+                                  PeriodicJob, TickerBatchDownloader)
+from xcrytoz.deribit_data.downloader import DeribitDownloader_Simple
+from xcrytoz.metrics import start_metrics_server, write_metrics_textfile
 
 # to add path required (required before packageds)
 for pp in [str(pathlib.Path(__file__).resolve().parent.parent)]:
@@ -16,43 +19,150 @@ for pp in [str(pathlib.Path(__file__).resolve().parent.parent)]:
 
 _LOGGER = get_logger(__name__)
 
+currencies = ['BTC', 'ETH', 'SOL']
+kinds = ['future', 'option']
+
+
+def run_ticker(root_folder: str, dt_utc_now: datetime, downloader: DeribitDownloader_Simple = None,
+               streaming=False):
+
+    # we work everything using utc time (no local times)
+    ts_utcnow_in_msec = Converter.dt2ms_int(dt_utc_now)
+
+    TickerBatchDownloader(root_folder, ts_utcnow_in_msec, downloader, streaming).download_batches(currencies, kinds)
+
+
+def run_order_book(root_folder: str, dt_utc_now: datetime, depth: int,
+                   downloader: DeribitDownloader_Simple = None):
+
+    # order books need numpy, which the ticker and last trade runs do not load
+    from xcrytoz.deribit_data import OrderBookBatchDownloader
+
+    ts_utcnow_in_msec = Converter.dt2ms_int(dt_utc_now)
+
+    OrderBookBatchDownloader(root_folder, ts_utcnow_in_msec, downloader, depth).download_batches(currencies, kinds)
+
+
+def run_last_trade(root_folder: str, dt_utc_now: datetime, downloader: DeribitDownloader_Simple = None,
+                   streaming=False):
+
+    # this is expected to run on hourly basis
+    end_datetime = datetime(dt_utc_now.year, dt_utc_now.month, dt_utc_now.day, dt_utc_now.hour, 0, 0)
+    end_timestamp = Converter.dt2ms_int(end_datetime)
+    start_timestamp = end_timestamp - 60 * 60 * 1000
+
+    LastTradeBatchDownloader(root_folder, start_timestamp, end_timestamp, downloader, streaming)\
+        .download_batches(currencies, kinds)
+
+
+def run_daemon(ticker_root_folder: str, last_trade_root_folder: str, ticker_interval_sec: float,
+               last_trade_offset_sec: float, streaming=False):
+
+    # one warm connection per job, reused across runs
+    ticker_downloader = DeribitDownloader_Simple(keep_alive=True)
+    last_trade_downloader = DeribitDownloader_Simple(keep_alive=True)
+
+    jobs = [
+        PeriodicJob('ticker', ticker_interval_sec,
+                    lambda t: run_ticker(ticker_root_folder, datetime.utcfromtimestamp(t), ticker_downloader,
+                                         streaming)),
+        # fires just after each hour boundary, for the hour that has just ended
+        PeriodicJob('last_trade', 60 * 60,
+                    lambda t: run_last_trade(last_trade_root_folder, datetime.utcfromtimestamp(t),
+                                             last_trade_downloader, streaming),
+                    offset_sec=last_trade_offset_sec),
+    ]
+
+    try:
+        JobScheduler(jobs).run()
+    finally:
+        ticker_downloader.close()
+        last_trade_downloader.close()
+
+
+def run_backfill(ticker_root_folder: str, last_trade_root_folder: str, dt_utc_from: datetime,
+                 dt_utc_to: datetime, n_workers: int, requests_per_sec: float, ticker_interval_sec: float):
+
+    # whole hours, as run_last_trade does
+    from_timestamp = Converter.dt2ms_int(dt_utc_from.replace(minute=0, second=0, microsecond=0))
+    to_timestamp = Converter.dt2ms_int(dt_utc_to.replace(minute=0, second=0, microsecond=0))
+
+    # ticker snapshots cannot be taken in the past: only report their gaps
+    if os.path.exists(ticker_root_folder):
+        missing_tickers = BackfillPlanner(ticker_root_folder, currencies, kinds)\
+            .get_missing_ticker_batches(from_timestamp, to_timestamp, int(ticker_interval_sec * 1000))
+        _LOGGER.info(str(len(missing_tickers)) + ' ticker batches are missing')
+
+    tasks = BackfillPlanner(last_trade_root_folder, currencies, kinds)\
+        .get_missing_last_trade_tasks(from_timestamp, to_timestamp)
+
+    # one checkpoint per root folder. tasks are whole hours, so a later run, whose window has moved
+    # by some hours, still skips every task an interrupted run has finished.
+    checkpoint_path = os.path.join(last_trade_root_folder, 'backfill.checkpoint')
+    failed = BackfillRunner(last_trade_root_folder, n_workers, requests_per_sec, checkpoint_path).run(tasks)
+    if failed:
+        _LOGGER.error(str(len(failed)) + ' backfill tasks failed. run the same command again to retry them')
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('run_type', help='which run to execute', choices=['ticker', 'last_trade'])
+    parser.add_argument('run_type', help='which run to execute',
+                        choices=['ticker', 'last_trade', 'order_book', 'daemon', 'backfill'])
     parser.add_argument('--live', help='run in the live mode.', action="store_true")
+    parser.add_argument('--ticker-interval', help='daemon: seconds between ticker snapshots.',
+                        type=float, default=300)
+    parser.add_argument('--last-trade-offset', help='daemon: seconds after each hour to download last trades.',
+                        type=float, default=0)
+    parser.add_argument('--book-depth', help='order_book: levels per side.', type=int, default=20)
+    parser.add_argument('--streaming', help='write downloads to a spill file as they arrive. a rerun of the same '
+                        'last trade hour resumes it; ticker spills of failed runs are written by the next run, '
+                        'with the instruments not downloaded as missing.', action="store_true")
+    parser.add_argument('--backfill-days', help='backfill: days to look back from now.', type=float, default=7)
+    parser.add_argument('--backfill-workers', help='backfill: concurrent downloads.', type=int, default=4)
+    parser.add_argument('--backfill-rate', help='backfill: requests per second over all workers.',
+                        type=float, default=20)
+    parser.add_argument('--metrics-port', help='serve prometheus metrics on this port.', type=int, default=None)
+    parser.add_argument('--metrics-textfile', help='write prometheus metrics to this file at the end of a run.',
+                        default=None)
     args = parser.parse_args()
     run_type = args.run_type
 
     target_folder = 'deribit' if args.live else 'test_deribit'
 
     home_path = str(pathlib.Path.home())
+    ticker_root_folder = os.path.join(home_path, 'data', target_folder)
+    last_trade_root_folder = os.path.join(home_path, 'data', target_folder + '_trade')
+    order_book_root_folder = os.path.join(home_path, 'data', target_folder + '_book')
 
     dt_utc_now = datetime.utcnow()
 
-    currencies = ['BTC', 'ETH', 'SOL']
-    kinds = ['future', 'option']
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
 
     if run_type == 'ticker':
-
-        # we work everything using utc time (no local times)
-        ts_utcnow_in_msec = Converter.dt2ms_int(dt_utc_now)
-        root_folder = os.path.join(home_path, 'data', target_folder)
-        # now run.
-
-        TickerBatchDownloader(root_folder, ts_utcnow_in_msec).download_batches(currencies, kinds)
+        run_ticker(ticker_root_folder, dt_utc_now, streaming=args.streaming)
 
     elif run_type == 'last_trade':
-        root_folder = os.path.join(home_path, 'data', target_folder + '_trade')
+        run_last_trade(last_trade_root_folder, dt_utc_now, streaming=args.streaming)
+
+    elif run_type == 'order_book':
+        run_order_book(order_book_root_folder, dt_utc_now, args.book_depth)
 
-        # this is expected to run on hourly basis
-        end_datetime = datetime(dt_utc_now.year, dt_utc_now.month, dt_utc_now.day, dt_utc_now.hour, 0, 0)
-        end_timestamp = Converter.dt2ms_int(end_datetime)
-        start_timestamp = end_timestamp - 60 * 60 * 1000
+    elif run_type == 'daemon':
+        run_daemon(ticker_root_folder, last_trade_root_folder, args.ticker_interval, args.last_trade_offset,
+                   args.streaming)
 
-        LastTradeBatchDownloader(root_folder, start_timestamp, end_timestamp).download_batches(currencies, kinds)
+    elif run_type == 'backfill':
+        os.makedirs(last_trade_root_folder, exist_ok=True)
+        run_backfill(ticker_root_folder, last_trade_root_folder, dt_utc_now - timedelta(days=args.backfill_days),
+                     dt_utc_now, args.backfill_workers, args.backfill_rate, args.ticker_interval)
 
     else:
-        raise Exception('unknown run type: ' + run_type + '. either "ticker", or "last_trade"')
+        raise Exception('unknown run type: ' + run_type +
+                        '. either "ticker", "last_trade", "order_book", "daemon" or "backfill"')
+
+    if args.metrics_textfile is not None:
+        write_metrics_textfile(args.metrics_textfile)
 
     _LOGGER.info('done')
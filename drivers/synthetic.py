@@ -0,0 +1,466 @@
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from xcrytoz.analytics.black import black_delta, black_gamma, black_price, black_theta, black_vega
+from xcrytoz.deribit_data.shared_structures import DeribitFields
+
+# NOTE:
+# synthetic deribit payloads shaped like the real ones (same fields, units and rounding), for the
+# benchmarks and for trying things out without a connection. prices of options are in coin units,
+# mark_iv in percent, expiries at 08:00 UTC. everything is deterministic given the seed.
+
+_cst = DeribitFields()
+
+_MS_PER_YEAR = 365 * 24 * 3600 * 1000
+_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def _round_to(x: np.ndarray, tick: float) -> np.ndarray:
+    # the second round drops the float noise of the multiplication
+    return np.round(np.round(np.asarray(x) / tick) * tick, 10)
+
+
+class SyntheticDeribitData:
+    ''' option and future chains of one currency listed at timestamp, with a random walk spot.
+
+    n_expiries expiries (weeklies, then month ends) by n_strikes strikes around the forward, each
+    listed as a call and a put. the smile has a skew and a curvature that flatten with maturity. '''
+
+    def __init__(self, currency='BTC', timestamp: int = 1700000000000, n_expiries=8, n_strikes=20,
+                 spot=30000.0, atm_vol=0.55, rate=0.03, seed=0):
+
+        self.currency = currency
+        self.timestamp = timestamp
+        self.n_expiries = n_expiries
+        self.n_strikes = n_strikes
+        self.spot = spot
+        self.atm_vol = atm_vol
+        self.rate = rate
+        self.seed = seed
+
+        self.expiration_timestamps: np.ndarray = self.__make_expiries(timestamp, n_expiries)
+        # strike grids are fixed at listing, as on the exchange
+        self.strikes: List[np.ndarray] = [self.__make_strikes(ex) for ex in self.expiration_timestamps]
+
+    def get_spot(self, timestamp: int) -> float:
+        ''' spot on an hourly random walk, interpolated within the hour. '''
+
+        hours = (timestamp - self.timestamp) / 3600000.0
+        n = int(np.floor(max(hours, 0.0)))
+        rng = np.random.default_rng([self.seed, 1])
+        steps = rng.standard_normal(n + 1) * self.atm_vol * np.sqrt(1.0 / (365 * 24))
+        log_path = np.concatenate([[0.0], np.cumsum(steps)])
+        log_s = log_path[n] + (hours - n) * steps[n] if hours > 0 else 0.0
+        return float(self.spot * np.exp(log_s))
+
+    def get_vol(self, tau: np.ndarray, log_moneyness: np.ndarray) -> np.ndarray:
+
+        x = log_moneyness / np.sqrt(np.maximum(tau, 1e-4))
+        vol = self.atm_vol * (1.0 + 0.1 * np.exp(-tau * 4.0)) - 0.04 * x + 0.02 * x * x
+        return np.clip(vol, 0.1, 3.0)
+
+    def get_option_instruments(self) -> List[dict]:
+
+        instruments = []
+        for ex, strikes in zip(self.expiration_timestamps, self.strikes):
+            for k in strikes:
+                for option_type in (_cst.call, _cst.put):
+                    instruments.append({
+                        'tick_size': 0.0005, 'taker_commission': 0.0003, 'strike': float(k),
+                        'settlement_period': 'week', 'settlement_currency': self.currency,
+                        'quote_currency': self.currency, 'price_index': self.currency.lower() + '_usd',
+                        'option_type': option_type, 'min_trade_amount': 0.1, 'maker_commission': 0.0003,
+                        'kind': _cst.option, 'is_active': True,
+                        'instrument_name': self.__get_option_name(int(ex), k, option_type),
+                        'expiration_timestamp': int(ex), 'creation_timestamp': self.timestamp,
+                        'counter_currency': 'USD', 'contract_size': 1.0, 'block_trade_commission': 0.0003,
+                        'base_currency': self.currency})
+        return instruments
+
+    def get_future_instruments(self) -> List[dict]:
+
+        perpetual = {'tick_size': 0.5, 'settlement_period': _cst.perpetual, 'kind': _cst.future,
+                     'instrument_name': self.currency + '-PERPETUAL', 'expiration_timestamp': 32503708800000,
+                     'is_active': True, 'base_currency': self.currency, 'quote_currency': 'USD'}
+        futures = [{'tick_size': 2.5, 'settlement_period': 'week', 'kind': _cst.future,
+                    'instrument_name': self.currency + '-' + self.__get_expiry_code(int(ex)),
+                    'expiration_timestamp': int(ex), 'is_active': True, 'base_currency': self.currency,
+                    'quote_currency': 'USD'}
+                   for ex in self.expiration_timestamps]
+        return [perpetual] + futures
+
+    def get_ticker_batch(self, timestamp: int, kind=_cst.option, missing_rate=0.0) -> dict:
+        ''' the data of a ticker batch file, as download_tickers returns it. '''
+
+        if kind == _cst.future:
+            instruments = self.get_future_instruments()
+            tickers = self.__get_future_tickers(timestamp, instruments)
+        else:
+            instruments = self.get_option_instruments()
+            tickers = self.__get_option_tickers(timestamp)
+
+        missing = []
+        if missing_rate > 0:
+            rng = np.random.default_rng([self.seed, 2, timestamp])
+            is_missing = rng.random(len(tickers)) < missing_rate
+            missing = [t[_cst.instrument_name] for t, m in zip(tickers, is_missing) if m]
+            tickers = [t for t, m in zip(tickers, is_missing) if not m]
+
+        return {'instruments': instruments, 'tickers': tickers, 'missing': missing}
+
+    def iter_ticker_batches(self, n_snapshots: int, interval_ms: int = 300000, kind=_cst.option)\
+            -> Iterator[Tuple[int, dict]]:
+        ''' (timestamp, batch) of n_snapshots snapshots every interval_ms from the listing. '''
+
+        for i in range(n_snapshots):
+            ts = self.timestamp + i * interval_ms
+            yield ts, self.get_ticker_batch(ts, kind)
+
+    def get_last_trades(self, start_timestamp: int, end_timestamp: int, n_trades: int) -> List[dict]:
+        ''' n_trades option trades in [start_timestamp, end_timestamp], in time order. '''
+
+        rng = np.random.default_rng([self.seed, 3, start_timestamp])
+        instruments = self.get_option_instruments()
+        # trades concentrate on the short expiries
+        p = np.array([1.0 / (1.0 + i) for i, _ in enumerate(instruments)])
+        i_inst = rng.choice(len(instruments), size=n_trades, p=p / p.sum())
+        timestamps = np.sort(rng.integers(start_timestamp, end_timestamp + 1, size=n_trades))
+
+        spot = self.get_spot(start_timestamp)
+        ex = np.array([instruments[i][_cst.expiration_timestamp] for i in i_inst])
+        k = np.array([instruments[i][_cst.strike] for i in i_inst])
+        is_call = np.array([instruments[i][_cst.option_type] == _cst.call for i in i_inst])
+        tau = np.maximum(ex - timestamps, 0) / _MS_PER_YEAR
+        fwd = spot * np.exp(self.rate * tau)
+        vol = self.get_vol(tau, np.log(k / fwd)) * (1.0 + 0.02 * rng.standard_normal(n_trades))
+        price = np.maximum(_round_to(black_price(fwd, k, tau, vol, is_call) / fwd, 0.0005), 0.0005)
+        amount = _round_to(rng.exponential(2.0, n_trades) + 0.1, 0.1)
+        is_buy = rng.random(n_trades) < 0.5
+
+        return [{
+            'trade_seq': int(seq), 'trade_id': str(start_timestamp * 1000000 + n), 'timestamp': int(ts),
+            'tick_direction': int(seq % 4), 'price': float(px), 'mark_price': float(px),
+            'iv': round(float(v) * 100, 2), 'instrument_name': instruments[i][_cst.instrument_name],
+            'index_price': round(spot, 2), 'direction': _cst.buy if b else _cst.sell,
+            'amount': float(a), 'contracts': float(a)}
+            for n, (seq, ts, px, v, i, b, a)
+            in enumerate(zip(range(1, n_trades + 1), timestamps, price, vol, i_inst, is_buy, amount))]
+
+    def get_last_trade_batch(self, start_timestamp: int, end_timestamp: int, n_trades: int,
+                             max_count=1000) -> List[dict]:
+        ''' the data of a last trade batch file, as download_last_trades returns it. '''
+
+        trades = self.get_last_trades(start_timestamp, end_timestamp, n_trades)
+        return [{'result': {'trades': trades[i:i + max_count], 'has_more': False}}
+                for i in range(0, max(len(trades), 1), max_count)]
+
+    def __get_option_tickers(self, timestamp: int) -> List[dict]:
+
+        spot = self.get_spot(timestamp)
+        rng = np.random.default_rng([self.seed, 4, timestamp])
+
+        tickers = []
+        for ex, strikes in zip(self.expiration_timestamps, self.strikes):
+
+            tau = max(int(ex) - timestamp, 0) / _MS_PER_YEAR
+            fwd = spot * np.exp(self.rate * tau)
+            k = np.concatenate([strikes, strikes])
+            is_call = np.repeat([True, False], len(strikes))
+            vol = self.get_vol(tau, np.log(k / fwd))
+
+            mark = black_price(fwd, k, tau, vol, is_call) / fwd
+            spread = np.maximum(0.0005, 0.05 * mark)
+            bid = np.maximum(_round_to(mark - spread, 0.0005), 0.0)
+            ask = _round_to(mark + spread, 0.0005) + 0.0005
+            delta = black_delta(fwd, k, tau, vol, is_call)
+            gamma = black_gamma(fwd, k, tau, vol)
+            vega = black_vega(fwd, k, tau, vol) / 100.0  # per vol point
+            theta = black_theta(fwd, k, tau, vol) / 365.0  # per day
+            oi = _round_to(rng.exponential(50.0, len(k)), 0.1)
+            volume = _round_to(rng.exponential(10.0, len(k)), 0.1)
+
+            for i in range(len(k)):
+                option_type = _cst.call if is_call[i] else _cst.put
+                tickers.append({
+                    'underlying_price': round(float(fwd), 2),
+                    'underlying_index': self.currency + '-' + self.__get_expiry_code(int(ex)),
+                    'timestamp': timestamp,
+                    'stats': {'volume': float(volume[i]), 'price_change': None,
+                              'low': float(bid[i]), 'high': float(ask[i])},
+                    'state': 'open', 'settlement_price': round(float(mark[i]), 8),
+                    'open_interest': float(oi[i]),
+                    'min_price': 0.0001, 'max_price': round(float(ask[i]) + 0.05, 4),
+                    'mark_price': round(float(mark[i]), 8), 'mark_iv': round(float(vol[i]) * 100.0, 2),
+                    'last_price': float(bid[i]), 'interest_rate': 0.0,
+                    'instrument_name': self.__get_option_name(int(ex), k[i], option_type),
+                    'index_price': round(spot, 2),
+                    'greeks': {'vega': round(float(vega[i]), 5), 'theta': round(float(theta[i]), 5),
+                               'rho': 0.0, 'gamma': round(float(gamma[i]), 8),
+                               'delta': round(float(delta[i]), 5)},
+                    'estimated_delivery_price': round(spot, 2),
+                    'bid_iv': round(float(vol[i]) * 100.0 - 1.0, 2), 'ask_iv': round(float(vol[i]) * 100.0 + 1.0, 2),
+                    'best_bid_price': float(bid[i]), 'best_bid_amount': 10.0,
+                    'best_ask_price': float(ask[i]), 'best_ask_amount': 10.0})
+
+        return tickers
+
+    def __get_future_tickers(self, timestamp: int, instruments: List[dict]) -> List[dict]:
+
+        spot = self.get_spot(timestamp)
+        tickers = []
+        for inst in instruments:
+            if inst[_cst.settlement_period] == _cst.perpetual:
+                mark = spot
+            else:
+                mark = spot * np.exp(self.rate * max(inst[_cst.expiration_timestamp] - timestamp, 0) / _MS_PER_YEAR)
+            mark = float(_round_to(mark, inst['tick_size']))
+            tickers.append({
+                'timestamp': timestamp, 'state': 'open', 'instrument_name': inst[_cst.instrument_name],
+                'index_price': round(spot, 2), 'mark_price': mark, 'last_price': mark,
+                'best_bid_price': mark - inst['tick_size'], 'best_ask_price': mark + inst['tick_size'],
+                'best_bid_amount': 1000.0, 'best_ask_amount': 1000.0, 'open_interest': 1e6,
+                'estimated_delivery_price': round(spot, 2),
+                'stats': {'volume': 100.0, 'price_change': None, 'low': mark, 'high': mark}})
+        return tickers
+
+    def __make_expiries(self, timestamp: int, n_expiries: int) -> np.ndarray:
+
+        dt = datetime.fromtimestamp(timestamp / 1000.0, tz=timezone.utc)
+        friday = (dt + timedelta(days=(4 - dt.weekday()) % 7)).replace(hour=8, minute=0, second=0, microsecond=0)
+        if friday <= dt:
+            friday += timedelta(days=7)
+
+        # four weeklies, then the last fridays of the following months
+        expiries = [friday + timedelta(days=7 * i) for i in range(min(n_expiries, 4))]
+        month_end = expiries[-1]
+        while len(expiries) < n_expiries:
+            month_end += timedelta(days=7)
+            if (month_end + timedelta(days=7)).month != month_end.month:
+                expiries.append(month_end)
+
+        return np.array([int(e.timestamp() * 1000) for e in expiries], dtype=np.int64)
+
+    def __make_strikes(self, expiration_timestamp: int) -> np.ndarray:
+
+        tau = (expiration_timestamp - self.timestamp) / _MS_PER_YEAR
+        fwd = self.spot * np.exp(self.rate * tau)
+        step = 10.0 ** np.floor(np.log10(self.spot)) / 20.0
+        # +-3 standard deviations
+        spacing = max(step, _round_to(6.0 * self.atm_vol * np.sqrt(tau) * fwd / max(self.n_strikes - 1, 1), step))
+        strikes = _round_to(fwd, step) + spacing * (np.arange(self.n_strikes) - self.n_strikes // 2)
+        return strikes[strikes > 0]
+
+    def __get_expiry_code(self, expiration_timestamp: int) -> str:
+        dt = datetime.fromtimestamp(expiration_timestamp / 1000.0, tz=timezone.utc)
+        return str(dt.day) + _MONTHS[dt.month - 1] + dt.strftime('%y')
+
+    def __get_option_name(self, expiration_timestamp: int, strike: float, option_type: str) -> str:
+        k = str(int(strike)) if float(strike).is_integer() else str(strike).replace('.', 'd')
+        return '-'.join([self.currency, self.__get_expiry_code(expiration_timestamp), k,
+                         'C' if option_type == _cst.call else 'P'])
+
+
+class FakeDeribitServer:
+    ''' local websocket server answering the public methods the downloader uses from synthetic data,
+    so that the download loop runs end to end without the exchange.
+
+    serves public/get_instruments, public/ticker, public/get_order_book and
+    public/get_last_trades_by_currency_and_time (with has_more when a window holds more than count
+    trades). tickers are those of the snapshot at timestamp (default: the listing). start() returns
+    the url to connect to. '''
+
+    ws_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    def __init__(self, data: Dict[str, SyntheticDeribitData], trades_per_hour=1000, timestamp: int = None,
+                 host='127.0.0.1', port=0):
+
+        self.data = data
+        self.timestamp = timestamp
+        self.trades_per_hour = trades_per_hour
+        self.host = host
+        self.port = port
+        self.server: socketserver.ThreadingTCPServer = None
+        self.thread: threading.Thread = None
+        self.n_requests = 0
+
+        # tickers by instrument name, refreshed on get_instruments
+        self.tickers: Dict[str, dict] = {}
+        self.trades: Dict[tuple, Tuple[np.ndarray, list]] = {}
+
+    @property
+    def url(self) -> str:
+        return 'ws://' + self.host + ':' + str(self.server.server_address[1])
+
+    def start(self) -> str:
+
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                fake.serve_connection(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-deribit', daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self) -> 'FakeDeribitServer':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def serve_connection(self, sock: socket.socket) -> None:
+
+        f = sock.makefile('rb')
+        if not self.__handshake(sock, f):
+            return
+
+        while True:
+            frame = self.__read_frame(f)
+            if frame is None:
+                return
+            opcode, payload = frame
+            if opcode == 0x8:  # close
+                self.__send_frame(sock, 0x8, payload[:2])
+                return
+            if opcode == 0x9:  # ping
+                self.__send_frame(sock, 0xA, payload)
+            elif opcode == 0x1:
+                self.__send_frame(sock, 0x1, json.dumps(self.respond(json.loads(payload))).encode('utf-8'))
+
+    def respond(self, msg: dict) -> dict:
+        ''' the json-rpc response to one request. '''
+
+        self.n_requests += 1
+        method, params = msg['method'], msg.get('params', {})
+        t_in = int(time.time() * 1e6)
+
+        if method == 'public/get_instruments':
+            data = self.data[params['currency']]
+            timestamp = data.timestamp if self.timestamp is None else self.timestamp
+            batch = data.get_ticker_batch(timestamp, params.get('kind', _cst.option))
+            self.tickers.update({t[_cst.instrument_name]: t for t in batch[_cst.tickers]})
+            response = {'result': batch[_cst.instruments]}
+
+        elif method == 'public/ticker':
+            name = params['instrument_name']
+            if name in self.tickers:
+                response = {'result': self.tickers[name]}
+            else:
+                response = {'error': {'message': 'instrument_not_found', 'code': 13020}}
+
+        elif method == 'public/get_order_book':
+            name = params['instrument_name']
+            if name in self.tickers:
+                response = {'result': self.__get_order_book(self.tickers[name], params.get('depth', 20))}
+            else:
+                response = {'error': {'message': 'instrument_not_found', 'code': 13020}}
+
+        elif method == 'public/get_last_trades_by_currency_and_time':
+            timestamps, trades = self.__get_trades(params['currency'], params['start_timestamp'],
+                                                   params['end_timestamp'])
+            i_s = np.searchsorted(timestamps, params['start_timestamp'], side='left')
+            i_e = np.searchsorted(timestamps, params['end_timestamp'], side='right')
+            count = params.get('count', 10)
+            response = {'result': {'trades': trades[i_s:min(i_e, i_s + count)], 'has_more': bool(i_e - i_s > count)}}
+
+        else:
+            response = {'error': {'message': 'method_not_found', 'code': -32601}}
+
+        t_out = int(time.time() * 1e6)
+        return dict(jsonrpc='2.0', id=msg.get('id'), usIn=t_in, usOut=t_out, usDiff=t_out - t_in,
+                    testnet=False, **response)
+
+    @staticmethod
+    def __get_order_book(ticker: dict, depth: int) -> dict:
+
+        # levels a tick apart from the best bid/ask, thinning out with distance
+        tick = 0.0005 if _cst.greeks in ticker else 0.5
+        bid, ask = ticker[_cst.best_bid_price], ticker[_cst.best_ask_price]
+        bids = [[round(bid - i * tick, 8), 10.0 * (i + 1)] for i in range(depth) if bid - i * tick > 0]
+        asks = [[round(ask + i * tick, 8), 10.0 * (i + 1)] for i in range(depth)]
+        return dict(ticker, bids=bids, asks=asks, change_id=int(ticker[_cst.timestamp]))
+
+    def __get_trades(self, currency: str, start_timestamp: int, end_timestamp: int) -> Tuple[np.ndarray, list]:
+
+        # trades are generated per hour and kept, so that overlapping requests see the same trades
+        hour = 3600000
+        trades = []
+        for h in range(start_timestamp // hour, end_timestamp // hour + 1):
+            key = (currency, h)
+            if key not in self.trades:
+                hour_trades = self.data[currency].get_last_trades(h * hour, (h + 1) * hour - 1,
+                                                                  self.trades_per_hour)
+                self.trades[key] = hour_trades
+            trades.extend(self.trades[key])
+
+        return np.array([t[_cst.timestamp] for t in trades], dtype=np.int64), trades
+
+    def __handshake(self, sock: socket.socket, f) -> bool:
+
+        headers = {}
+        line = f.readline()
+        if not line:
+            return False
+        while True:
+            line = f.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + self.ws_guid).encode()).digest())
+        sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        return True
+
+    @staticmethod
+    def __read_frame(f):
+
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        masked = header[1] & 0x80
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('>H', f.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', f.read(8))[0]
+        mask = f.read(4) if masked else None
+        payload = f.read(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    @staticmethod
+    def __send_frame(sock: socket.socket, opcode: int, payload: bytes) -> None:
+
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('>BB', 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+        sock.sendall(header + payload)
@@ -0,0 +1,34 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from xcrytoz.analytics.utils import Interpolator1D
+
+
+@pytest.mark.parametrize('x', [[1., 1., 1., 2., 3.], [0., 1., 2., 2., 2.], [0., 1., 1., 2., 3.], [2., 2., 2.]])
+@pytest.mark.parametrize('kind', [Interpolator1D.s_linear, Interpolator1D.s_pchip])
+def test_duplicate_knots(x, kind):
+    ''' repeated knots, e.g. strikes quoted twice, give finite values without numpy warnings. '''
+
+    y = np.column_stack([np.linspace(1., 2., len(x)), np.linspace(3., 1., len(x))])
+    x_new = np.linspace(-1., 4., 51)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        interpolator = Interpolator1D(x, y, kind=kind)
+        out = interpolator(x_new)
+        out_column = interpolator(x_new, column=1)
+
+    assert out.shape == (x_new.size, 2)
+    assert np.isfinite(out).all() and np.isfinite(out_column).all()
+
+
+def test_pchip_duplicate_end_knots_stay_monotone():
+
+    x = np.array([1., 1., 1., 2., 3., 4.])
+    y = np.array([1., 1., 1., 2., 4., 8.])
+    out = Interpolator1D(x, y, kind=Interpolator1D.s_pchip)(np.linspace(1., 4., 301))
+
+    assert (np.diff(out) >= 0).all()
+    np.testing.assert_allclose(out[[0, 100, 200, 300]], [1., 2., 4., 8.])
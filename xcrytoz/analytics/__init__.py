@@ -1 +1,56 @@
-from .volatility_surface import VolatilitySurfaceDeribit
\ No newline at end of file
+import importlib
+from typing import TYPE_CHECKING
+
+# submodules (and pandas / scipy behind them) are imported on first attribute access
+_LAZY_ATTRIBUTES = {
+    'BlackDeribitChain': '.black',
+    'black_delta': '.black',
+    'black_gamma': '.black',
+    'black_implied_vol': '.black',
+    'black_price': '.black',
+    'black_theta': '.black',
+    'black_vega': '.black',
+    'FORWARD_CURVE_CACHE': '.forward_curve',
+    'ForwardCurve': '.forward_curve',
+    'ForwardCurveCache': '.forward_curve',
+    'RollupStore': '.rollups',
+    'SABRCalibrator': '.sabr',
+    'hagan_lognormal_vol': '.sabr',
+    'CachedSurface': '.surface_cache',
+    'SurfaceCache': '.surface_cache',
+    'SurfaceAsOfJoiner': '.surface_join',
+    'SVISurface': '.svi',
+    'svi_total_variance': '.svi',
+    'TradeAnalytics': '.trades',
+    'VolatilitySurfaceDeribit': '.volatility_surface',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+if TYPE_CHECKING:
+    from .black import (BlackDeribitChain, black_delta, black_gamma,
+                        black_implied_vol, black_price, black_theta,
+                        black_vega)
+    from .forward_curve import (FORWARD_CURVE_CACHE, ForwardCurve,
+                                ForwardCurveCache)
+    from .rollups import RollupStore
+    from .sabr import SABRCalibrator, hagan_lognormal_vol
+    from .surface_cache import CachedSurface, SurfaceCache
+    from .surface_join import SurfaceAsOfJoiner
+    from .svi import SVISurface, svi_total_variance
+    from .trades import TradeAnalytics
+    from .volatility_surface import VolatilitySurfaceDeribit
+
+
+def __getattr__(name: str):
+
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value  # next access does not come here
+        return value
+
+    raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
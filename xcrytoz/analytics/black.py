@@ -0,0 +1,181 @@
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+from ..deribit_data.shared_structures import DeribitFields
+from .forward_curve import ForwardCurve
+from .volatility_surface import VolatilitySurface
+
+# NOTE:
+# undiscounted black-76 on forwards. tau is in years, vol is decimal.
+# vega is per unit of vol, theta is per year (time decay, i.e. - d price / d tau).
+
+_SQRT_2PI = np.sqrt(2.0 * np.pi)
+
+
+def _npdf(x):
+    return np.exp(-0.5 * x * x) / _SQRT_2PI
+
+
+def _d1_d2(forward, strike, tau, vol) -> tuple:
+
+    f, k, t, v = (np.asarray(a, float) for a in (forward, strike, tau, vol))
+    sig_sqrt_t = v * np.sqrt(t)
+    d1 = np.log(f / k) / sig_sqrt_t + 0.5 * sig_sqrt_t
+    return d1, d1 - sig_sqrt_t
+
+
+def black_price(forward, strike, tau, vol, is_call=True) -> np.ndarray:
+
+    d1, d2 = _d1_d2(forward, strike, tau, vol)
+    call = forward * ndtr(d1) - strike * ndtr(d2)
+    put = strike * ndtr(-d2) - forward * ndtr(-d1)
+    return np.where(is_call, call, put)
+
+
+def black_delta(forward, strike, tau, vol, is_call=True) -> np.ndarray:
+
+    d1, _ = _d1_d2(forward, strike, tau, vol)
+    return np.where(is_call, ndtr(d1), ndtr(d1) - 1.0)
+
+
+def black_gamma(forward, strike, tau, vol) -> np.ndarray:
+
+    d1, _ = _d1_d2(forward, strike, tau, vol)
+    return _npdf(d1) / (np.asarray(forward, float) * np.asarray(vol, float) * np.sqrt(tau))
+
+
+def black_vega(forward, strike, tau, vol) -> np.ndarray:
+
+    d1, _ = _d1_d2(forward, strike, tau, vol)
+    return np.asarray(forward, float) * _npdf(d1) * np.sqrt(tau)
+
+
+def black_theta(forward, strike, tau, vol) -> np.ndarray:
+
+    # undiscounted, so calls and puts share the same theta
+    d1, _ = _d1_d2(forward, strike, tau, vol)
+    return - np.asarray(forward, float) * _npdf(d1) * np.asarray(vol, float) / (2.0 * np.sqrt(tau))
+
+
+def black_implied_vol(price, forward, strike, tau, is_call=True,
+                      tol=1e-10, max_iter=50, vol_min=1e-4, vol_max=10.0) -> np.ndarray:
+    ''' batched black implied vol. NaN where the price is outside the no-arbitrage bounds.
+
+    prices are first mapped to the out-of-the-money option by parity, which is the well conditioned
+    side. the Corrado-Miller rational guess is refined by Newton steps, safeguarded by bisection
+    on a [vol_min, vol_max] bracket. '''
+
+    price, f, k, t, is_call = np.broadcast_arrays(*(np.asarray(a, float) for a in (price, forward, strike, tau)),
+                                                  np.asarray(is_call, bool))
+    otm_call = k >= f
+    otm_price = price - np.where(is_call, 1.0, -1.0) * np.where(is_call != otm_call, f - k, 0.0)
+    upper = np.where(otm_call, f, k)
+    valid = (otm_price > 0) & (otm_price < upper) & (t > 0) & (f > 0) & (k > 0)
+
+    # Corrado-Miller on the call price
+    call = np.where(otm_call, otm_price, otm_price + f - k)
+    c_half = call - 0.5 * (f - k)
+    disc = np.maximum(c_half * c_half - (f - k)**2 / np.pi, 0.0)
+    sqrt_t = np.sqrt(np.where(t > 0, t, 1.0))
+    vol = _SQRT_2PI / (f + k) * (c_half + np.sqrt(disc)) / sqrt_t
+    vol = np.clip(np.where(np.isfinite(vol), vol, 0.5), vol_min, vol_max)
+
+    # iterate on the unconverged points only
+    idx = np.flatnonzero(valid)
+    vol, lo, hi = vol.ravel(), np.full(idx.size, vol_min), np.full(idx.size, vol_max)
+    f_a, k_a, t_a, p_a, c_a = (a.ravel()[idx] for a in (f, k, t, otm_price, otm_call))
+    v_a = vol[idx]
+    for _ in range(max_iter):
+
+        if idx.size == 0:
+            break
+
+        diff = black_price(f_a, k_a, t_a, v_a, c_a) - p_a
+        vega = black_vega(f_a, k_a, t_a, v_a)
+
+        # shrink the bracket: the price is increasing in vol
+        lo = np.where(diff < 0, v_a, lo)
+        hi = np.where(diff > 0, v_a, hi)
+
+        # converged points keep the current vol, the others take a newton or bisection step
+        keep = (np.abs(diff) > tol * p_a) & (hi - lo > tol)
+        v_newton = v_a - np.divide(diff, vega, out=np.full(idx.size, np.inf), where=vega > 0)
+        v_a = np.where(keep, np.where((v_newton > lo) & (v_newton < hi), v_newton, 0.5 * (lo + hi)), v_a)
+        vol[idx] = v_a
+
+        idx, lo, hi, v_a = idx[keep], lo[keep], hi[keep], v_a[keep]
+        f_a, k_a, t_a, p_a, c_a = f_a[keep], k_a[keep], t_a[keep], p_a[keep], c_a[keep]
+
+    vol = vol.reshape(valid.shape)
+
+    return np.where(valid, vol, np.nan)
+
+
+class BlackDeribitChain:
+    ''' black-76 on frames from ConverterToDF.tick_info_to_df.
+
+    deribit option prices are in units of the underlying coin, so they are multiplied by the
+    forward before inverting. the forward is deribit's underlying price, or the forward curve's if
+    one is given. '''
+
+    s_price = 'price'
+    s_delta = 'delta'
+    s_gamma = 'gamma'
+    s_vega = 'vega'
+    s_theta = 'theta'
+    s_tau = 'tau'
+
+    _cst = DeribitFields()
+
+    @staticmethod
+    def get_tau(df_md: pd.DataFrame) -> np.ndarray:
+        cst = BlackDeribitChain._cst
+        return (df_md[cst.expiration_timestamp].to_numpy(float) - df_md[cst.timestamp].to_numpy(float)) \
+            / VolatilitySurface.ms_per_year
+
+    @staticmethod
+    def get_forward(df_md: pd.DataFrame, forward_curve: ForwardCurve = None) -> np.ndarray:
+        cst = BlackDeribitChain._cst
+        if forward_curve is None:
+            return df_md[cst.underlying_price].to_numpy(float)
+        return forward_curve.get_forward(df_md[cst.expiration_timestamp].to_numpy())
+
+    @staticmethod
+    def implied_vol(df_md: pd.DataFrame, price_field: str = DeribitFields.mark_price,
+                    forward_curve: ForwardCurve = None) -> pd.Series:
+        ''' implied vols (decimal) of a whole chain at once. price_field can be mark_price,
+        best_bid_price or best_ask_price. '''
+
+        cst = BlackDeribitChain._cst
+        fwd = BlackDeribitChain.get_forward(df_md, forward_curve)
+        price = df_md[price_field].to_numpy(float) * fwd
+        vol = black_implied_vol(price, fwd, df_md[cst.strike].to_numpy(float), BlackDeribitChain.get_tau(df_md),
+                                (df_md[cst.option_type] == cst.call).to_numpy())
+
+        return pd.Series(vol, index=df_md.index, name=price_field)
+
+    @staticmethod
+    def greeks(df_md: pd.DataFrame, vol: Union[np.ndarray, pd.Series] = None,
+               forward_curve: ForwardCurve = None) -> pd.DataFrame:
+        ''' price (in USD), delta, gamma, vega and theta of a whole chain. uses mark_iv if vol is not given. '''
+
+        cst = BlackDeribitChain._cst
+        if vol is None:
+            vol = df_md[cst.mark_iv].to_numpy(float) / 100.0  # deribit iv is in percent
+        vol = np.asarray(vol, float)
+
+        fwd = BlackDeribitChain.get_forward(df_md, forward_curve)
+        strike = df_md[cst.strike].to_numpy(float)
+        tau = BlackDeribitChain.get_tau(df_md)
+        is_call = (df_md[cst.option_type] == cst.call).to_numpy()
+
+        return pd.DataFrame(index=df_md.index, data={
+            BlackDeribitChain.s_tau: tau,
+            BlackDeribitChain.s_price: black_price(fwd, strike, tau, vol, is_call),
+            BlackDeribitChain.s_delta: black_delta(fwd, strike, tau, vol, is_call),
+            BlackDeribitChain.s_gamma: black_gamma(fwd, strike, tau, vol),
+            BlackDeribitChain.s_vega: black_vega(fwd, strike, tau, vol),
+            BlackDeribitChain.s_theta: black_theta(fwd, strike, tau, vol)})
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+
+from ..deribit_data.shared_structures import DeribitFields
+
+# constants from deribit data
+_cst = DeribitFields()
+
+
+class ForwardCurve:
+    ''' forward curve of one currency at one snapshot.
+
+    knots are the index price at the snapshot time and the mark prices of the dated futures.
+    log forwards are linear in time between knots, and the first/last segments' carry is used to
+    extrapolate. '''
+
+    def __init__(self, name: str, timestamp: int, expiration_timestamps: np.ndarray, forwards: np.ndarray):
+
+        if not np.issubdtype(type(timestamp), np.integer):
+            raise TypeError('timestamp ' + str(timestamp) + ' is not an integer.')
+
+        i_s = np.argsort(expiration_timestamps)
+        self.name: str = name
+        self.as_of_timestamp: int = timestamp
+        self.expiration_timestamps: np.ndarray = np.asarray(expiration_timestamps, dtype=np.int64)[i_s]
+        self.log_forwards: np.ndarray = np.log(np.asarray(forwards, dtype=float)[i_s])
+
+        # carry (d log F / d ms) of the end segments, for extrapolation
+        ts = self.expiration_timestamps.astype(float)
+        if ts.size > 1:
+            self.carry_first = (self.log_forwards[1] - self.log_forwards[0]) / (ts[1] - ts[0])
+            self.carry_last = (self.log_forwards[-1] - self.log_forwards[-2]) / (ts[-1] - ts[-2])
+        else:
+            self.carry_first = self.carry_last = 0.0
+
+    @classmethod
+    def from_future_batch(cls, name: str, timestamp: int, deribit_future_data: dict) -> 'ForwardCurve':
+        ''' builds from a future ticker batch (the data of a '<batch>_<currency>_future' file).
+        perpetuals are skipped; their index price is the spot knot. '''
+
+        kw_exp = {inst[_cst.instrument_name]: inst[_cst.expiration_timestamp]
+                  for inst in deribit_future_data[_cst.instruments]
+                  if inst.get(_cst.settlement_period) != _cst.perpetual}
+
+        tickers = deribit_future_data[_cst.tickers]
+        exps = [kw_exp[t[_cst.instrument_name]] for t in tickers if t[_cst.instrument_name] in kw_exp]
+        fwds = [t[_cst.mark_price] for t in tickers if t[_cst.instrument_name] in kw_exp]
+
+        # spot knot at the snapshot time. tickers of the same batch share the index price.
+        if len(tickers) > 0:
+            exps.append(timestamp)
+            fwds.append(np.median([t[_cst.index_price] for t in tickers]))
+
+        if len(exps) == 0:
+            raise Exception('no futures to build a forward curve for ' + name)
+
+        return cls(name, timestamp, np.array(exps), np.array(fwds))
+
+    def get_forward(self, expiration_timestamp: Union[int, np.ndarray]) -> np.ndarray:
+
+        ts = np.asarray(expiration_timestamp, dtype=float)
+        knots = self.expiration_timestamps.astype(float)
+
+        lnf = np.interp(ts, knots, self.log_forwards)
+        lnf = np.where(ts < knots[0], self.log_forwards[0] + self.carry_first * (ts - knots[0]), lnf)
+        lnf = np.where(ts > knots[-1], self.log_forwards[-1] + self.carry_last * (ts - knots[-1]), lnf)
+
+        return np.exp(lnf)
+
+
+class ForwardCurveCache:
+    ''' forward curves keyed by (name, snapshot timestamp), least recently used evicted first.
+
+    the surface builder and pricing code ask the cache so that a snapshot's curve is built once. '''
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.curves: OrderedDict = OrderedDict()
+
+    def get(self, name: str, timestamp: int, deribit_future_data: dict = None) -> ForwardCurve:
+        ''' cached curve, built from deribit_future_data on a miss. returns None on a miss without data. '''
+
+        key = (name, timestamp)
+        if key in self.curves:
+            self.curves.move_to_end(key)
+            return self.curves[key]
+
+        if deribit_future_data is None:
+            return None
+
+        curve = ForwardCurve.from_future_batch(name, timestamp, deribit_future_data)
+        self.curves[key] = curve
+        if len(self.curves) > self.max_size:
+            self.curves.popitem(last=False)
+
+        return curve
+
+    def clear(self) -> None:
+        self.curves.clear()
+
+
+# shared by default
+FORWARD_CURVE_CACHE = ForwardCurveCache()
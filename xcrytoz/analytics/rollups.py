@@ -0,0 +1,296 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ..common_utils import get_logger
+from ..deribit_data.batch_managers import BatchFileManager
+from ..deribit_data.shared_structures import DeribitConstants, DeribitFields
+from ..tracing import traced
+from .surface_cache import SurfaceCache
+from .volatility_surface import VolatilitySurface, VolatilitySurfaceDeribit
+
+_LOGGER = get_logger(__name__)
+
+# constants from deribit data
+_cst = DeribitFields()
+_dcs = DeribitConstants()
+
+# NOTE:
+# rollups of a currency live in <root>/<currency>/: rollups.json (the metric columns and the last
+# snapshot added) and a folder per resolution of segments <segment start>.npz, each covering
+# _SEGMENT_BUCKETS buckets. a segment holds its records sorted by bucket and the sorted timestamps of
+# the snapshots already in them. a record is one (bucket, expiry): the number of snapshots, the last
+# snapshot's timestamp, and per metric the sum and the last value over those snapshots. buckets start
+# at multiples of the resolution since the epoch. a snapshot rewrites the one segment of its bucket,
+# to a temporary file renamed over it, so a crash never loses records, and a snapshot already in a
+# segment is not added to it again. the last segment read per resolution is kept in memory while its
+# size and mtime are unchanged, so consecutive snapshots do not read it back. sums and counts
+# re-aggregate exactly, which is how a query at a multiple of a stored resolution is answered.
+
+_BASE_DTYPE = [('bucket', '<i8'), ('expiration_timestamp', '<i8'), ('count', '<i8'), ('last_timestamp', '<i8')]
+
+_MINUTE_MS = 60 * 1000
+_SEGMENT_BUCKETS = 256
+
+
+class RollupStore:
+    ''' downsampled surface metrics (forward, arf vols and extrapolation flags of df_md_combined) per
+    currency and expiry, at several resolutions. extrapolation flags roll up to the fraction of
+    snapshots extrapolated. not safe for concurrent writers. '''
+
+    s_mean = 'mean'
+    s_last = 'last'
+    s_count = 'count'
+    s_header_file_name = 'rollups.json'
+
+    default_resolutions = {'5min': 5 * _MINUTE_MS, '1h': 60 * _MINUTE_MS, '1d': 24 * 60 * _MINUTE_MS}
+    metric_fields = (VolatilitySurface.s_forward, VolatilitySurface.s_volatility_arf,
+                     VolatilitySurface.s_extrapolated_arf)
+
+    def __init__(self, root_folder: str, resolutions: dict = None):
+        ''' resolutions maps a name to a bucket length in ms. '''
+
+        self.root_folder = root_folder
+        self.resolutions: dict = dict(resolutions or self.default_resolutions)
+        # the last segment read or written per (currency, resolution): path, stamp, records, snapshots
+        self.__segments: dict = {}
+
+    def get_columns(self, currency: str) -> list:
+        ''' the (field, label) metric columns of a currency, None if nothing was added yet. '''
+
+        header = self.__read_header(currency)
+        return None if header is None else [tuple(c) for c in header['columns']]
+
+    def get_last_timestamp(self, currency: str) -> int:
+        ''' timestamp of the latest snapshot added, None if nothing was added yet. '''
+
+        header = self.__read_header(currency)
+        return None if header is None else header['last_timestamp']
+
+    def has_snapshot(self, currency: str, timestamp: int) -> bool:
+        ''' whether the snapshot at timestamp is in every resolution. '''
+
+        columns = self.get_columns(currency)
+        if columns is None:
+            return False
+        return all(_contains(self.__read_segment(currency, name, timestamp, len(columns))[1], timestamp)
+                   for name in self.resolutions)
+
+    @traced()
+    def add(self, currency: str, timestamp: int, df_md_combined: pd.DataFrame) -> bool:
+        ''' adds the summary of one surface snapshot to every resolution it is not in yet. returns
+        False if it was in all of them already. '''
+
+        is_metric = df_md_combined.columns.get_level_values(0).isin(self.metric_fields)
+        columns = list(df_md_combined.columns[is_metric])
+        header = self.__read_header(currency)
+        if header is None:
+            os.makedirs(os.path.join(self.root_folder, currency), exist_ok=True)
+            header = {'columns': [list(c) for c in columns], 'last_timestamp': timestamp}
+        elif [tuple(c) for c in header['columns']] != columns:
+            raise ValueError('metric columns of the snapshot at ' + str(timestamp)
+                             + ' differ from the stored rollups of ' + currency + '.')
+
+        dtype = self.__get_dtype(len(columns))
+        # by position: selecting by a list of labels re-indexes the column MultiIndex on every snapshot
+        values = df_md_combined.iloc[:, is_metric].to_numpy(dtype=float)
+
+        is_added = False
+        for name, resolution_ms in self.resolutions.items():
+            records, snapshots = self.__read_segment(currency, name, timestamp, len(columns))
+            if _contains(snapshots, timestamp):
+                continue
+
+            rows = np.zeros(len(df_md_combined), dtype=dtype)
+            rows['bucket'] = timestamp - timestamp % resolution_ms
+            rows['expiration_timestamp'] = df_md_combined.index.to_numpy()
+            rows['count'] = 1
+            rows['last_timestamp'] = timestamp
+            for i in range(len(columns)):
+                rows['sum_' + str(i)] = values[:, i]
+                rows['last_' + str(i)] = values[:, i]
+            self.__write_segment(currency, name, timestamp, _combine(np.concatenate([records, rows]), len(columns)),
+                                 np.insert(snapshots, np.searchsorted(snapshots, timestamp), timestamp))
+            is_added = True
+
+        header['last_timestamp'] = max(header['last_timestamp'], timestamp)
+        self.__write_header(currency, header)
+
+        return is_added
+
+    def update_from_ticker_batches(self, root_folder: str, currency: str, surface_cache: SurfaceCache = None,
+                                   from_timestamp: int = None, to_timestamp: int = None, **build_kwargs) -> int:
+        ''' adds the stored option ticker batches not added yet. surfaces come from surface_cache when
+        given. by default only batches later than the last snapshot added are looked at; pass
+        from_timestamp to also pick up batches stored later with older timestamps, e.g. by a
+        backfill. returns the number of snapshots added. '''
+
+        if from_timestamp is None:
+            from_timestamp = self.get_last_timestamp(currency)
+        bfm = BatchFileManager(root_folder)
+        infos = [bi for bi in bfm.get_ticker_batch_file_infos(from_timestamp, to_timestamp)
+                 if bi.currency == currency and bi.kind == _cst.option
+                 and not self.has_snapshot(currency, bi.batch_timestamp)]
+
+        for bi in infos:
+            if surface_cache is not None:
+                df_md_combined = surface_cache.get_or_build(root_folder, bi.path, currency, bi.batch_timestamp,
+                                                            **build_kwargs).df_md_combined
+            else:
+                surface = VolatilitySurfaceDeribit(currency, bi.batch_timestamp, bfm.read(bi.path)[_dcs.data])
+                surface.build(**build_kwargs)
+                df_md_combined = surface.df_md_combined
+            self.add(currency, bi.batch_timestamp, df_md_combined)
+
+        return len(infos)
+
+    def get_resolution(self, resolution_ms: int) -> str:
+        ''' the coarsest stored resolution whose buckets tile buckets of resolution_ms. '''
+
+        candidates = [(ms, name) for name, ms in self.resolutions.items()
+                      if ms <= resolution_ms and resolution_ms % ms == 0]
+        if not candidates:
+            raise ValueError('no stored resolution divides ' + str(resolution_ms) + ' ms.')
+        return max(candidates)[1]
+
+    @traced()
+    def get(self, currency: str, from_timestamp: int, to_timestamp: int, resolution_ms: int,
+            stat=s_mean) -> pd.DataFrame:
+        ''' metrics of the buckets of resolution_ms starting in [from_timestamp, to_timestamp), indexed by
+        (bucket, expiration_timestamp), each the mean or last (stat) over the bucket's snapshots. read
+        from the coarsest stored resolution that tiles resolution_ms. '''
+
+        if stat not in (self.s_mean, self.s_last):
+            raise ValueError('stat ' + str(stat) + ' is neither ' + self.s_mean + ' nor ' + self.s_last + '.')
+
+        columns = self.get_columns(currency)
+        if columns is None:
+            raise ValueError('no rollups of ' + currency + '.')
+
+        name = self.get_resolution(resolution_ms)
+        # whole buckets: up to the end of the bucket in which to_timestamp falls
+        rows = self.__read_range(currency, name, len(columns), from_timestamp,
+                                 to_timestamp - to_timestamp % resolution_ms + resolution_ms)
+        if self.resolutions[name] < resolution_ms:
+            rows['bucket'] -= rows['bucket'] % resolution_ms
+            rows = _combine(rows, len(columns))
+        rows = rows[(rows['bucket'] >= from_timestamp) & (rows['bucket'] < to_timestamp)]
+
+        index = pd.MultiIndex.from_arrays([rows['bucket'], rows['expiration_timestamp']],
+                                          names=['timestamp', VolatilitySurface.s_expiration_timestamp])
+        data = {(self.s_count, self.s_count): rows['count']}
+        for i, c in enumerate(columns):
+            data[c] = rows['sum_' + str(i)] / rows['count'] if stat == self.s_mean else rows['last_' + str(i)]
+
+        return pd.DataFrame(data, index=index)
+
+    def __get_segment_path(self, currency: str, resolution_name: str, timestamp: int) -> str:
+
+        segment_ms = self.resolutions[resolution_name] * _SEGMENT_BUCKETS
+        return os.path.join(self.root_folder, currency, resolution_name,
+                            str(timestamp - timestamp % segment_ms) + '.npz')
+
+    @staticmethod
+    def __get_dtype(n_metrics: int) -> np.dtype:
+        return np.dtype(_BASE_DTYPE + [(prefix + str(i), '<f8')
+                                       for i in range(n_metrics) for prefix in ('sum_', 'last_')])
+
+    def __read_header(self, currency: str) -> dict:
+
+        path = os.path.join(self.root_folder, currency, self.s_header_file_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def __write_header(self, currency: str, header: dict) -> None:
+
+        path = os.path.join(self.root_folder, currency, self.s_header_file_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(path + '.tmp', path)
+
+    def __read_range(self, currency: str, resolution_name: str, n_metrics: int, from_bucket: int,
+                     to_bucket: int) -> np.ndarray:
+        ''' the records with from_bucket <= bucket < to_bucket. '''
+
+        folder = os.path.join(self.root_folder, currency, resolution_name)
+        segment_ms = self.resolutions[resolution_name] * _SEGMENT_BUCKETS
+        segment_starts = sorted(int(f[:-len('.npz')]) for f in os.listdir(folder) if f.endswith('.npz')) \
+            if os.path.exists(folder) else []
+
+        parts = [np.zeros(0, dtype=self.__get_dtype(n_metrics))]
+        for start in segment_starts:
+            if start + segment_ms <= from_bucket or start >= to_bucket:
+                continue
+            records = self.__read_segment(currency, resolution_name, start, n_metrics)[0]
+            i_from, i_to = np.searchsorted(records['bucket'], [from_bucket, to_bucket])
+            parts.append(records[i_from:i_to])
+
+        return np.concatenate(parts)
+
+    def __read_segment(self, currency: str, resolution_name: str, timestamp: int, n_metrics: int) -> tuple:
+        ''' the records of the segment of timestamp and the sorted timestamps of the snapshots in them,
+        empty if there is none. '''
+
+        path = self.__get_segment_path(currency, resolution_name, timestamp)
+        stamp = _get_stamp(path)
+        cached = self.__segments.get((currency, resolution_name))
+        if cached is not None and cached[0] == path and cached[1] == stamp:
+            return cached[2], cached[3]
+
+        if stamp is None:
+            return np.zeros(0, dtype=self.__get_dtype(n_metrics)), np.zeros(0, dtype=np.int64)
+        with np.load(path) as npz:
+            records, snapshots = npz['records'], np.sort(npz['snapshots'])
+        self.__segments[(currency, resolution_name)] = (path, stamp, records, snapshots)
+
+        return records, snapshots
+
+    def __write_segment(self, currency: str, resolution_name: str, timestamp: int, records: np.ndarray,
+                        snapshots: np.ndarray) -> None:
+
+        path = self.__get_segment_path(currency, resolution_name, timestamp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to the segment and renamed over it, so that a crash leaves the old or the new one
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, records=records, snapshots=snapshots)
+        os.replace(path + '.tmp', path)
+
+        self.__segments[(currency, resolution_name)] = (path, _get_stamp(path), records, snapshots)
+
+
+def _combine(rows: np.ndarray, n_metrics: int) -> np.ndarray:
+    ''' one record per (bucket, expiry): counts and sums added, last values of the latest snapshot. '''
+
+    if len(rows) == 0:
+        return rows
+
+    rows = rows[np.lexsort((rows['last_timestamp'], rows['expiration_timestamp'], rows['bucket']))]
+    key_changed = (np.diff(rows['bucket']) != 0) | (np.diff(rows['expiration_timestamp']) != 0)
+    starts = np.concatenate(([0], np.flatnonzero(key_changed) + 1))
+    lasts = np.append(starts[1:], len(rows)) - 1
+
+    combined = rows[lasts]
+    combined['count'] = np.add.reduceat(rows['count'], starts)
+    for i in range(n_metrics):
+        combined['sum_' + str(i)] = np.add.reduceat(rows['sum_' + str(i)], starts)
+
+    return combined
+
+
+def _contains(sorted_values: np.ndarray, value: int) -> bool:
+    i = np.searchsorted(sorted_values, value)
+    return bool(i < len(sorted_values) and sorted_values[i] == value)
+
+
+def _get_stamp(path: str) -> tuple:
+    ''' (size, mtime) of a file, None if it does not exist. '''
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,153 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from ..common_utils import get_logger
+from .utils import PaddedSmiles, batched_levenberg_marquardt, get_padded_smiles
+
+_LOGGER = get_logger(__name__)
+
+
+def hagan_lognormal_vol(forward, strike, tau, alpha, beta, rho, nu) -> np.ndarray:
+    ''' Hagan et al (2002) lognormal implied volatility. all arguments broadcast. '''
+
+    f, k, t = np.asarray(forward, float), np.asarray(strike, float), np.asarray(tau, float)
+
+    omb = 1.0 - beta
+    fk_omb_half = (f * k) ** (0.5 * omb)
+    lfk = np.log(f / k)
+    lfk2 = lfk * lfk
+
+    denom = fk_omb_half * (1.0 + omb**2 / 24.0 * lfk2 + omb**4 / 1920.0 * lfk2 * lfk2)
+
+    # z / x(z), with the series expansion around z = 0 (at the money)
+    z = nu / alpha * fk_omb_half * lfk
+    small = np.abs(z) < 1e-6
+    z_safe = np.where(small, 1.0, z)
+    x_z = np.log((np.sqrt(1.0 - 2.0 * rho * z_safe + z_safe * z_safe) + z_safe - rho) / (1.0 - rho))
+    z_over_x = np.where(small, 1.0 - 0.5 * rho * z + (2.0 - 3.0 * rho * rho) / 12.0 * z * z, z_safe / x_z)
+
+    correction = 1.0 + (omb**2 / 24.0 * alpha**2 / fk_omb_half**2
+                        + 0.25 * rho * beta * nu * alpha / fk_omb_half
+                        + (2.0 - 3.0 * rho * rho) / 24.0 * nu * nu) * t
+
+    return alpha / denom * z_over_x * correction
+
+
+class SABRCalibrator:
+    ''' calibrates (alpha, rho, nu) of every expiry with a fixed beta.
+
+    all expiries are fitted together with a batched Levenberg-Marquardt, so a full surface takes a
+    handful of numpy passes per iteration. '''
+
+    s_alpha = 'alpha'
+    s_beta = 'beta'
+    s_rho = 'rho'
+    s_nu = 'nu'
+    s_rmse = 'rmse'
+    s_expiration_timestamp = 'expiration_timestamp'
+
+    def __init__(self, beta=1.0, max_iter=100, tol=1e-10, fd_step=1e-7):
+
+        self.beta = beta
+        self.max_iter = max_iter
+        self.tol = tol
+        self.fd_step = fd_step
+
+    def calibrate(self, surface, initial_params: pd.DataFrame = None) -> pd.DataFrame:
+        ''' fits a built surface. initial_params (e.g. the previous snapshot's result) warm-starts
+        the expiries it contains; the others start from the atm vol. '''
+
+        return self.calibrate_market_data(get_padded_smiles(surface), initial_params)
+
+    def calibrate_market_data(self, md: PaddedSmiles, initial_params: pd.DataFrame = None) -> pd.DataFrame:
+
+        f, k, t = md.forwards[:, np.newaxis], md.strikes, md.taus[:, np.newaxis]
+
+        x, cost = batched_levenberg_marquardt(lambda x: self.__residuals(x, f, k, t, md),
+                                              self.__get_initial_x(md, initial_params),
+                                              self.max_iter, self.tol, self.fd_step)
+
+        alpha, rho, nu = self.__from_x(x)
+        n_points = np.maximum(md.mask.sum(axis=1), 1)
+        df_params = pd.DataFrame(
+            index=pd.Index(md.expirations, name=self.s_expiration_timestamp),
+            data={self.s_alpha: alpha, self.s_beta: self.beta, self.s_rho: rho, self.s_nu: nu,
+                  self.s_rmse: np.sqrt(cost / n_points)})
+
+        return df_params
+
+    def calibrate_history(self, surfaces: list, n_workers: int = 1, initial_params: pd.DataFrame = None)\
+            -> List[pd.DataFrame]:
+        ''' calibrates a time-ordered list of surfaces, each warm-started from the previous one.
+
+        with n_workers > 1, the list is split into contiguous chunks calibrated in separate processes;
+        only the first snapshot of each chunk starts cold. '''
+
+        mds = [get_padded_smiles(s) for s in surfaces]
+
+        if n_workers <= 1 or len(mds) <= 1:
+            return _calibrate_chain(self, mds, initial_params)
+
+        chunks = [list(c) for c in np.array_split(np.arange(len(mds)), min(n_workers, len(mds)))]
+        _LOGGER.info('calibrating ' + str(len(mds)) + ' snapshots in ' + str(len(chunks)) + ' chunks')
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_calibrate_chain, self, [mds[i] for i in c],
+                                       initial_params if i_c == 0 else None)
+                       for i_c, c in enumerate(chunks)]
+            results = [df for fut in futures for df in fut.result()]
+
+        return results
+
+    def get_volatility(self, df_params: pd.DataFrame, md: PaddedSmiles) -> np.ndarray:
+        ''' model vols on the padded market data grid. '''
+
+        df_p = df_params.loc[md.expirations]
+        return hagan_lognormal_vol(
+            md.forwards[:, np.newaxis], md.strikes, md.taus[:, np.newaxis],
+            df_p[self.s_alpha].to_numpy()[:, np.newaxis], self.beta,
+            df_p[self.s_rho].to_numpy()[:, np.newaxis], df_p[self.s_nu].to_numpy()[:, np.newaxis])
+
+    # parameters are transformed so that the optimisation is unconstrained:
+    # alpha = exp(x0), rho = tanh(x1), nu = exp(x2)
+    @staticmethod
+    def __from_x(x: np.ndarray) -> tuple:
+        return np.exp(x[:, 0]), 0.999 * np.tanh(x[:, 1]), np.exp(x[:, 2])
+
+    def __get_initial_x(self, md: PaddedSmiles, initial_params: Union[pd.DataFrame, None]) -> np.ndarray:
+
+        # cold start: atm vol scaled for beta, no skew, moderate vol of vol
+        i_atm = np.argmin(np.where(md.mask, np.abs(np.log(md.strikes / md.forwards[:, np.newaxis])), np.inf), axis=1)
+        vol_atm = np.maximum(md.vols[np.arange(md.vols.shape[0]), i_atm], 1e-4)
+        alpha = vol_atm * md.forwards ** (1.0 - self.beta)
+        rho = np.zeros_like(alpha)
+        nu = np.ones_like(alpha)
+
+        if initial_params is not None:
+            df_init = initial_params.reindex(md.expirations)
+            found = df_init[self.s_alpha].notna().to_numpy()
+            alpha = np.where(found, df_init[self.s_alpha].to_numpy(float), alpha)
+            rho = np.where(found, df_init[self.s_rho].to_numpy(float), rho)
+            nu = np.where(found, df_init[self.s_nu].to_numpy(float), nu)
+
+        return np.column_stack([np.log(alpha), np.arctanh(np.clip(rho / 0.999, -0.999, 0.999)), np.log(nu)])
+
+    def __residuals(self, x, f, k, t, md: PaddedSmiles) -> np.ndarray:
+
+        alpha, rho, nu = self.__from_x(x)
+        model = hagan_lognormal_vol(f, k, t, alpha[:, np.newaxis], self.beta,
+                                    rho[:, np.newaxis], nu[:, np.newaxis])
+        return np.where(md.mask, model - md.vols, 0.0)
+
+
+def _calibrate_chain(calibrator: SABRCalibrator, mds: List[PaddedSmiles], initial_params: pd.DataFrame = None):
+
+    # module level so that it can be sent to worker processes
+    results = []
+    for md in mds:
+        initial_params = calibrator.calibrate_market_data(md, initial_params)
+        results.append(initial_params)
+    return results
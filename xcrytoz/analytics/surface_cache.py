@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from ..common_utils import get_logger
+from ..deribit_data.batch_managers import BatchFileManager
+from ..deribit_data.shared_structures import DeribitConstants
+from ..tracing import traced
+from .forward_curve import ForwardCurve
+from .utils import Interpolator1D
+from .volatility_surface import VolatilitySurfaceDeribit
+
+_LOGGER = get_logger(__name__)
+
+# constants from deribit data
+_dcs = DeribitConstants()
+
+# NOTE:
+# an entry is a folder per (source batch, future batch, target deltas, interp kind) holding one parquet
+# file per frame (df_md_combined and each fit) and header.json: the frame names and the validity of
+# the entry, i.e. the builder version and, per source file, its content hash with the size and mtime
+# it had when hashed. a source whose size and mtime are unchanged is not hashed again, so a lookup in
+# a new session costs a stat. an entry whose source or builder changed is removed when next looked up.
+# last use is the folder's mtime, touched on every hit, and the least recently used entries go first
+# once the cache exceeds max_bytes.
+
+# df_md_combined and the fit parameters, each fit's frame by name
+CachedSurface = namedtuple('CachedSurface', ['df_md_combined', 'params'])
+
+_HEADER_FILE_NAME = 'header.json'
+_EXTENSION = '.surface'
+
+
+class SurfaceCache:
+    ''' built surface summaries persisted on disk as parquet, keyed by their source batch. '''
+
+    s_df_md_combined = 'df_md_combined'
+
+    def __init__(self, cache_folder: str, max_bytes: int = 2 ** 30):
+
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        # content hashes of this session, keyed by absolute path, kept while size and mtime are unchanged
+        self.source_hashes: dict = {}
+
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def get(self, source_path: str, target_neg_put_deltas_half=[0.1, 0.25],
+            interp_kind=Interpolator1D.s_linear, future_path: str = None) -> CachedSurface:
+        ''' the cached entry of the source batch file, or None if there is none or it is stale. '''
+
+        entry_path = self.__get_entry_path(source_path, target_neg_put_deltas_half, interp_kind, future_path)
+        if not os.path.exists(entry_path):
+            return None
+
+        try:
+            with open(os.path.join(entry_path, _HEADER_FILE_NAME), 'r') as f:
+                header = json.load(f)
+            is_valid, is_restamped = self.__check_sources(header, source_path, future_path)
+            if not is_valid:
+                _LOGGER.info('stale cached surface of ' + source_path + '. removed.')
+                self.__remove(entry_path)
+                return None
+            if is_restamped:
+                # same content under a new mtime: not hashed again next time
+                self.__write_header(entry_path, header)
+            frames = {name: pd.read_parquet(os.path.join(entry_path, name + '.parquet'))
+                      for name in header['frames']}
+        except (OSError, ValueError, KeyError) as ex:
+            _LOGGER.warning('unreadable cached surface ' + entry_path + ' (' + str(ex) + '). removed.')
+            self.__remove(entry_path)
+            return None
+
+        # last use, for eviction
+        os.utime(entry_path)
+
+        df_md_combined = frames.pop(self.s_df_md_combined)
+        return CachedSurface(df_md_combined, frames)
+
+    @traced()
+    def put(self, source_path: str, df_md_combined: pd.DataFrame, params: Dict[str, pd.DataFrame] = None,
+            target_neg_put_deltas_half=[0.1, 0.25], interp_kind=Interpolator1D.s_linear,
+            future_path: str = None) -> str:
+        ''' stores the built frames of the source batch file, then evicts down to max_bytes. the names
+        of params become file names. returns the entry path. '''
+
+        frames = dict(params or {})
+        frames[self.s_df_md_combined] = df_md_combined
+        header = {'source': source_path,
+                  'builder_version': VolatilitySurfaceDeribit.builder_version,
+                  'sources': [self.__get_source_record(source_path),
+                              None if future_path is None else self.__get_source_record(future_path)],
+                  'frames': list(frames)}
+
+        entry_path = self.__get_entry_path(source_path, target_neg_put_deltas_half, interp_kind, future_path)
+
+        # written next to the entry and renamed, so readers never see a partial entry
+        tmp_path = entry_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, df in frames.items():
+            df.to_parquet(os.path.join(tmp_path, name + '.parquet'))
+        self.__write_header(tmp_path, header)
+
+        self.__remove(entry_path)
+        os.replace(tmp_path, entry_path)
+
+        self.evict(keep=entry_path)
+
+        return entry_path
+
+    def get_or_build(self, root_folder: str, path: str, name: str, timestamp: int,
+                     target_neg_put_deltas_half=[0.1, 0.25], interp_kind=Interpolator1D.s_linear,
+                     fits: Dict[str, Callable] = None, future_path: str = None) -> CachedSurface:
+        ''' the cached entry of a stored option ticker batch (path without root folder), built and
+        stored on a miss. fits maps a name to a function of the built surface returning its parameter
+        frame, e.g. {'svi': lambda s: SVISurface(s).fit()}. forwards come from the future batch at
+        future_path if given. '''
+
+        fits = fits or {}
+        source_path = os.path.join(root_folder, path)
+        full_future_path = None if future_path is None else os.path.join(root_folder, future_path)
+
+        cached = self.get(source_path, target_neg_put_deltas_half, interp_kind, full_future_path)
+        if cached is not None and all(fit_name in cached.params for fit_name in fits):
+            return cached
+
+        bfm = BatchFileManager(root_folder)
+        forward_curve = None
+        if future_path is not None:
+            forward_curve = ForwardCurve.from_future_batch(name, timestamp, bfm.read(future_path)[_dcs.data])
+        surface = VolatilitySurfaceDeribit(name, timestamp, bfm.read(path)[_dcs.data], forward_curve)
+        surface.build(target_neg_put_deltas_half, interp_kind)
+
+        params = {fit_name: fit(surface) for fit_name, fit in fits.items()}
+        self.put(source_path, surface.df_md_combined, params, target_neg_put_deltas_half, interp_kind,
+                 full_future_path)
+
+        return CachedSurface(surface.df_md_combined, params)
+
+    def evict(self, keep: str = None) -> List[str]:
+        ''' removes the least recently used entries until the cache fits in max_bytes. keep is never
+        removed. returns the removed entry paths. '''
+
+        entries = [(entry.stat().st_mtime_ns, _get_folder_size(entry.path), entry.path)
+                   for entry in self.__scan_entries()]
+
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            self.__remove(entry_path)
+            total -= size
+            removed.append(entry_path)
+
+        return removed
+
+    def clear(self) -> None:
+
+        for entry in self.__scan_entries():
+            self.__remove(entry.path)
+
+    def get_size(self) -> int:
+        ''' bytes of all entries. '''
+        return sum(_get_folder_size(entry.path) for entry in self.__scan_entries())
+
+    def get_source_hash(self, source_path: str) -> str:
+        ''' content hash of a file, recomputed only when its size or mtime changed. '''
+        return self.__get_source_record(source_path)['hash']
+
+    def __get_source_record(self, source_path: str) -> dict:
+        ''' the content hash of a file with the (size, mtime) it was computed for. '''
+
+        abs_path = os.path.abspath(source_path)
+        stamp = _get_stamp(abs_path)
+
+        record = self.source_hashes.get(abs_path)
+        if record is not None and record['stamp'] == stamp:
+            return record
+
+        h = hashlib.blake2b(digest_size=20)
+        with open(abs_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        self.source_hashes[abs_path] = {'stamp': stamp, 'hash': h.hexdigest()}
+
+        return self.source_hashes[abs_path]
+
+    def __check_sources(self, header: dict, source_path: str, future_path: str) -> tuple:
+        ''' whether the entry is still valid, and whether a stored stamp was updated in header. '''
+
+        if header['builder_version'] != VolatilitySurfaceDeribit.builder_version:
+            return False, False
+
+        is_restamped = False
+        for path, stored in zip([source_path, future_path], header['sources']):
+            if (path is None) != (stored is None):
+                return False, False
+            if path is None or _get_stamp(path) == stored['stamp']:
+                continue  # unchanged since it was hashed
+            record = self.__get_source_record(path)
+            if record['hash'] != stored['hash']:
+                return False, False
+            stored['stamp'], is_restamped = record['stamp'], True
+
+        return True, is_restamped
+
+    @staticmethod
+    def __write_header(entry_path: str, header: dict) -> None:
+
+        path = os.path.join(entry_path, _HEADER_FILE_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(path + '.tmp', path)
+
+    def __get_entry_path(self, source_path: str, target_neg_put_deltas_half, interp_kind: str,
+                         future_path: str) -> str:
+
+        key = [os.path.abspath(source_path), sorted(float(d) for d in target_neg_put_deltas_half), interp_kind,
+               None if future_path is None else os.path.abspath(future_path)]
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cache_folder, digest + _EXTENSION)
+
+    def __scan_entries(self) -> list:
+        return [entry for entry in os.scandir(self.cache_folder)
+                if entry.name.endswith(_EXTENSION) and entry.is_dir()]
+
+    @staticmethod
+    def __remove(entry_path: str) -> None:
+        shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def _get_stamp(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _get_folder_size(path: str) -> int:
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+import pandas as pd
+
+from ..common_utils import get_logger
+from ..deribit_data.batch_managers import BatchFileManager
+from ..deribit_data.shared_structures import (DeribitConstants, DeribitFields,
+                                              TickerBatchInfo)
+from .forward_curve import FORWARD_CURVE_CACHE
+from .volatility_surface import VolatilitySurfaceDeribit
+
+_LOGGER = get_logger(__name__)
+
+# constants from deribit data
+_cst = DeribitFields()
+_dcs = DeribitConstants()
+
+# deribit options expire at 08:00 UTC
+_EXPIRY_HOUR_MS = 8 * 60 * 60 * 1000
+
+
+class SurfaceAsOfJoiner:
+    ''' attaches to each trade the prevailing surface: the latest snapshot at or before the trade.
+
+    trades are located in the sorted snapshot timestamps with one searchsorted, then each snapshot
+    answers all of its trades with one vectorised query. surfaces are obtained through a loader so
+    that only snapshots with trades are ever built; the most recent ones are kept. '''
+
+    s_surface_timestamp = 'surface_timestamp'
+    s_expiration_timestamp = 'expiration_timestamp'
+    s_strike = 'strike'
+    s_forward = 'forward'
+    s_atmf_vol = 'atmf_vol'
+    s_surface_vol = 'surface_vol'
+    s_iv_spread = 'iv_spread'
+
+    def __init__(self, timestamps: List[int], surface_loader: Callable, cache_size=32):
+
+        i_s = np.argsort(timestamps)
+        self.timestamps: np.ndarray = np.asarray(timestamps, dtype=np.int64)[i_s]
+        self.positions: np.ndarray = i_s
+        self.surface_loader: Callable = surface_loader
+        self.cache_size = cache_size
+        self.surfaces: OrderedDict = OrderedDict()
+
+    @classmethod
+    def from_surfaces(cls, surfaces: List[VolatilitySurfaceDeribit]) -> 'SurfaceAsOfJoiner':
+        ''' joiner over already built surfaces. '''
+
+        return cls([s.get_as_of_timestamp() for s in surfaces], lambda i: surfaces[i], cache_size=0)
+
+    @classmethod
+    def from_ticker_batches(cls, root_folder: str, currency: str, from_timestamp: int = None,
+                            to_timestamp: int = None, use_futures=True, **build_kwargs) -> 'SurfaceAsOfJoiner':
+        ''' joiner over stored option ticker batches, built lazily. with use_futures, forwards come
+        from the future batch of the same snapshot when there is one. '''
+
+        bfm = BatchFileManager(root_folder)
+        infos = bfm.get_ticker_batch_file_infos(from_timestamp, to_timestamp)
+        opt_infos: List[TickerBatchInfo] = [bi for bi in infos if bi.currency == currency and bi.kind == _cst.option]
+        kw_fut = {bi.batch_timestamp: bi for bi in infos if bi.currency == currency and bi.kind == _cst.future}
+
+        def load(i: int) -> VolatilitySurfaceDeribit:
+            bi = opt_infos[i]
+            forward_curve = None
+            if use_futures and bi.batch_timestamp in kw_fut:
+                forward_curve = FORWARD_CURVE_CACHE.get(currency, bi.batch_timestamp)
+                if forward_curve is None:
+                    fut_data = bfm.read(kw_fut[bi.batch_timestamp].path)[_dcs.data]
+                    forward_curve = FORWARD_CURVE_CACHE.get(currency, bi.batch_timestamp, fut_data)
+            surface = VolatilitySurfaceDeribit(currency, bi.batch_timestamp, bfm.read(bi.path)[_dcs.data],
+                                               forward_curve)
+            surface.build(**build_kwargs)
+            return surface
+
+        return cls([bi.batch_timestamp for bi in opt_infos], load)
+
+    @staticmethod
+    def parse_instrument_names(instrument_names: pd.Series) -> pd.DataFrame:
+        ''' expiration timestamps and strikes from option names, e.g. BTC-29DEC23-30000-C. other
+        instruments (futures, perpetuals) get NaN. '''
+
+        expiration_ts = np.full(len(instrument_names), np.nan)
+        strikes = np.full(len(instrument_names), np.nan)
+
+        parts = instrument_names.str.split('-')
+        option_types = (VolatilitySurfaceDeribit.s_C, VolatilitySurfaceDeribit.s_P)
+        is_option = parts.map(lambda p: len(p) == 4 and p[3] in option_types).to_numpy(bool)
+        if is_option.any():
+            options = pd.DataFrame(parts[is_option].tolist())
+            expiry_dates = pd.to_datetime(options[1], format='%d%b%y', utc=True)
+            expiration_ts[is_option] = \
+                expiry_dates.astype('datetime64[ms, UTC]').astype(np.int64).to_numpy() + _EXPIRY_HOUR_MS
+            # strikes may use 'd' as decimal point, e.g. XRP_USDC-29DEC23-0d5-C
+            strikes[is_option] = options[2].str.replace('d', '.', regex=False).astype(float).to_numpy()
+
+        return pd.DataFrame({SurfaceAsOfJoiner.s_expiration_timestamp: expiration_ts,
+                             SurfaceAsOfJoiner.s_strike: strikes}, index=instrument_names.index)
+
+    def join(self, df_trades: pd.DataFrame) -> pd.DataFrame:
+        ''' trades (e.g. from ConverterToDF.last_trade_info_to_df) with the prevailing surface's forward,
+        atmf vol and vol at the trade's strike and expiry (decimal). trades before the first snapshot,
+        and trades of instruments other than options, get NaN. iv_spread is the trade iv less the
+        surface vol, if the trades have iv. '''
+
+        df = df_trades.reset_index(drop=True)
+
+        # parse each distinct instrument once
+        codes, names = pd.factorize(df[_cst.instrument_name])
+        df_ks = self.parse_instrument_names(pd.Series(names)).iloc[codes].reset_index(drop=True)
+        expiry = df_ks[self.s_expiration_timestamp].to_numpy()
+        strike = df_ks[self.s_strike].to_numpy()
+
+        i_snap = np.searchsorted(self.timestamps, df[_cst.timestamp].to_numpy(np.int64), side='right') - 1
+        # trades of futures and perpetuals have no point on the surface
+        i_snap[np.isnan(expiry)] = -1
+
+        surface_ts = np.full(len(df), -1, dtype=np.int64)
+        fwd, vol_atmf, vol = (np.full(len(df), np.nan) for _ in range(3))
+
+        # one vectorised query per snapshot with trades
+        order = np.argsort(i_snap, kind='stable')
+        snaps, starts = np.unique(i_snap[order], return_index=True)
+        for snap, rows in zip(snaps, np.split(order, starts[1:])):
+            if snap < 0:
+                continue
+            surface = self.__get_surface(snap)
+            ex, k = expiry[rows], strike[rows]
+            surface_ts[rows] = self.timestamps[snap]
+            fwd[rows] = surface.get_forward(ex)
+            vol_atmf[rows] = surface.get_black_volatility(ex, surface.get_strike_at_npdelta(ex, 0.5))
+            vol[rows] = surface.get_black_volatility(ex, k)
+
+        df_joined = pd.concat([df, df_ks], axis=1)
+        df_joined[self.s_surface_timestamp] = np.where(surface_ts >= 0, surface_ts, np.nan)
+        df_joined[self.s_forward] = fwd
+        df_joined[self.s_atmf_vol] = vol_atmf
+        df_joined[self.s_surface_vol] = vol
+        if _cst.iv in df_joined:
+            df_joined[self.s_iv_spread] = df_joined[_cst.iv] / 100.0 - vol  # deribit iv is in percent
+
+        return df_joined
+
+    def __get_surface(self, i_sorted: int) -> VolatilitySurfaceDeribit:
+
+        i = int(self.positions[i_sorted])
+        if i in self.surfaces:
+            self.surfaces.move_to_end(i)
+            return self.surfaces[i]
+
+        surface = self.surface_loader(i)
+        if self.cache_size > 0:
+            self.surfaces[i] = surface
+            if len(self.surfaces) > self.cache_size:
+                self.surfaces.popitem(last=False)
+
+        return surface
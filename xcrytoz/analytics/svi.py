@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from .utils import PaddedSmiles, batched_levenberg_marquardt, get_padded_smiles
+
+# NOTE:
+# raw SVI in total variance: w(k) = a + b * (rho * (k - m) + sqrt((k - m)^2 + sigma^2)),
+# with k = log(strike / forward) and w = vol^2 * tau.
+
+
+def svi_total_variance(lnk, a, b, rho, m, sigma) -> np.ndarray:
+
+    km = np.asarray(lnk, float) - m
+    return a + b * (rho * km + np.sqrt(km * km + sigma * sigma))
+
+
+def svi_total_variance_derivatives(lnk, a, b, rho, m, sigma) -> tuple:
+    ''' w, dw/dk and d2w/dk2, all in closed form. '''
+
+    km = np.asarray(lnk, float) - m
+    root = np.sqrt(km * km + sigma * sigma)
+    w = a + b * (rho * km + root)
+    dw = b * (rho + km / root)
+    d2w = b * sigma * sigma / root**3
+    return w, dw, d2w
+
+
+class SVISurface:
+    ''' raw SVI slices fitted to every live expiry of a built VolatilitySurfaceDeribit.
+
+    all slices are fitted together with a batched Levenberg-Marquardt on total variance. the fit
+    is kept as a (expiry, parameter) array so that dense grids are evaluated in closed form. '''
+
+    s_a = 'a'
+    s_b = 'b'
+    s_rho = 'rho'
+    s_m = 'm'
+    s_sigma = 'sigma'
+    s_rmse = 'rmse'
+    s_expiration_timestamp = 'expiration_timestamp'
+    param_names = [s_a, s_b, s_rho, s_m, s_sigma]
+
+    s_min_g = 'min_g'
+    s_butterfly_ok = 'butterfly_ok'
+    s_min_calendar_spread = 'min_calendar_spread'
+    s_calendar_ok = 'calendar_ok'
+    s_max_wing_slope = 'max_wing_slope'
+    s_wing_ok = 'wing_ok'
+
+    def __init__(self, surface, max_iter=200, tol=1e-12, fd_step=1e-7):
+
+        self.name = surface.name
+        self.as_of_timestamp = surface.get_as_of_timestamp()
+        self.smiles: PaddedSmiles = get_padded_smiles(surface)
+        self.max_iter = max_iter
+        self.tol = tol
+        self.fd_step = fd_step
+
+        # to be defined
+        self.params: np.ndarray
+        self.rmse: np.ndarray
+
+    def fit(self, initial_params: pd.DataFrame = None) -> pd.DataFrame:
+        ''' fits all slices. initial_params (e.g. the previous snapshot's result) warm-starts
+        the expiries it contains. '''
+
+        md = self.smiles
+        lnk = np.log(md.strikes / md.forwards[:, np.newaxis])
+        w_mkt = md.vols**2 * md.taus[:, np.newaxis]
+
+        def residuals(x):
+            w = svi_total_variance(lnk, *(p[:, np.newaxis] for p in self.__from_x(x)))
+            return np.where(md.mask, w - w_mkt, 0.0)
+
+        x, cost = batched_levenberg_marquardt(residuals, self.__get_initial_x(lnk, w_mkt, initial_params),
+                                              self.max_iter, self.tol, self.fd_step)
+
+        self.params = np.column_stack(self.__from_x(x))
+        self.rmse = np.sqrt(cost / np.maximum(md.mask.sum(axis=1), 1))
+
+        return self.get_params()
+
+    def get_params(self) -> pd.DataFrame:
+
+        df_params = pd.DataFrame(self.params, columns=self.param_names,
+                                 index=pd.Index(self.smiles.expirations, name=self.s_expiration_timestamp))
+        df_params[self.s_rmse] = self.rmse
+        return df_params
+
+    def get_total_variance(self, lnk: np.ndarray) -> np.ndarray:
+        ''' total variance of every slice at log(strike / forward), shape (expiry, len(lnk)). '''
+
+        return svi_total_variance(np.asarray(lnk, float)[np.newaxis, :], *(p[:, np.newaxis] for p in self.params.T))
+
+    def get_black_volatility(self, lnk: np.ndarray) -> np.ndarray:
+        ''' black volatility (decimal) of every slice at log(strike / forward), shape (expiry, len(lnk)). '''
+
+        w = self.get_total_variance(lnk)
+        return np.sqrt(np.maximum(w, 0.0) / self.smiles.taus[:, np.newaxis])
+
+    def get_arbitrage_diagnostics(self, lnk: np.ndarray = np.linspace(-2.0, 2.0, 401)) -> pd.DataFrame:
+        ''' static arbitrage checks of the fitted slices on a log-moneyness grid.
+
+        butterfly: Gatheral's density function g(k) must be non-negative.
+        calendar: total variance must not decrease with expiry at any k.
+        wings: Lee's moment bound requires b * (1 + |rho|) <= 2. '''
+
+        lnk = np.asarray(lnk, float)[np.newaxis, :]
+        w, dw, d2w = svi_total_variance_derivatives(lnk, *(p[:, np.newaxis] for p in self.params.T))
+        w_safe = np.where(w > 0, w, np.nan)
+
+        g = (1.0 - 0.5 * lnk * dw / w_safe)**2 - 0.25 * dw * dw * (1.0 / w_safe + 0.25) + 0.5 * d2w
+        # non-positive variance is an arbitrage in itself
+        min_g = np.where(np.all(w > 0, axis=1), np.nanmin(g, axis=1), -np.inf)
+
+        # first slice has nothing before it
+        calendar = np.full(w.shape[0], np.inf)
+        if w.shape[0] > 1:
+            calendar[1:] = np.min(w[1:] - w[:-1], axis=1)
+
+        b, rho = self.params[:, 1], self.params[:, 2]
+        wing = b * (1.0 + np.abs(rho))
+
+        return pd.DataFrame(index=pd.Index(self.smiles.expirations, name=self.s_expiration_timestamp), data={
+            self.s_min_g: min_g,
+            self.s_butterfly_ok: min_g >= 0,
+            self.s_min_calendar_spread: calendar,
+            self.s_calendar_ok: calendar >= 0,
+            self.s_max_wing_slope: wing,
+            self.s_wing_ok: wing <= 2.0})
+
+    # parameters are transformed so that the optimisation is unconstrained:
+    # a, m free, b = exp(x1), rho = tanh(x2), sigma = exp(x4)
+    @staticmethod
+    def __from_x(x: np.ndarray) -> tuple:
+        return x[:, 0], np.exp(x[:, 1]), 0.999 * np.tanh(x[:, 2]), x[:, 3], np.exp(x[:, 4])
+
+    def __get_initial_x(self, lnk: np.ndarray, w_mkt: np.ndarray, initial_params: pd.DataFrame) -> np.ndarray:
+
+        # cold start: symmetric smile around the money, level set by the atm total variance
+        md = self.smiles
+        i_atm = np.argmin(np.where(md.mask, np.abs(lnk), np.inf), axis=1)
+        w_atm = np.maximum(w_mkt[np.arange(w_mkt.shape[0]), i_atm], 1e-6)
+        b = np.full(w_atm.shape, 0.1)
+        sigma = np.full(w_atm.shape, 0.1)
+        a = w_atm - b * sigma
+        rho = np.zeros_like(a)
+        m = np.zeros_like(a)
+
+        if initial_params is not None:
+            df_init = initial_params.reindex(md.expirations)
+            found = df_init[self.s_a].notna().to_numpy()
+            a, b, rho, m, sigma = (np.where(found, df_init[p].to_numpy(float), v)
+                                   for p, v in zip(self.param_names, (a, b, rho, m, sigma)))
+
+        return np.column_stack([a, np.log(b), np.arctanh(np.clip(rho / 0.999, -0.999, 0.999)), m, np.log(sigma)])
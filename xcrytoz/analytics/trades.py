@@ -0,0 +1,251 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+
+from ..common_utils import get_logger
+from ..deribit_data.batch_managers import BatchFileManager
+from ..deribit_data.shared_structures import (DeribitConstants, DeribitFields,
+                                              LastTradeBatchInfo)
+
+_LOGGER = get_logger(__name__)
+
+# constants from deribit data
+_cst = DeribitFields()
+_dcs = DeribitConstants()
+
+_MS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+class TradeAnalytics:
+    ''' analytics over stored last trade batches.
+
+    batches are processed one day at a time, so memory is bounded by a day of trades, and days can
+    be spread over worker processes. each day gives partial results (bars, aggregates) that are
+    additive, so they are merged exactly whatever the partition. '''
+
+    s_bar_timestamp = 'bar_timestamp'
+    s_bar_no = 'bar_no'
+    s_open = 'open'
+    s_high = 'high'
+    s_low = 'low'
+    s_close = 'close'
+    s_volume = 'volume'
+    s_notional = 'notional'  # sum of price * amount
+    s_vwap = 'vwap'
+    s_n_trades = 'n_trades'
+    s_first_timestamp = 'first_timestamp'
+    s_last_timestamp = 'last_timestamp'
+    s_buy_volume = 'buy_volume'
+    s_sell_volume = 'sell_volume'
+    s_net_volume = 'net_volume'
+    s_realized_volatility = 'realized_volatility'
+
+    ms_per_year = 365.0 * _MS_PER_DAY
+
+    def __init__(self, root_folder: str, n_workers: int = 1):
+
+        self.root_folder = root_folder
+        self.n_workers = n_workers
+        self.bfm = BatchFileManager(root_folder)
+
+    def iter_trades(self, currency: str, kind: str, from_timestamp: int, to_timestamp: int) -> Iterator[pd.DataFrame]:
+        ''' trades in [from_timestamp, to_timestamp], one day per frame. '''
+
+        for infos in self.__get_daily_infos(currency, kind, from_timestamp, to_timestamp):
+            yield _read_trades(self.root_folder, infos, from_timestamp, to_timestamp)
+
+    def get_time_bars(self, currency: str, kind: str, from_timestamp: int, to_timestamp: int,
+                      bar_ms: int = 60 * 1000) -> pd.DataFrame:
+        ''' ohlc, volume, notional, vwap and trade counts per (instrument_name, bar_timestamp). '''
+
+        parts = self.__map_days(_get_time_bars, currency, kind, from_timestamp, to_timestamp, bar_ms)
+        return self.__merge_bars(parts, [_cst.instrument_name, self.s_bar_timestamp])
+
+    def get_volume_bars(self, currency: str, kind: str, from_timestamp: int, to_timestamp: int,
+                        bar_volume: float) -> pd.DataFrame:
+        ''' bars closing every bar_volume of traded amount per instrument, indexed by
+        (instrument_name, bar_no) with the bar's first and last trade timestamps. bars are counted
+        from from_timestamp; the cumulative volume is carried from day to day, so this one streams
+        the days in order in this process. '''
+
+        carry = pd.Series(dtype=float)
+        parts = []
+        for df in self.iter_trades(currency, kind, from_timestamp, to_timestamp):
+
+            if df.empty:
+                continue
+
+            amount = df[_cst.amount].to_numpy(float)
+            cum = df.groupby(_cst.instrument_name, sort=False)[_cst.amount].cumsum().to_numpy() \
+                + carry.reindex(df[_cst.instrument_name]).fillna(0.0).to_numpy()
+            carry = carry.add(df.groupby(_cst.instrument_name)[_cst.amount].sum(), fill_value=0.0)
+
+            # a trade belongs to the bar in which it starts
+            df = _get_trades_compact(df).assign(**{
+                self.s_bar_no: ((cum - amount) // bar_volume).astype(np.int64),
+                self.s_notional: df[_cst.price] * df[_cst.amount]})
+
+            parts.append(df.groupby([_cst.instrument_name, self.s_bar_no], sort=True).agg(**{
+                self.s_first_timestamp: (_cst.timestamp, 'first'),
+                self.s_last_timestamp: (_cst.timestamp, 'last'),
+                self.s_open: (_cst.price, 'first'),
+                self.s_high: (_cst.price, 'max'),
+                self.s_low: (_cst.price, 'min'),
+                self.s_close: (_cst.price, 'last'),
+                self.s_volume: (_cst.amount, 'sum'),
+                self.s_notional: (self.s_notional, 'sum'),
+                self.s_n_trades: (_cst.price, 'size')}))
+
+        df_bars = self.__merge_bars(parts, [_cst.instrument_name, self.s_bar_no])
+        if not df_bars.empty:
+            df_bars[self.s_vwap] = df_bars[self.s_notional] / df_bars[self.s_volume]
+
+        return df_bars
+
+    def get_instrument_aggregates(self, currency: str, kind: str, from_timestamp: int, to_timestamp: int)\
+            -> pd.DataFrame:
+        ''' per instrument trade counts, volumes (total, buy, sell and net = buy - sell), notional and vwap. '''
+
+        parts = self.__map_days(_get_instrument_aggregates, currency, kind, from_timestamp, to_timestamp)
+        if len(parts) == 0:
+            return pd.DataFrame()
+
+        df = pd.concat(parts).groupby(level=0).agg({
+            self.s_n_trades: 'sum', self.s_volume: 'sum', self.s_buy_volume: 'sum', self.s_sell_volume: 'sum',
+            self.s_notional: 'sum', self.s_first_timestamp: 'min', self.s_last_timestamp: 'max'})
+        df[self.s_net_volume] = df[self.s_buy_volume] - df[self.s_sell_volume]
+        df[self.s_vwap] = df[self.s_notional] / df[self.s_volume]
+
+        return df
+
+    @staticmethod
+    def get_realized_volatility(df_time_bars: pd.DataFrame, bar_ms: int, window: int) -> pd.DataFrame:
+        ''' annualised rolling realised volatility of close-to-close log returns, per instrument.
+
+        returns are taken between consecutive bars with trades; empty bars are not filled. '''
+
+        close = df_time_bars[TradeAnalytics.s_close]
+        log_ret = np.log(close).groupby(level=0).diff()
+        rv = log_ret.groupby(level=0).rolling(window, min_periods=window).std().droplevel(0)
+
+        return pd.DataFrame({TradeAnalytics.s_realized_volatility: rv * np.sqrt(TradeAnalytics.ms_per_year / bar_ms)})
+
+    def __get_daily_infos(self, currency, kind, from_timestamp, to_timestamp) -> List[List[LastTradeBatchInfo]]:
+
+        infos = [bi for bi in self.bfm.get_last_trade_batch_file_infos(from_timestamp, to_timestamp)
+                 if bi.currency == currency and bi.kind == kind]
+
+        # group by the day of the window end
+        kw_day = {}
+        for bi in infos:
+            kw_day.setdefault(bi.end_timestamp // _MS_PER_DAY, []).append(bi)
+
+        return [kw_day[d] for d in sorted(kw_day)]
+
+    def __map_days(self, fn, currency, kind, from_timestamp, to_timestamp, *args) -> List[pd.DataFrame]:
+
+        daily_infos = self.__get_daily_infos(currency, kind, from_timestamp, to_timestamp)
+        _LOGGER.info(currency + '/' + kind + ': ' + str(len(daily_infos)) + ' days of trade batches')
+
+        if self.n_workers <= 1 or len(daily_infos) <= 1:
+            parts = [_read_and_apply(fn, self.root_folder, infos, from_timestamp, to_timestamp, *args)
+                     for infos in daily_infos]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(_read_and_apply, fn, self.root_folder, infos,
+                                           from_timestamp, to_timestamp, *args) for infos in daily_infos]
+                parts = [fut.result() for fut in futures]
+
+        return [p for p in parts if not p.empty]
+
+    def __merge_bars(self, parts: List[pd.DataFrame], keys: list) -> pd.DataFrame:
+
+        if len(parts) == 0:
+            return pd.DataFrame()
+        if len(parts) == 1:
+            return parts[0]
+
+        # bars straddling two partitions appear twice: re-aggregate them
+        df_bars = pd.concat(parts)
+        kw_agg = {self.s_first_timestamp: 'min', self.s_last_timestamp: 'max',
+                  self.s_open: 'first', self.s_high: 'max', self.s_low: 'min', self.s_close: 'last',
+                  self.s_volume: 'sum', self.s_notional: 'sum', self.s_n_trades: 'sum'}
+        df_bars = df_bars.groupby(level=keys, sort=True).agg({c: f for c, f in kw_agg.items() if c in df_bars})
+        df_bars[self.s_vwap] = df_bars[self.s_notional] / df_bars[self.s_volume]
+
+        return df_bars
+
+
+# module level functions below run in worker processes.
+
+def _read_trades(root_folder: str, infos: List[LastTradeBatchInfo], from_timestamp: int, to_timestamp: int)\
+        -> pd.DataFrame:
+
+    bfm = BatchFileManager(root_folder)
+    frames = [pd.DataFrame(resp[_cst.result][_cst.trades])
+              for bi in infos for resp in bfm.read(bi.path)[_dcs.data]]
+    frames = [df for df in frames if not df.empty]
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df[(df[_cst.timestamp] >= from_timestamp) & (df[_cst.timestamp] <= to_timestamp)]
+    # windows may overlap (e.g. backfills)
+    df = df.drop_duplicates(_cst.trade_id)
+    df = df.sort_values([_cst.timestamp, _cst.trade_seq], kind='stable', ignore_index=True)
+
+    return df
+
+
+def _read_and_apply(fn, root_folder, infos, from_timestamp, to_timestamp, *args) -> pd.DataFrame:
+
+    df = _read_trades(root_folder, infos, from_timestamp, to_timestamp)
+    if df.empty:
+        return df
+    return fn(df, *args)
+
+
+def _get_trades_compact(df: pd.DataFrame) -> pd.DataFrame:
+    return df[[_cst.timestamp, _cst.instrument_name, _cst.price, _cst.amount]]
+
+
+def _get_time_bars(df: pd.DataFrame, bar_ms: int) -> pd.DataFrame:
+
+    ta = TradeAnalytics
+    df = _get_trades_compact(df).assign(**{
+        ta.s_bar_timestamp: df[_cst.timestamp] // bar_ms * bar_ms,
+        ta.s_notional: df[_cst.price] * df[_cst.amount]})
+
+    df_bars = df.groupby([_cst.instrument_name, ta.s_bar_timestamp], sort=True).agg(**{
+        ta.s_open: (_cst.price, 'first'),
+        ta.s_high: (_cst.price, 'max'),
+        ta.s_low: (_cst.price, 'min'),
+        ta.s_close: (_cst.price, 'last'),
+        ta.s_volume: (_cst.amount, 'sum'),
+        ta.s_notional: (ta.s_notional, 'sum'),
+        ta.s_n_trades: (_cst.price, 'size')})
+    df_bars[ta.s_vwap] = df_bars[ta.s_notional] / df_bars[ta.s_volume]
+
+    return df_bars
+
+
+def _get_instrument_aggregates(df: pd.DataFrame) -> pd.DataFrame:
+
+    ta = TradeAnalytics
+    is_buy = (df[_cst.direction] == _cst.buy).to_numpy()
+    amount = df[_cst.amount].to_numpy(float)
+    df = df.assign(**{
+        ta.s_notional: df[_cst.price] * df[_cst.amount],
+        ta.s_buy_volume: np.where(is_buy, amount, 0.0),
+        ta.s_sell_volume: np.where(is_buy, 0.0, amount)})
+
+    return df.groupby(_cst.instrument_name).agg(**{
+        ta.s_n_trades: (_cst.price, 'size'),
+        ta.s_volume: (_cst.amount, 'sum'),
+        ta.s_buy_volume: (ta.s_buy_volume, 'sum'),
+        ta.s_sell_volume: (ta.s_sell_volume, 'sum'),
+        ta.s_notional: (ta.s_notional, 'sum'),
+        ta.s_first_timestamp: (_cst.timestamp, 'min'),
+        ta.s_last_timestamp: (_cst.timestamp, 'max')})
@@ -1,8 +1,14 @@
+from collections import namedtuple
+from typing import Callable
+
 import numpy as np
-from scipy import interpolate
 
 
 def linear_interp_flat_extrap(x: np.ndarray, y: np.ndarray, extrapolate=True):
+    ''' scipy interp1d with flat extrapolation. kept for callers outside the package; the surface
+    uses Interpolator1D. '''
+
+    from scipy import interpolate
 
     i_s = np.argsort(x)
     x_s, y_s = x[i_s], y[i_s]
@@ -11,3 +17,190 @@ def linear_interp_flat_extrap(x: np.ndarray, y: np.ndarray, extrapolate=True):
 
     return interpolate.interp1d(x_s, y_s, bounds_error=False,
                                 fill_value=fill_value, assume_sorted=True)
+
+
+class Interpolator1D:
+    ''' interpolates one or many y-columns on a shared x-grid, numpy only.
+
+    x is sorted once at construction (and pchip slopes are computed once), and each call locates the
+    new points once for all columns. y is (n,) or (n, n_columns); the result has the same trailing shape. '''
+
+    s_linear = 'linear'
+    s_pchip = 'pchip'
+    s_flat = 'flat'
+    s_nan = 'nan'
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, kind=s_linear, extrapolation=s_flat):
+
+        if kind not in (self.s_linear, self.s_pchip):
+            raise ValueError('unknown interpolation kind: ' + str(kind))
+        if extrapolation not in (self.s_flat, self.s_nan):
+            raise ValueError('unknown extrapolation: ' + str(extrapolation))
+
+        x, y = np.asarray(x, float), np.asarray(y, float)
+        i_s = np.argsort(x, kind='stable')
+        self.x: np.ndarray = x[i_s]
+        self.y: np.ndarray = y[i_s].reshape(x.size, -1)
+        self.is_1d: bool = y.ndim == 1
+        self.kind: str = kind
+        self.extrapolation: str = extrapolation
+
+        self.dx: np.ndarray = np.diff(self.x)
+        self.slopes: np.ndarray = np.divide(np.diff(self.y, axis=0), self.dx[:, np.newaxis],
+                                            out=np.zeros((self.x.size - 1, self.y.shape[1])),
+                                            where=self.dx[:, np.newaxis] > 0)
+        # derivatives at the knots, only for pchip
+        self.d: np.ndarray = self.__get_pchip_derivatives() if kind == self.s_pchip else None
+
+    def __call__(self, x_new: np.ndarray, column: int = None) -> np.ndarray:
+
+        x_new = np.asarray(x_new, float)
+        shape = x_new.shape
+
+        # single linear column: np.interp is the fastest path
+        if self.kind == self.s_linear and (self.is_1d or column is not None) and self.x.size > 1:
+            fill = np.nan if self.extrapolation == self.s_nan else None
+            return np.interp(x_new, self.x, self.y[:, column or 0], left=fill, right=fill)
+
+        xq = np.clip(x_new.ravel(), self.x[0], self.x[-1])
+
+        y = self.y if column is None else self.y[:, [column]]
+        slopes = self.slopes if column is None else self.slopes[:, [column]]
+
+        if self.x.size == 1:
+            out = np.repeat(y, xq.size, axis=0)
+        else:
+            i = np.clip(np.searchsorted(self.x, xq, side='right') - 1, 0, self.x.size - 2)
+            h = (xq - self.x[i])[:, np.newaxis]
+            if self.kind == self.s_linear:
+                out = y[i] + h * slopes[i]
+            else:
+                d = self.d if column is None else self.d[:, [column]]
+                out = self.__hermite(h, self.dx[i][:, np.newaxis], y[i], y[i + 1], d[i], d[i + 1])
+
+        if self.extrapolation == self.s_nan:
+            outside = (x_new.ravel() < self.x[0]) | (x_new.ravel() > self.x[-1])
+            out[outside] = np.nan
+
+        if self.is_1d or column is not None:
+            return out[:, 0].reshape(shape)
+        return out.reshape(shape + (out.shape[1],))
+
+    @staticmethod
+    def __hermite(h, dx, y0, y1, d0, d1) -> np.ndarray:
+
+        dx = np.where(dx > 0, dx, 1.0)
+        t = h / dx
+        t2, t3 = t * t, t * t * t
+        return (2 * t3 - 3 * t2 + 1) * y0 + (t3 - 2 * t2 + t) * dx * d0 \
+            + (-2 * t3 + 3 * t2) * y1 + (t3 - t2) * dx * d1
+
+    def __get_pchip_derivatives(self) -> np.ndarray:
+
+        # Fritsch-Carlson, as scipy.interpolate.PchipInterpolator
+        h, m = self.dx[:, np.newaxis], self.slopes
+        n = self.x.size
+        d = np.zeros_like(self.y)
+        if n < 2:
+            return d
+        if n == 2:
+            d[:] = m[0]
+            return d
+
+        # interior: weighted harmonic mean where the secants agree in sign, flat otherwise
+        w1 = 2 * h[1:] + h[:-1]
+        w2 = h[1:] + 2 * h[:-1]
+        same_sign = (m[:-1] * m[1:]) > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d_int = (w1 + w2) / (w1 / m[:-1] + w2 / m[1:])
+        d[1:-1] = np.where(same_sign, d_int, 0.0)
+
+        # ends: non-centred three point formula, kept shape preserving
+        d[0] = self.__edge(h[0], h[1], m[0], m[1])
+        d[-1] = self.__edge(h[-1], h[-2], m[-1], m[-2])
+        return d
+
+    @staticmethod
+    def __edge(h0, h1, m0, m1) -> np.ndarray:
+
+        # h0 + h1 is 0 when the first (or last) three knots coincide: flat there
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+        d = np.where(h0 + h1 > 0, d, 0.0)
+        d = np.where(np.sign(d) != np.sign(m0), 0.0, d)
+        return np.where((np.sign(m0) != np.sign(m1)) & (np.abs(d) > np.abs(3 * m0)), 3 * m0, d)
+
+
+# padded smiles of all expiries of a surface. 2d arrays are (expiry, point) with mask for valid points.
+PaddedSmiles = namedtuple('PaddedSmiles', ['expirations', 'taus', 'forwards', 'strikes', 'vols', 'mask'])
+
+
+def get_padded_smiles(surface) -> PaddedSmiles:
+    ''' stacks the cached per expiry grids of a built VolatilitySurfaceDeribit, skipping expired slices. '''
+
+    i_live = [i for i, tau in enumerate(surface.grid_taus) if tau > 0]
+    grids = [surface.grids[i] for i in i_live]
+    fwds = np.exp(surface.grid_log_fwds[i_live])
+
+    n_max = max([g.lnk.size for g in grids], default=0)
+    strikes = np.ones((len(grids), n_max))
+    vols = np.zeros((len(grids), n_max))
+    mask = np.zeros((len(grids), n_max), dtype=bool)
+    for i, g in enumerate(grids):
+        n = g.lnk.size
+        strikes[i, :n] = fwds[i] * np.exp(g.lnk)
+        vols[i, :n] = g.vol_lnk
+        mask[i, :n] = np.isfinite(g.vol_lnk)
+    # padded points sit at the forward so that model formulas stay finite there
+    strikes = np.where(mask, strikes, fwds[:, np.newaxis])
+    vols = np.where(mask, vols, 0.0)
+
+    return PaddedSmiles(surface.grid_expirations[i_live], surface.grid_taus[i_live], fwds, strikes, vols, mask)
+
+
+def batched_levenberg_marquardt(residuals: Callable, x0: np.ndarray, max_iter=100, tol=1e-10, fd_step=1e-7) -> tuple:
+    ''' independent least squares problems solved together.
+
+    x0 is (problem, parameter) and residuals(x) returns (problem, point), zero for padded points.
+    jacobians are forward differences and the normal equations are solved as a stack. returns the
+    parameters and the sum of squared residuals of each problem. '''
+
+    x = np.array(x0, dtype=float)
+    n_prob, n_par = x.shape
+    eye = np.eye(n_par)
+
+    r = residuals(x)
+    cost = np.sum(r * r, axis=1)
+    lam = np.full(n_prob, 1e-3)
+    active = np.ones(n_prob, dtype=bool)
+
+    for _ in range(max_iter):
+
+        if not active.any():
+            break
+
+        jac = np.empty(r.shape + (n_par,))
+        for j in range(n_par):
+            x_j = x.copy()
+            x_j[:, j] += fd_step
+            jac[:, :, j] = (residuals(x_j) - r) / fd_step
+
+        jtj = np.einsum('emi,emj->eij', jac, jac)
+        jtr = np.einsum('emi,em->ei', jac, r)
+        damped = jtj + lam[:, np.newaxis, np.newaxis] * (eye * jtj + 1e-12 * eye)
+        step = -np.linalg.solve(damped, jtr[:, :, np.newaxis])[:, :, 0]
+
+        x_new = np.where(active[:, np.newaxis], x + step, x)
+        r_new = residuals(x_new)
+        cost_new = np.sum(r_new * r_new, axis=1)
+
+        improved = active & (cost_new < cost)
+        converged = improved & (cost - cost_new <= tol * np.maximum(cost, 1e-16))
+
+        x = np.where(improved[:, np.newaxis], x_new, x)
+        r = np.where(improved[:, np.newaxis], r_new, r)
+        cost = np.where(improved, cost_new, cost)
+        lam = np.where(improved, lam / 3.0, lam * 2.0)
+        active &= ~converged & (lam < 1e10)
+
+    return x, cost
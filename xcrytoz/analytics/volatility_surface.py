@@ -1,13 +1,16 @@
 from abc import ABC, abstractclassmethod
+from collections import namedtuple
+from functools import partial
 from typing import Callable, Union
 
 import numpy as np
 import pandas as pd
 
-from xcrytoz.deribit_data import ConverterToDF
-
 from ..deribit_data.shared_structures import DeribitFields
-from .utils import linear_interp_flat_extrap
+from ..deribit_data.snapshot import OptionSnapshot
+from ..tracing import traced
+from .forward_curve import ForwardCurve
+from .utils import Interpolator1D
 
 # from ..common_utils import get_logger, Converter
 # from .downloader import DeribitDownloader_Simple
@@ -15,6 +18,14 @@ from .utils import linear_interp_flat_extrap
 # NOTE:
 # all time stamps integers, measured in milliseconds.
 
+# per expiry interpolation grids, cached at build time.
+# npd: sorted neg put deltas, with strikes and vols at npd
+# lnk: sorted log(strike/forward), with vols and neg put deltas at lnk
+# interp_npd: interpolator on npd of columns (strike, vol)
+# interp_lnk: interpolator on lnk of columns (vol, npd)
+ExpiryGrid = namedtuple('ExpiryGrid', ['npd', 'strike_npd', 'vol_npd', 'lnk', 'vol_lnk', 'npd_lnk',
+                                       'interp_npd', 'interp_lnk'])
+
 
 class VolatilitySurface(ABC):
 
@@ -36,6 +47,8 @@ class VolatilitySurface(ABC):
     s_extrapolated_pac = 'extrapolated_pac'
     s_extrapolated_arf = 'extrapolated_arf'
 
+    ms_per_year = 365.0 * 24.0 * 60.0 * 60.0 * 1000.0
+
     @staticmethod
     def f2str100(x):
         return str(round(x*100))
@@ -49,6 +62,9 @@ class VolatilitySurface(ABC):
     def get_as_of_timestamp(self) -> int:
         return self.as_of_timestamp
 
+    def get_year_fraction(self, expiration_timestamp: Union[int, np.ndarray]) -> np.ndarray:
+        return (np.asarray(expiration_timestamp, dtype=float) - self.as_of_timestamp) / self.ms_per_year
+
     # @abstractclassmethod
     def get_black_volatility(self, expiration_timestamp: int, strike: np.ndarray) -> np.ndarray:
         pass
@@ -90,19 +106,19 @@ _cst = DeribitFields()
 
 class VolatilitySurfaceDeribit(VolatilitySurface):
 
-    def __init__(self, name: str, timestamp: int, deribit_option_data: dict):
+    # bump whenever build results change. persisted surfaces of another version are rebuilt.
+    builder_version = 1
 
-        super().__init__(name, timestamp)
+    def __init__(self, name: str, timestamp: int, deribit_option_data: dict, forward_curve: ForwardCurve = None):
 
-        df_md = ConverterToDF.tick_info_to_df(deribit_option_data)
+        super().__init__(name, timestamp)
 
-        # option data, organise this put expiration and option type
-        self.kkw_md = {ex: {ot: df_ot for ot, df_ot in df_ex.groupby(_cst.option_type)}
-                       for ex, df_ex in df_md.groupby(_cst.expiration_timestamp)}
+        # forwards from the futures curve if given, otherwise from the options' underlying prices
+        self.forward_curve: ForwardCurve = forward_curve
 
-        self.missing_instruments: list = []
-        if 'missing' in deribit_option_data:
-            self.missing_instruments: list = deribit_option_data['missing']
+        # option data, sorted by expiration and option type so that each is a slice
+        self.snapshot: OptionSnapshot = OptionSnapshot.from_deribit(deribit_option_data)
+        self.missing_instruments: list = self.snapshot.missing
 
         # to be defined
         self.ds_fwd: pd.Series
@@ -111,54 +127,270 @@ class VolatilitySurfaceDeribit(VolatilitySurface):
         self.df_md_pac: pd.DataFrame
         self.df_md_arf: pd.DataFrame
         self.df_md_combined: pd.DataFrame
+        self.kw_grid: dict
+        self.grid_expirations: np.ndarray
+        self.grid_taus: np.ndarray
+        self.grid_log_fwds: np.ndarray
+        self.grids: list
 
-    def build(self, target_neg_put_deltas_half=[0.1, 0.25], *args, **kwargs):
-
-        # set forwards: keep the forward price by taking average for each expiry
-        kw_fwd = {}
-        for ex, kw_md in self.kkw_md.items():
-            kw_fwd[ex] = np.mean(np.hstack([df[_cst.underlying_price].to_numpy() for df in kw_md.values()]))
-        self.ds_fwd: pd.Series = pd.Series(kw_fwd)
-        self.ds_fwd.index.name = self.s_expiration_timestamp
+    @traced()
+    def build(self, target_neg_put_deltas_half=[0.1, 0.25], interp_kind=Interpolator1D.s_linear, *args, **kwargs):
 
         # target neg put deltas
         self.target_npdeltas = self.extend_to_full_negputdeltas(target_neg_put_deltas_half)
 
-        # As a starter, use linear interp & flat extrapolator.
-        self.interp_extrap = linear_interp_flat_extrap
+        # linear (default) or pchip interp, flat extrapolation
+        self.interp_extrap = partial(Interpolator1D, kind=interp_kind, extrapolation=Interpolator1D.s_flat)
 
         # run each expiry and collect them
-        kw_md_pac_ex = {ex_ts: self.__get_md_at_npdeltas(ex_ts) for ex_ts in self.kkw_md}
+        expirations = list(self.snapshot.expirations)
+        self.ds_fwd, self.df_md_pac, self.df_md_arf, self.df_md_combined = self.__build_expiries(expirations)
 
-        # index: expiration_timestamp, columns: (fields, label) where fields = (strike, volatility, extrapolated)
-        self.df_md_pac = pd.concat(kw_md_pac_ex).unstack()
-        self.df_md_pac.index.name = self.s_expiration_timestamp
+        # interpolation grids for surface queries
+        self.kw_grid = {ex: self.__get_expiry_grid(ex) for ex in expirations}
+        self.__stack_grids()
 
-        # set md by atmf, rr, fly
-        self.df_md_arf = self.__get_md_atmf_rr_fly()
-        self.df_md_arf.index.name = self.s_expiration_timestamp
+    def update(self, timestamp: int, deribit_option_data: dict,
+               vol_tol=1e-6, delta_tol=1e-6, fwd_rel_tol=1e-8, forward_curve: ForwardCurve = None) -> list:
+        ''' moves the surface to a new snapshot, recomputing only the expiries that moved.
+
+        an expiry is recomputed if its instruments changed, or if any mark_iv / delta / underlying_price
+        moved beyond the given tolerances. the built frames are patched in place, and the list of
+        recomputed expiration timestamps is returned. pass the new snapshot's forward_curve if the
+        surface was built on one; a moved curve recomputes every expiry, and so does a missing one, with
+        forwards from the underlying prices from then on. '''
+
+        if not np.issubdtype(type(timestamp), np.integer):
+            raise TypeError('timestamp ' + str(timestamp) + ' is not an integer.')
+        if not hasattr(self, 'df_md_combined'):
+            raise Exception('surface is not built yet. call build first.')
+
+        snapshot_new = OptionSnapshot.from_deribit(deribit_option_data)
+        expirations_new = list(snapshot_new.expirations)
+
+        removed = [ex for ex in self.snapshot.expirations if ex not in snapshot_new.kw_expiry]
+        changed = [ex for ex in expirations_new
+                   if (ex not in self.snapshot.kw_expiry) or
+                   self.__has_expiry_moved(self.snapshot, snapshot_new, ex, vol_tol, delta_tol, fwd_rel_tol)]
+
+        if forward_curve is not None:
+            if (self.forward_curve is None) or np.any(np.abs(
+                    forward_curve.get_forward(expirations_new) / self.forward_curve.get_forward(expirations_new)
+                    - 1.0) > fwd_rel_tol):
+                changed = expirations_new
+            self.forward_curve = forward_curve
+        elif self.forward_curve is not None:
+            # no curve for the new snapshot: back to the options' underlying prices, for every expiry
+            self.forward_curve = None
+            changed = expirations_new
+
+        self.as_of_timestamp = timestamp
+        self.snapshot = snapshot_new
+        self.missing_instruments = snapshot_new.missing
+
+        if removed or changed:
+            ds_fwd, df_md_pac, df_md_arf, df_md_combined = self.__build_expiries(changed)
+            self.ds_fwd = self.__patch_rows(self.ds_fwd, ds_fwd, removed)
+            self.df_md_pac = self.__patch_rows(self.df_md_pac, df_md_pac, removed)
+            self.df_md_arf = self.__patch_rows(self.df_md_arf, df_md_arf, removed)
+            self.df_md_combined = self.__patch_rows(self.df_md_combined, df_md_combined, removed)
 
-        df_fwd = pd.DataFrame(self.ds_fwd, columns=pd.MultiIndex.from_arrays([[self.s_forward], [self.s_forward]]))
-        self.df_md_combined = pd.concat([df_fwd, self.df_md_pac, self.df_md_arf], axis=1)
+            for ex in removed:
+                del self.kw_grid[ex]
+            self.kw_grid.update({ex: self.__get_expiry_grid(ex) for ex in changed})
+
+        # year fractions move with the as-of timestamp
+        self.__stack_grids()
+
+        return changed
+
+    def get_black_volatility(self, expiration_timestamp: Union[int, np.ndarray],
+                             strike: np.ndarray) -> np.ndarray:
+        ''' black volatility (decimal) at strikes, interpolated in total variance at fixed
+        log(strike/forward) between listed expiries. flat outside listed expiries and strikes. '''
+
+        tau, strike = np.broadcast_arrays(self.get_year_fraction(expiration_timestamp), np.asarray(strike, float))
+        i_lo, i_hi, a = self.__get_time_weights(tau)
+        lnk = np.log(strike) - self.__get_log_forward(i_lo, i_hi, a)
+
+        vol_lo = self.__eval_grids(i_lo, lnk, 'interp_lnk', 0)
+        vol_hi = self.__eval_grids(i_hi, lnk, 'interp_lnk', 0)
+
+        return self.__interp_total_variance(i_lo, i_hi, a, vol_lo, vol_hi)
+
+    def get_strike_at_npdelta(self, expiration_timestamp: Union[int, np.ndarray],
+                              neg_put_delta: np.ndarray) -> np.ndarray:
+        ''' strikes at neg put deltas, interpolating log(strike/forward) in time at fixed delta. '''
+
+        tau, npd = np.broadcast_arrays(self.get_year_fraction(expiration_timestamp),
+                                       np.asarray(neg_put_delta, float))
+        i_lo, i_hi, a = self.__get_time_weights(tau)
+
+        lnk_lo = np.log(self.__eval_grids(i_lo, npd, 'interp_npd', 0)) - self.grid_log_fwds[i_lo]
+        lnk_hi = np.log(self.__eval_grids(i_hi, npd, 'interp_npd', 0)) - self.grid_log_fwds[i_hi]
+
+        return np.exp(self.__get_log_forward(i_lo, i_hi, a) + (1.0 - a) * lnk_lo + a * lnk_hi)
+
+    def get_npdelta_at_strike(self, expiration_timestamp: Union[int, np.ndarray],
+                              strike: np.ndarray) -> np.ndarray:
+        ''' neg put deltas at strikes, interpolating delta in time at fixed log(strike/forward). '''
+
+        tau, strike = np.broadcast_arrays(self.get_year_fraction(expiration_timestamp), np.asarray(strike, float))
+        i_lo, i_hi, a = self.__get_time_weights(tau)
+        lnk = np.log(strike) - self.__get_log_forward(i_lo, i_hi, a)
+
+        npd_lo = self.__eval_grids(i_lo, lnk, 'interp_lnk', 1)
+        npd_hi = self.__eval_grids(i_hi, lnk, 'interp_lnk', 1)
+
+        return (1.0 - a) * npd_lo + a * npd_hi
+
+    def get_forward(self, expiration_timestamp: Union[int, np.ndarray]) -> np.ndarray:
+        ''' forward at any expiry, log-linear in time between listed expiries and flat outside. '''
+
+        i_lo, i_hi, a = self.__get_time_weights(self.get_year_fraction(expiration_timestamp))
+        return np.exp(self.__get_log_forward(i_lo, i_hi, a))
 
     def get_surface_summary_in_npdelta(self) -> pd.DataFrame:
 
         return self.df_md_combined
 
+    def __get_expiry_grid(self, expiration_timestamp: int) -> ExpiryGrid:
+
+        # use put (deribit has the same vol info for put & call)
+        puts = self.snapshot.get_rows(expiration_timestamp, _cst.put)
+        npd = - puts[_cst.delta]
+        strike = puts[_cst.strike]
+        vol = puts[_cst.mark_iv] / 100.0  # deribit iv is in percent
+        lnk = np.log(strike / self.ds_fwd[expiration_timestamp])
+
+        i_npd, i_lnk = np.argsort(npd), np.argsort(lnk)
+
+        return ExpiryGrid(npd[i_npd], strike[i_npd], vol[i_npd], lnk[i_lnk], vol[i_lnk], npd[i_lnk],
+                          self.interp_extrap(npd[i_npd], np.column_stack([strike[i_npd], vol[i_npd]])),
+                          self.interp_extrap(lnk[i_lnk], np.column_stack([vol[i_lnk], npd[i_lnk]])))
+
+    def __stack_grids(self) -> None:
+
+        self.grid_expirations = np.array(sorted(self.kw_grid), dtype=np.int64)
+        self.grid_taus = self.get_year_fraction(self.grid_expirations)
+        self.grid_log_fwds = np.log(self.ds_fwd.loc[self.grid_expirations].to_numpy(float))
+        self.grids = [self.kw_grid[ex] for ex in self.grid_expirations]
+
+    def __get_time_weights(self, tau: np.ndarray) -> tuple:
+
+        # bracketing listed expiries and the weight on the upper one. the weight is clipped to [0, 1],
+        # which makes everything flat before the first and after the last expiry.
+        n = self.grid_taus.size
+        i_hi = np.clip(np.searchsorted(self.grid_taus, tau), 0, n - 1)
+        i_lo = np.maximum(i_hi - 1, 0)
+
+        tau_lo, tau_hi = self.grid_taus[i_lo], self.grid_taus[i_hi]
+        dtau = tau_hi - tau_lo
+        a = np.clip(np.divide(tau - tau_lo, dtau, out=np.ones_like(dtau), where=dtau > 0), 0.0, 1.0)
+
+        return i_lo, i_hi, a
+
+    def __get_log_forward(self, i_lo: np.ndarray, i_hi: np.ndarray, a: np.ndarray) -> np.ndarray:
+        return (1.0 - a) * self.grid_log_fwds[i_lo] + a * self.grid_log_fwds[i_hi]
+
+    def __eval_grids(self, i_grid: np.ndarray, x: np.ndarray, interp_field: str, column: int) -> np.ndarray:
+
+        # one pass of the cached interpolator per expiry, on the contiguous run of its queries
+        i_flat, x_flat = np.ravel(i_grid), np.ravel(x)
+        order = np.argsort(i_flat, kind='stable')
+        grid_ids, starts = np.unique(i_flat[order], return_index=True)
+
+        y = np.empty(x_flat.shape)
+        for i, rows in zip(grid_ids, np.split(order, starts[1:])):
+            y[rows] = getattr(self.grids[i], interp_field)(x_flat[rows], column)
+        return y.reshape(np.shape(x))
+
+    def __interp_total_variance(self, i_lo, i_hi, a, vol_lo, vol_hi) -> np.ndarray:
+
+        tau_lo, tau_hi = self.grid_taus[i_lo], self.grid_taus[i_hi]
+        tau = (1.0 - a) * tau_lo + a * tau_hi
+        w = (1.0 - a) * vol_lo**2 * tau_lo + a * vol_hi**2 * tau_hi
+
+        # expired or expiring slices have no variance to spread; fall back to vol interpolation
+        return np.where(tau > 0, np.sqrt(np.divide(w, tau, out=np.zeros_like(w), where=tau > 0)),
+                        (1.0 - a) * vol_lo + a * vol_hi)
+
+    @staticmethod
+    def __has_expiry_moved(snapshot_old: OptionSnapshot, snapshot_new: OptionSnapshot, expiration_timestamp: int,
+                           vol_tol, delta_tol, fwd_rel_tol) -> bool:
+
+        sl_old = snapshot_old.get_expiry_slice(expiration_timestamp)
+        sl_new = snapshot_new.get_expiry_slice(expiration_timestamp)
+
+        # listed/delisted instruments. both are sorted the same way, so equal lists align row by row.
+        if not np.array_equal(snapshot_old.instrument_names[sl_old], snapshot_new.instrument_names[sl_new]):
+            return True
+
+        old, new = snapshot_old.rows[sl_old], snapshot_new.rows[sl_new]
+        d_fwd = np.abs(new[_cst.underlying_price] / old[_cst.underlying_price] - 1.0)
+        d_vol = np.abs(new[_cst.mark_iv] - old[_cst.mark_iv])
+        d_delta = np.abs(new[_cst.delta] - old[_cst.delta])
+
+        return bool((d_fwd > fwd_rel_tol).any() or (d_vol > vol_tol).any() or (d_delta > delta_tol).any())
+
+    @staticmethod
+    def __patch_rows(df_old: Union[pd.Series, pd.DataFrame], df_new: Union[pd.Series, pd.DataFrame], removed: list):
+
+        df = df_old.drop(index=removed)
+        if df_new.empty:
+            return df
+
+        # overwrite existing expiries in place, then append the new ones
+        i_existing = df_new.index.intersection(df.index)
+        df.loc[i_existing] = df_new.loc[i_existing]
+        i_added = df_new.index.difference(df.index)
+        if i_added.size > 0:
+            df = pd.concat([df, df_new.loc[i_added]]).sort_index()
+
+        return df
+
+    def __build_expiries(self, expiration_timestamps: list) -> tuple:
+
+        # set forwards: from the futures curve, or else the average underlying price of each expiry
+        if self.forward_curve is not None:
+            ds_fwd = pd.Series(self.forward_curve.get_forward(expiration_timestamps), index=expiration_timestamps,
+                               dtype=float)
+        else:
+            kw_fwd = {ex: np.mean(self.snapshot.get_rows(ex)[_cst.underlying_price]) for ex in expiration_timestamps}
+            ds_fwd = pd.Series(kw_fwd, dtype=float)
+        ds_fwd.index.name = self.s_expiration_timestamp
+
+        if not expiration_timestamps:
+            return ds_fwd, pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+        kw_md_pac_ex = {ex_ts: self.__get_md_at_npdeltas(ex_ts) for ex_ts in expiration_timestamps}
+
+        # index: expiration_timestamp, columns: (fields, label) where fields = (strike, volatility, extrapolated)
+        df_md_pac = pd.concat(kw_md_pac_ex).unstack()
+        df_md_pac.index.name = self.s_expiration_timestamp
+
+        # set md by atmf, rr, fly
+        df_md_arf = self.__get_md_atmf_rr_fly(df_md_pac)
+        df_md_arf.index.name = self.s_expiration_timestamp
+
+        df_fwd = pd.DataFrame(ds_fwd, columns=pd.MultiIndex.from_arrays([[self.s_forward], [self.s_forward]]))
+        df_md_combined = pd.concat([df_fwd, df_md_pac, df_md_arf], axis=1)
+
+        return ds_fwd, df_md_pac, df_md_arf, df_md_combined
+
     def __get_md_at_npdeltas(self, expiration_timestamp: int) -> pd.DataFrame:
 
         # market data: use put (deribit has the same vol info for put & call)
-        df_p = self.kkw_md[expiration_timestamp][_cst.put]
-        md_npdeltas = - df_p[_cst.delta].to_numpy()
-        md_strikes = df_p[_cst.strike].to_numpy()
-        md_vols = df_p[_cst.mark_iv].to_numpy()
+        puts = self.snapshot.get_rows(expiration_timestamp, _cst.put)
+        md_npdeltas = - puts[_cst.delta]
+        md_strikes = puts[_cst.strike]
+        md_vols = puts[_cst.mark_iv]
 
         # interpolates at 'deltaP, ATM, deltaC' (PAC)
         npd_min, npd_max = md_npdeltas.min(), md_npdeltas.max()
         pac_extrapolated = (self.target_npdeltas < npd_min) | (self.target_npdeltas > npd_max)
         pac_npdeltas = np.clip(self.target_npdeltas, npd_min, npd_max)
-        pac_strikes = self.interp_extrap(md_npdeltas, md_strikes)(pac_npdeltas)
-        pac_vols = self.interp_extrap(md_npdeltas, md_vols)(pac_npdeltas)
+        pac_strikes, pac_vols = self.interp_extrap(md_npdeltas, np.column_stack([md_strikes, md_vols]))(pac_npdeltas).T
 
         return pd.DataFrame(
             index=np.array([self.get_negputdel_label(npd) for npd in self.target_npdeltas]),
@@ -167,13 +399,13 @@ class VolatilitySurfaceDeribit(VolatilitySurface):
                   self.s_volatility_pac: pac_vols,
                   self.s_extrapolated_pac: pac_extrapolated})
 
-    def __get_md_atmf_rr_fly(self) -> pd.DataFrame:
+    def __get_md_atmf_rr_fly(self, df_md_pac: pd.DataFrame) -> pd.DataFrame:
 
         # for ATM, RR, FLY: RR & FLY are ordered in descending order of negative put deltas
         i_atm = self.target_npdeltas.size // 2  # 3 -> 1, 5 -> 2
 
-        vol = self.df_md_pac[self.s_volatility_pac].to_numpy()
-        ext = self.df_md_pac[self.s_extrapolated_pac].to_numpy()
+        vol = df_md_pac[self.s_volatility_pac].to_numpy()
+        ext = df_md_pac[self.s_extrapolated_pac].to_numpy()
 
         vol_atm = vol[:, i_atm]
         vol_rr = vol - vol[:, ::-1]
@@ -191,8 +423,8 @@ class VolatilitySurfaceDeribit(VolatilitySurface):
             delta_str = self.f2str100(1.0 - self.target_npdeltas[idx])
             col_arf.extend([delta_str + self.s_RR, delta_str + self.s_FLY])
 
-        df_vol_arf = pd.DataFrame(data=np.array(vol_arf).T, index=self.df_md_pac.index, columns=col_arf)
-        df_ext_arf = pd.DataFrame(data=np.array(ext_arf).T, index=self.df_md_pac.index, columns=col_arf)
+        df_vol_arf = pd.DataFrame(data=np.array(vol_arf).T, index=df_md_pac.index, columns=col_arf)
+        df_ext_arf = pd.DataFrame(data=np.array(ext_arf).T, index=df_md_pac.index, columns=col_arf)
 
         df_md_arf = pd.concat({self.s_volatility_arf: df_vol_arf, self.s_extrapolated_arf: df_ext_arf}, axis=1)
 
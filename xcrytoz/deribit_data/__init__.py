@@ -1,6 +1,47 @@
-from .batch_managers import LastTradeBatchDownloader, TickerBatchDownloader
-from .shared_structures import DeribitFields
-from .user_methods import ConverterToDF
+import importlib
+from typing import TYPE_CHECKING
 
-__all__ = ['LastTradeBatchDownloader', 'TickerBatchDownloader',
+# submodules are imported on first attribute access, so that e.g. a download run does not pay for
+# pandas and pymongo.
+_LAZY_ATTRIBUTES = {
+    'BackfillPlanner': '.backfill',
+    'BackfillRunner': '.backfill',
+    'LastTradeBatchDownloader': '.batch_managers',
+    'TickerBatchDownloader': '.batch_managers',
+    'JobScheduler': '.scheduler',
+    'OptionSnapshot': '.snapshot',
+    'OrderBookBatch': '.order_books',
+    'OrderBookBatchDownloader': '.order_books',
+    'PeriodicJob': '.scheduler',
+    'DeribitFields': '.shared_structures',
+    'ConverterToDF': '.user_methods',
+}
+
+__all__ = ['BackfillPlanner', 'BackfillRunner',
+           'LastTradeBatchDownloader', 'TickerBatchDownloader',
+           'JobScheduler', 'PeriodicJob',
+           'OptionSnapshot', 'OrderBookBatch', 'OrderBookBatchDownloader',
            'DeribitFields', 'ConverterToDF']
+
+if TYPE_CHECKING:
+    from .backfill import BackfillPlanner, BackfillRunner
+    from .batch_managers import LastTradeBatchDownloader, TickerBatchDownloader
+    from .order_books import OrderBookBatch, OrderBookBatchDownloader
+    from .scheduler import JobScheduler, PeriodicJob
+    from .snapshot import OptionSnapshot
+    from .shared_structures import DeribitFields
+    from .user_methods import ConverterToDF
+
+
+def __getattr__(name: str):
+
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value  # next access does not come here
+        return value
+
+    raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,174 @@
+import bisect
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Set
+
+from ..common_utils import get_logger
+from .batch_managers import BatchFileManager, LastTradeBatchDownloader
+from .downloader import DeribitDownloader_Simple, RateLimiter
+from .shared_structures import BackfillTask, TickerBatchInfo
+
+_LOGGER = get_logger(__name__)
+
+_MS_PER_HOUR = 60 * 60 * 1000
+
+
+class BackfillPlanner:
+    ''' finds what is missing from the stored batches.
+
+    last trades can be downloaded for any past window, so their gaps become backfill tasks: one per
+    (period window, currency, kind) not covered by stored batches. ticker snapshots cannot be taken
+    in the past, so their gaps are only reported. '''
+
+    def __init__(self, root_folder: str, currencies: List[str], kinds: List[str], period_ms: int = _MS_PER_HOUR):
+
+        self.bfm = BatchFileManager(root_folder)
+        self.currencies = currencies
+        self.kinds = kinds
+        self.period_ms = period_ms
+
+    def get_missing_last_trade_tasks(self, from_timestamp: int, to_timestamp: int) -> List[BackfillTask]:
+        ''' windows [t, t + period_ms] on the period grid within [from_timestamp, to_timestamp] that no
+        stored batch covers, for every currency and kind. a window is covered by one batch or by
+        several contiguous ones (e.g. earlier backfills with other windows). '''
+
+        infos = self.bfm.get_last_trade_batch_file_infos(from_timestamp, to_timestamp)
+
+        # covered intervals per pair, merged when they touch or overlap
+        kw_covered = {}
+        for bi in infos:  # sorted by start
+            covered = kw_covered.setdefault((bi.currency, bi.kind), [])
+            if covered and bi.start_timestamp <= covered[-1][1]:
+                covered[-1][1] = max(covered[-1][1], bi.end_timestamp)
+            else:
+                covered.append([bi.start_timestamp, bi.end_timestamp])
+
+        p = self.period_ms
+        window_starts = range(-(-from_timestamp // p) * p, to_timestamp - p + 1, p)
+
+        tasks = []
+        for currency, kind in itertools.product(self.currencies, self.kinds):
+            covered = kw_covered.get((currency, kind), [])
+            starts = [c[0] for c in covered]
+            for ws in window_starts:
+                i = bisect.bisect_right(starts, ws) - 1
+                if i < 0 or covered[i][1] < ws + p:
+                    tasks.append(BackfillTask(ws, ws + p, currency, kind))
+
+        return sorted(tasks)
+
+    def get_missing_ticker_batches(self, from_timestamp: int, to_timestamp: int, interval_ms: int)\
+            -> List[TickerBatchInfo]:
+        ''' ticker batches missing in [from_timestamp, to_timestamp], as infos without a path:
+        - snapshots stored for some (currency, kind) but not for others.
+        - interval_ms slots of the grid without any snapshot, with the slot start as timestamp. '''
+
+        infos = self.bfm.get_ticker_batch_file_infos(from_timestamp, to_timestamp)
+
+        kw_pairs = {}
+        for bi in infos:
+            kw_pairs.setdefault(bi.batch_timestamp, set()).add((bi.currency, bi.kind))
+
+        all_pairs = list(itertools.product(self.currencies, self.kinds))
+        missing = [TickerBatchInfo(ts, c, k, None) for ts, pairs in kw_pairs.items()
+                   for c, k in all_pairs if (c, k) not in pairs]
+
+        slots_with_batch = {ts // interval_ms for ts in kw_pairs}
+        for slot in range(-(-from_timestamp // interval_ms), to_timestamp // interval_ms + 1):
+            if slot not in slots_with_batch:
+                missing.extend(TickerBatchInfo(slot * interval_ms, c, k, None) for c, k in all_pairs)
+
+        return sorted(missing)
+
+
+class BackfillRunner:
+    ''' downloads backfill tasks concurrently.
+
+    - rate limit: all worker threads share one token bucket, so the whole backfill stays within
+      requests_per_sec however many workers there are.
+    - connections: each worker keeps one connection alive for all of its tasks.
+    - checkpoint: every finished task is appended to checkpoint_path (json lines). run again with
+      the same checkpoint, an interrupted backfill skips what it has already done. '''
+
+    def __init__(self, root_folder: str, n_workers: int = 4, requests_per_sec: float = 20.0,
+                 checkpoint_path: str = None):
+
+        self.root_folder = root_folder
+        self.n_workers = n_workers
+        self.rate_limiter = RateLimiter(requests_per_sec, burst=max(1, n_workers))
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_lock = threading.Lock()
+        self.local = threading.local()
+        self.downloaders: List[DeribitDownloader_Simple] = []
+
+    def run(self, tasks: List[BackfillTask]) -> List[BackfillTask]:
+        ''' runs the tasks not in the checkpoint yet. returns those that failed. '''
+
+        done = self.__load_checkpoint()
+        pending = [t for t in tasks if t not in done]
+        _LOGGER.info('backfill: ' + str(len(pending)) + ' tasks to run, ' + str(len(tasks) - len(pending)) +
+                     ' already done')
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix='backfill') as executor:
+                futures = {executor.submit(self.__run_task, t): t for t in pending}
+                for n, fut in enumerate(as_completed(futures), 1):
+                    if not fut.result():
+                        failed.append(futures[fut])
+                    if n % 100 == 0:
+                        _LOGGER.info('backfill: ' + str(n) + '/' + str(len(pending)) + ' tasks finished')
+        finally:
+            for downloader in self.downloaders:
+                downloader.close()
+            self.downloaders = []
+
+        _LOGGER.info('backfill: ' + str(len(pending) - len(failed)) + ' tasks done, ' + str(len(failed)) + ' failed')
+        return sorted(failed)
+
+    def __run_task(self, task: BackfillTask) -> bool:
+
+        if not hasattr(self.local, 'downloader'):
+            self.local.downloader = DeribitDownloader_Simple(keep_alive=True, rate_limiter=self.rate_limiter)
+            self.downloaders.append(self.local.downloader)
+
+        # streaming, so that a retried task resumes within its window
+        failed = LastTradeBatchDownloader(self.root_folder, task.start_timestamp, task.end_timestamp,
+                                          self.local.downloader, streaming=True)\
+            .download_batches([task.currency], [task.kind])
+        if failed:
+            # the connection may be broken: the next task of this worker starts a new one
+            self.local.downloader.close()
+            return False
+
+        self.__save_checkpoint(task)
+        return True
+
+    def __load_checkpoint(self) -> Set[BackfillTask]:
+
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return set()
+
+        done = set()
+        with open(self.checkpoint_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        done.add(BackfillTask(*json.loads(line)))
+                    except (ValueError, TypeError):
+                        # e.g. a line cut short by the interruption
+                        _LOGGER.warning('skipping checkpoint line: ' + line)
+        return done
+
+    def __save_checkpoint(self, task: BackfillTask) -> None:
+
+        if self.checkpoint_path is None:
+            return
+
+        with self.checkpoint_lock:
+            with open(self.checkpoint_path, 'a') as f:
+                f.write(json.dumps(list(task)) + '\n')
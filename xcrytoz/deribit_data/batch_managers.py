@@ -5,59 +5,98 @@ import time
 import zipfile
 from abc import abstractclassmethod
 from datetime import datetime
-from typing import List
-
-import numpy as np
+from typing import Iterator, List, Tuple
 
 from ..common_utils import Converter, get_logger
+from ..metrics import get_metrics
+from ..tracing import traced
 from .downloader import DeribitDownloader_Simple
-from .shared_structures import DeribitConstants, TickerBatchInfo
+from .shared_structures import (DeribitConstants, DeribitFields,
+                                LastTradeBatchInfo, TickerBatchInfo)
+from .spill import SpillFile, iter_json_list
 
 _LOGGER = get_logger(__name__)
 
 # this is to make the variable name shorter
 _dcs = DeribitConstants()
+_cst = DeribitFields()
 
 
 class BatchDownloader:
 
-    def __init__(self, root_folder, save_folder_name, batch_id):
+    s_time_start = 'time_start'
+
+    def __init__(self, root_folder, save_folder_name, batch_id, downloader: DeribitDownloader_Simple = None,
+                 streaming=False):
 
         self.root_folder = root_folder
         self.batch_id = batch_id
         self.save_folder = os.path.join(root_folder, save_folder_name)
-        self.downloader = DeribitDownloader_Simple()
+        # a downloader can be shared between batches, e.g. to keep its connection alive
+        self.downloader = DeribitDownloader_Simple() if downloader is None else downloader
+        # with streaming, records are appended to a spill file next to the zip as they arrive and the
+        # zip is written from it at the end. a failed download leaves its spill behind: the next run of
+        # the same batch resumes from it, and a run of a later batch finishes it if _seal_spill can.
+        self.streaming = streaming
 
-    def download_batches(self, currencies: List[str], kinds: List[str]):
+    def download_batches(self, currencies: List[str], kinds: List[str]) -> List[Tuple[str, str]]:
+        ''' downloads and writes one batch per (currency, kind). returns the pairs that failed. '''
 
         if not os.path.exists(self.save_folder):
             os.makedirs(self.save_folder)
 
         start_timestamp = int(time.time())
+        failed = []
         for currency, kind in itertools.product(currencies, kinds):
+            t_download = time.perf_counter()
+            spill = None
             try:
                 _LOGGER.info('downloading ' + currency + ' ' + kind)
-                data = self._execute_download(currency, kind)
+                if self.streaming:
+                    self.__finish_leftover_spills(currency, kind)
+                    spill = SpillFile(self._get_file_path(currency, kind, '.spill'))
+                    time_start = self.__start_spill(spill, start_timestamp)
+                    self._execute_download_to_spill(currency, kind, spill)
+                else:
+                    time_start = start_timestamp
+                    data = self._execute_download(currency, kind)
                 end_timestamp = int(time.time())
                 attribs = {
                     'batch_id': self.batch_id,
                     'save_folder': self.save_folder,
-                    'time_start': start_timestamp,
+                    'time_start': time_start,
                     'time_end': end_timestamp
                 }
 
-                file_path = self.__write_zip(data, attribs, currency, kind)
+                get_metrics().observe_snapshot(currency, kind, time.perf_counter() - t_download)
+
+                t_write = time.perf_counter()
+                if self.streaming:
+                    file_path = self.__write_zip_from_spill(spill, attribs, currency, kind)
+                    spill.remove()
+                else:
+                    file_path = self._write_batch(data, attribs, currency, kind)
+                get_metrics().observe_zip_write(currency, kind, time.perf_counter() - t_write,
+                                                _get_size(file_path))
                 _LOGGER.info('wrote to json ' + file_path)
 
             except Exception as ex:
+                get_metrics().add_batch_failure(currency, kind)
                 _LOGGER.error("FAILED: " + currency + '/' + kind + '. Error: ' + str(ex))
+                failed.append((currency, kind))
+            finally:
+                if spill is not None:
+                    spill.close()
 
+        return failed
+
+    @traced()
     def __write_zip(self, data: dict, attributes: dict, currency: str, kind: str) -> str:
 
         # create a data structure with data and attrbutes
         to_save = {_dcs.attributes_file_name: attributes, _dcs.data_file_name: data}
 
-        zip_file_path = os.path.join(self.save_folder, '_'.join([self.batch_id, currency, kind]) + '.zip')
+        zip_file_path = self._get_file_path(currency, kind, '.zip')
 
         with zipfile.ZipFile(zip_file_path, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zip_file:
 
@@ -69,26 +108,160 @@ class BatchDownloader:
 
         return zip_file_path
 
+    def _write_batch(self, data, attributes: dict, currency: str, kind: str) -> str:
+        ''' writes a downloaded batch, by default as a zip of json. returns the path written. '''
+        return self.__write_zip(data, attributes, currency, kind)
+
+    @traced()
+    def __write_zip_from_spill(self, spill: SpillFile, attributes: dict, currency: str, kind: str,
+                               batch_id: str = None) -> str:
+
+        # same archive as __write_zip, with the data streamed from the spill
+        zip_file_path = self._get_file_path(currency, kind, '.zip', batch_id)
+
+        with zipfile.ZipFile(zip_file_path, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zip_file:
+
+            zip_file.writestr(_dcs.attributes_file_name, data=json.dumps(attributes, ensure_ascii=False, indent=4))
+            with zip_file.open(_dcs.data_file_name, mode='w', force_zip64=True) as f:
+                for piece in self._iter_data_json_from_spill(spill):
+                    f.write(piece.encode('utf-8'))
+
+            zip_file.testzip()
+
+        return zip_file_path
+
+    def _get_file_path(self, currency: str, kind: str, extension: str, batch_id: str = None) -> str:
+        batch_id = self.batch_id if batch_id is None else batch_id
+        return os.path.join(self.save_folder, '_'.join([batch_id, currency, kind]) + extension)
+
+    def __start_spill(self, spill: SpillFile, start_timestamp: int) -> int:
+        ''' the start time of the batch in the spill, which is created if there is none. '''
+
+        for record in spill.records():
+            _LOGGER.info('resuming from ' + spill.path)
+            return record[self.s_time_start]
+
+        spill.append({self.s_time_start: start_timestamp})
+        return start_timestamp
+
+    def __finish_leftover_spills(self, currency: str, kind: str) -> None:
+        ''' writes the spills that failed earlier batches of the pair left in the save folder, when
+        _seal_spill makes them complete. '''
+
+        suffix = '_'.join(['', currency, kind]) + '.spill'
+        for entry in os.scandir(self.save_folder):
+            batch_id = entry.name[:-len(suffix)]
+            if not entry.name.endswith(suffix) or batch_id == self.batch_id or '_' in batch_id:
+                continue
+
+            spill = SpillFile(entry.path)
+            try:
+                time_end = int(os.path.getmtime(spill.path))  # the last record received
+                if not self._seal_spill(spill):
+                    continue
+                time_start = next(spill.records())[self.s_time_start]
+                attribs = {
+                    'batch_id': batch_id,
+                    'save_folder': self.save_folder,
+                    'time_start': time_start,
+                    'time_end': time_end
+                }
+                file_path = self.__write_zip_from_spill(spill, attribs, currency, kind, batch_id)
+                spill.remove()
+                _LOGGER.info('finished the leftover ' + entry.path + ' as ' + file_path)
+            except Exception as ex:
+                _LOGGER.error('could not finish the leftover ' + entry.path + '. Error: ' + str(ex))
+            finally:
+                spill.close()
+
+    def _seal_spill(self, spill: SpillFile) -> bool:
+        ''' completes the spill of a failed earlier batch so that it can be written as it is. returns
+        False to leave the spill alone, which is the default: such batches are resumed by a rerun. '''
+        return False
+
     @abstractclassmethod
     def _execute_download(self, currency, kind):
         pass
 
+    @abstractclassmethod
+    def _execute_download_to_spill(self, currency, kind, spill: SpillFile):
+        ''' appends to the spill what is not in it yet. '''
+        pass
+
+    @abstractclassmethod
+    def _iter_data_json_from_spill(self, spill: SpillFile) -> Iterator[str]:
+        ''' pieces of the json of the data that _execute_download would have returned. '''
+        pass
+
 
 class TickerBatchDownloader(BatchDownloader):
 
-    def __init__(self, root_folder, timestamp):
+    def __init__(self, root_folder, timestamp, downloader: DeribitDownloader_Simple = None, streaming=False):
         dt = Converter.ms2dt(timestamp)
         save_folder_name = dt.strftime(_dcs.YYYYMM)
         batch_id = dt.strftime(_dcs.YYYYMMDDhhmmss)
-        super().__init__(root_folder, save_folder_name, batch_id)
+        super().__init__(root_folder, save_folder_name, batch_id, downloader, streaming)
 
     def _execute_download(self, currency, kind):
         return self.downloader.download_tickers(currency, kind)
 
+    def _execute_download_to_spill(self, currency, kind, spill: SpillFile):
+
+        # the instruments of an interrupted run are kept, so that the snapshot stays one chain
+        instruments, done = None, set()
+        for record in spill.records():
+            if 'instruments' in record:
+                instruments = record['instruments']
+            elif 'ticker' in record:
+                done.add(record['ticker'][_cst.instrument_name])
+            elif 'missing' in record:
+                done.add(record['missing'])
+
+        for record in self.downloader.get_iter_download_tickers(currency, kind, instruments, done):
+            spill.append(record)
+
+    def _seal_spill(self, spill: SpillFile) -> bool:
+
+        # a snapshot cannot be resumed later: the instruments without a ticker yet become missing
+        instruments, done = None, set()
+        for record in spill.records():
+            if 'instruments' in record:
+                instruments = record['instruments']
+            elif 'ticker' in record:
+                done.add(record['ticker'][_cst.instrument_name])
+            elif 'missing' in record:
+                done.add(record['missing'])
+
+        if instruments is None:
+            # failed before anything was received
+            _LOGGER.info('removing the empty leftover ' + spill.path)
+            spill.remove()
+            return False
+
+        for inst in instruments:
+            if inst[_cst.instrument_name] not in done:
+                spill.append({'missing': inst[_cst.instrument_name]})
+        return True
+
+    def _iter_data_json_from_spill(self, spill: SpillFile) -> Iterator[str]:
+
+        # {'instruments': [...], 'tickers': [...], 'missing': [...]}, one pass over the spill per key
+        yield '{\n    "instruments": '
+        yield from iter_json_list((i for r in spill.records() if 'instruments' in r for i in r['instruments']), 1)
+        yield ',\n    "tickers": '
+        yield from iter_json_list((r['ticker'] for r in spill.records() if 'ticker' in r), 1)
+        yield ',\n    "missing": '
+        yield from iter_json_list((r['missing'] for r in spill.records() if 'missing' in r), 1)
+        yield '\n}'
+
 
 class LastTradeBatchDownloader(BatchDownloader):
 
-    def __init__(self, root_folder: str, start_timestamp: int, end_timestamp: int):
+    s_end = 'end'
+    s_response = 'response'
+
+    def __init__(self, root_folder: str, start_timestamp: int, end_timestamp: int,
+                 downloader: DeribitDownloader_Simple = None, streaming=False):
 
         self.start_timestamp = start_timestamp
         self.end_timestamp = end_timestamp
@@ -97,17 +270,40 @@ class LastTradeBatchDownloader(BatchDownloader):
         save_folder_name = dt_e.strftime(_dcs.YYYYMM)
         batch_id = dt_s.strftime(_dcs.YYYYMMDDhhmmss) + '-' + dt_e.strftime(_dcs.YYYYMMDDhhmmss)
 
-        super().__init__(root_folder, save_folder_name, batch_id)
+        super().__init__(root_folder, save_folder_name, batch_id, downloader, streaming)
 
     def _execute_download(self, currency, kind):
         return self.downloader.download_last_trades(currency, kind, self.start_timestamp, self.end_timestamp)
 
+    def _execute_download_to_spill(self, currency, kind, spill: SpillFile):
+
+        # restart after the last window in the spill
+        start_timestamp = self.start_timestamp
+        for record in spill.records():
+            if self.s_end in record:
+                start_timestamp = record[self.s_end]
+
+        for end, recvd in self.downloader.get_iter_download_last_trade_windows(
+                currency, kind, start_timestamp, self.end_timestamp):
+            spill.append({self.s_end: end, self.s_response: recvd})
+
+    def _iter_data_json_from_spill(self, spill: SpillFile) -> Iterator[str]:
+        yield from iter_json_list(r[self.s_response] for r in spill.records() if self.s_response in r)
+
+
+def _get_size(path: str) -> int:
+
+    if os.path.isdir(path):
+        return sum(os.path.getsize(e.path) for e in os.scandir(path) if e.is_file())
+    return os.path.getsize(path)
+
 
 class BatchFileManager:
 
     def __init__(self, root_folder):
         self.root_folder = root_folder
 
+    @traced()
     def read(self, file_path_without_root_folder: str):
 
         file_path = os.path.join(self.root_folder, file_path_without_root_folder)
@@ -122,9 +318,9 @@ class BatchFileManager:
             -> List[TickerBatchInfo]:
 
         if from_timestamp is None:
-            from_timestamp = -np.inf
+            from_timestamp = -float('inf')
         if to_timestamp is None:
-            to_timestamp = np.inf
+            to_timestamp = float('inf')
 
         # find all subfolders with digits
         data_folder_names = sorted([path.name for path in os.scandir(self.root_folder)
@@ -136,6 +332,8 @@ class BatchFileManager:
             for file_path in os.scandir(os.path.join(self.root_folder, folder_name)):
 
                 file_name_w_ext = file_path.name
+                if not file_name_w_ext.endswith('.zip'):
+                    continue  # e.g. spill files of unfinished streaming downloads
                 file_path_wo_root = os.path.join(folder_name, file_name_w_ext)
 
                 # parse
@@ -146,3 +344,71 @@ class BatchFileManager:
                     file_infos.append(TickerBatchInfo(batch_ts, currency, kind, file_path_wo_root))
 
         return file_infos
+
+    def read_order_books(self, path_without_root_folder: str):
+        ''' an order book batch, memory mapped (see OrderBookBatch). '''
+
+        # imported here so that numpy is only loaded when order books are used
+        from .order_books import OrderBookBatch
+        return OrderBookBatch(os.path.join(self.root_folder, path_without_root_folder))
+
+    def get_order_book_batch_file_infos(self, from_timestamp: int = None, to_timestamp: int = None)\
+            -> List[TickerBatchInfo]:
+        ''' order book batches in [from_timestamp, to_timestamp], ordered by batch timestamp. '''
+
+        if from_timestamp is None:
+            from_timestamp = -float('inf')
+        if to_timestamp is None:
+            to_timestamp = float('inf')
+
+        data_folder_names = sorted([path.name for path in os.scandir(self.root_folder)
+                                    if (path.is_dir() and os.path.basename(path.path).isdigit())])
+
+        file_infos = []
+        for folder_name in data_folder_names:
+            for file_path in os.scandir(os.path.join(self.root_folder, folder_name)):
+
+                # batches are folders: <batch>_<currency>_<kind>.book
+                file_name_w_ext = file_path.name
+                if not (file_path.is_dir() and file_name_w_ext.endswith(_dcs.order_book_extension)):
+                    continue
+                file_path_wo_root = os.path.join(folder_name, file_name_w_ext)
+
+                batch_dt_str, currency, kind = os.path.splitext(file_name_w_ext)[0].split('_')
+                batch_ts = Converter.dt2ms_int(datetime.strptime(batch_dt_str, _dcs.YYYYMMDDhhmmss))
+
+                if (batch_ts >= from_timestamp) and (batch_ts <= to_timestamp):
+                    file_infos.append(TickerBatchInfo(batch_ts, currency, kind, file_path_wo_root))
+
+        return sorted(file_infos)
+
+    def get_last_trade_batch_file_infos(self, from_timestamp: int = None, to_timestamp: int = None)\
+            -> List[LastTradeBatchInfo]:
+        ''' last trade batches whose window overlaps [from_timestamp, to_timestamp], ordered by window. '''
+
+        if from_timestamp is None:
+            from_timestamp = -float('inf')
+        if to_timestamp is None:
+            to_timestamp = float('inf')
+
+        data_folder_names = sorted([path.name for path in os.scandir(self.root_folder)
+                                    if (path.is_dir() and os.path.basename(path.path).isdigit())])
+
+        file_infos = []
+        for folder_name in data_folder_names:
+            for file_path in os.scandir(os.path.join(self.root_folder, folder_name)):
+
+                file_name_w_ext = file_path.name
+                if not file_name_w_ext.endswith('.zip'):
+                    continue  # e.g. spill files of unfinished streaming downloads
+                file_path_wo_root = os.path.join(folder_name, file_name_w_ext)
+
+                # parse: <start>-<end>_<currency>_<kind>.zip
+                batch_dt_str, currency, kind = os.path.splitext(file_name_w_ext)[0].split('_')
+                start_ts, end_ts = [Converter.dt2ms_int(datetime.strptime(dt_str, _dcs.YYYYMMDDhhmmss))
+                                    for dt_str in batch_dt_str.split('-')]
+
+                if (end_ts >= from_timestamp) and (start_ts <= to_timestamp):
+                    file_infos.append(LastTradeBatchInfo(start_ts, end_ts, currency, kind, file_path_wo_root))
+
+        return sorted(file_infos)
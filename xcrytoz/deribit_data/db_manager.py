@@ -1,6 +1,9 @@
+import time
+
 import pymongo as mdb
 
 from ..common_utils import get_logger
+from ..metrics import get_metrics
 
 _LOGGER = get_logger(__name__)
 
@@ -58,7 +61,9 @@ class DBManager:
 
             # add batch and insert
             ticker_batch[self.s_batch] = batch
+            t_start = time.perf_counter()
             self.col_ticker_batch.insert_one(ticker_batch)
+            get_metrics().observe_db_insert(self.ticker_batch_col_name, time.perf_counter() - t_start)
         else:
             _LOGGER.info(f'skipping. already exists: {ticker_batch}')
 
@@ -1,11 +1,13 @@
 import json
+import threading
 import time
 from time import sleep
 
-import numpy as np
 import websocket
 
 from ..common_utils import get_logger
+from ..metrics import get_metrics
+from ..tracing import traced
 # import within package
 from .shared_structures import DeribitFields
 
@@ -16,6 +18,32 @@ _LOGGER = get_logger(__name__)
 _cst = DeribitFields()
 
 
+class RateLimiter:
+    ''' token bucket shared between threads: on average rate_per_sec acquisitions per second, with
+    bursts of up to burst. '''
+
+    def __init__(self, rate_per_sec: float, burst: int = 1):
+
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.t_last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.t_last) * self.rate_per_sec)
+                self.t_last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_sec = (1.0 - self.tokens) / self.rate_per_sec
+            sleep(wait_sec)
+
+
 class DeribitDownloader_Simple:
     ''' simple downloader using websocket. needs to be improved. '''
 
@@ -28,47 +56,117 @@ class DeribitDownloader_Simple:
             return int(time.time())
         return id
 
-    def __init__(self):
+    def __init__(self, keep_alive=False, rate_limiter: RateLimiter = None, url: str = None):
 
         # initialise websocket
         self.ws = websocket.WebSocket()
+        # e.g. a local fake server
+        self.url = self.deribit_ws_live if url is None else url
 
-    def download_tickers(self, currency='BTC', kind='option', sleep_in_sec=0.05):
+        # with keep_alive, the connection is opened once and reused by every download (e.g. in a
+        # long running process) until close() is called.
+        self.keep_alive = keep_alive
 
-        # go to live server
-        self.ws.connect(self.deribit_ws_live)
+        # when given, every request waits for it, e.g. to share deribit's rate limit between threads
+        self.rate_limiter = rate_limiter
 
-        msg = self.__make_msg_get_instruments(currency, kind)
-        received_instruments = self.__download_no_check(msg)
-
-        if _cst.result not in received_instruments:
+    def close(self):
+        if self.ws.connected:
             self.ws.close()
-            raise Exception('failed to receive a list of instruments')
 
-        # sort instruments by expiration timestamp so that the options with the same expiry are
-        # downloaded about the same timestamp
-        instruments = sorted(received_instruments[_cst.result], key=lambda inst: inst[_cst.expiration_timestamp])
+    @traced()
+    def download_tickers(self, currency='BTC', kind='option', sleep_in_sec=0.05):
 
-        # collect tickers
+        instruments = None
         tickers = []
         missing_ticker_instruments = []
-        for inst in instruments:
-            inst_name = inst[_cst.instrument_name]
-            msg = self.__make_msg_ticker(inst_name)
-            received_ticker = self.__download_no_check(msg)
-            if _cst.result in received_ticker:
-                tickers.append(received_ticker[_cst.result])
+        for record in self.get_iter_download_tickers(currency, kind, sleep_in_sec=sleep_in_sec):
+            if 'instruments' in record:
+                instruments = record['instruments']
+            elif 'ticker' in record:
+                tickers.append(record['ticker'])
             else:
-                missing_ticker_instruments.append(inst_name)
-            sleep(sleep_in_sec)
+                missing_ticker_instruments.append(record['missing'])
 
-        self.ws.close()
         return {
             'instruments': instruments,
             'tickers': tickers,
             'missing': missing_ticker_instruments
         }
 
+    def get_iter_download_tickers(self, currency='BTC', kind='option', instruments: list = None,
+                                  skip_instrument_names=(), sleep_in_sec=0.05):
+        ''' download_tickers one record at a time, so that they can be written as they arrive:
+        {'instruments': [...]} first, unless instruments are given (e.g. by an interrupted run), then
+        {'ticker': ...} or {'missing': instrument_name} for each instrument not in skip_instrument_names. '''
+
+        # go to live server
+        self.__open()
+        try:
+            if instruments is None:
+                msg = self.__make_msg_get_instruments(currency, kind)
+                received_instruments = self.__download_no_check(msg)
+
+                if _cst.result not in received_instruments:
+                    raise Exception('failed to receive a list of instruments')
+
+                # sort instruments by expiration timestamp so that the options with the same expiry are
+                # downloaded about the same timestamp
+                instruments = sorted(received_instruments[_cst.result],
+                                     key=lambda inst: inst[_cst.expiration_timestamp])
+                yield {'instruments': instruments}
+
+            # collect tickers
+            n_missing = 0
+            for inst in instruments:
+                inst_name = inst[_cst.instrument_name]
+                if inst_name in skip_instrument_names:
+                    continue
+                msg = self.__make_msg_ticker(inst_name)
+                received_ticker = self.__download_no_check(msg)
+                if _cst.result in received_ticker:
+                    yield {'ticker': received_ticker[_cst.result]}
+                else:
+                    n_missing += 1
+                    yield {'missing': inst_name}
+                sleep(sleep_in_sec)
+        finally:
+            self.__close()
+
+        get_metrics().add_missing_instruments(currency, kind, n_missing)
+
+    def download_order_books(self, currency='BTC', kind='option', depth=20, sleep_in_sec=0.05):
+        ''' full depth snapshot of the chain: {'instruments', 'order_books', 'missing'}. each order book
+        also carries the ticker fields (mark price, greeks, ...). '''
+
+        self.__open()
+        try:
+            msg = self.__make_msg_get_instruments(currency, kind)
+            received_instruments = self.__download_no_check(msg)
+            if _cst.result not in received_instruments:
+                raise Exception('failed to receive a list of instruments')
+            instruments = sorted(received_instruments[_cst.result], key=lambda inst: inst[_cst.expiration_timestamp])
+
+            order_books = []
+            missing = []
+            for inst in instruments:
+                inst_name = inst[_cst.instrument_name]
+                received = self.__download_no_check(self.__make_msg_order_book(inst_name, depth))
+                if _cst.result in received:
+                    order_books.append(received[_cst.result])
+                else:
+                    missing.append(inst_name)
+                sleep(sleep_in_sec)
+        finally:
+            self.__close()
+
+        get_metrics().add_missing_instruments(currency, kind, len(missing))
+        return {
+            'instruments': instruments,
+            'order_books': order_books,
+            'missing': missing
+        }
+
     def download_last_trades(
             self, currency, kind,
             start_timestamp_exclusive, end_timestamp_inclusive,
@@ -83,6 +181,17 @@ class DeribitDownloader_Simple:
             start_timestamp_exclusive, end_timestamp_inclusive,
             max_count=1000, ts_split=20, level=0):
 
+        for _, recvd in self.get_iter_download_last_trade_windows(
+                currency, kind, start_timestamp_exclusive, end_timestamp_inclusive, max_count, ts_split, level):
+            yield recvd
+
+    def get_iter_download_last_trade_windows(
+            self, currency, kind,
+            start_timestamp_exclusive, end_timestamp_inclusive,
+            max_count=1000, ts_split=20, level=0):
+        ''' as get_iter_download_last_trades, with the end of each response's window. windows come in
+        time order, so a download stopped after a window can be restarted from its end. '''
+
         indent = '*   ' * level
 
         _LOGGER.info(indent + 'requesting from ' + str(start_timestamp_exclusive) +
@@ -91,45 +200,73 @@ class DeribitDownloader_Simple:
             currency, kind, start_timestamp_exclusive + 1, end_timestamp_inclusive, max_count)
         if recvd['result']['has_more']:
             _LOGGER.info(indent + 'Splitting into ' + str(ts_split) + ' sub-tasks')
-            ts_se = np.linspace(start_timestamp_exclusive, end_timestamp_inclusive, ts_split + 1)
+            # same points as np.linspace, without importing numpy in the download path
+            step = (end_timestamp_inclusive - start_timestamp_exclusive) / ts_split
+            ts_se = [start_timestamp_exclusive + i * step for i in range(ts_split)] + [end_timestamp_inclusive]
             for i in range(ts_split):
                 time.sleep(0.05)
                 ts_s = int(ts_se[i])
                 ts_e = int(ts_se[i+1])
-                yield from self.get_iter_download_last_trades(
+                yield from self.get_iter_download_last_trade_windows(
                     currency, kind, ts_s+1, ts_e, max_count, ts_split, level + 1)
         else:
             _LOGGER.info(indent + 'returning data')
-            yield recvd
+            yield end_timestamp_inclusive, recvd
 
     def get_last_trades_by_instrument_and_time(self, instrument_name,
                                                start_timestamp=None, end_timestamp=None, count=10):
 
-        self.ws.connect(self.deribit_ws_live)
+        self.__open()
         msg = self.__make_get_last_trades_by_instrument_and_time(
             instrument_name, start_timestamp, end_timestamp, count)
         received = self.__download_no_check(msg)
-        self.ws.close()
+        self.__close()
 
         return received
 
     def get_last_trades_by_currency_and_time(self, currency, kind,
                                              start_timestamp=None, end_timestamp=None, count=10):
 
-        self.ws.connect(self.deribit_ws_live)
+        self.__open()
         msg = self.__make_get_last_trades_by_currency_and_time(
             currency, kind, start_timestamp, end_timestamp, count)
         received = self.__download_no_check(msg)
-        self.ws.close()
+        self.__close()
 
         return received
 
+    def __open(self):
+        if not (self.keep_alive and self.ws.connected):
+            self.ws.connect(self.url)
+
+    def __close(self):
+        if not self.keep_alive:
+            self.ws.close()
+
+    @traced()
     def __download_no_check(self, msg: dict):
 
         # assumes the socket is open
         # ideally, we should do async programming - that is for next time.
-        self.ws.send(json.dumps(msg))
-        received = json.loads(self.ws.recv())
+        payload = json.dumps(msg)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        t_start = time.perf_counter()
+        try:
+            self.ws.send(payload)
+            raw = self.ws.recv()
+        except (websocket.WebSocketException, OSError) as ex:
+            if not self.keep_alive:
+                raise
+            # a kept-alive connection may have been dropped by the server: reconnect once
+            _LOGGER.warning('reconnecting after: ' + str(ex))
+            self.ws.close()
+            self.ws.connect(self.url)
+            self.ws.send(payload)
+            raw = self.ws.recv()
+
+        get_metrics().observe_request(msg['method'], time.perf_counter() - t_start, len(payload), len(raw))
+        received = json.loads(raw)
 
         # todo: probably needs to check whether the received has 'result' key.
         return received
@@ -159,6 +296,19 @@ class DeribitDownloader_Simple:
         }
         return msg
 
+    def __make_msg_order_book(self, instrument_name: str, depth: int, id: int = None) -> dict:
+
+        msg = {
+            "jsonrpc": self.jsonrpc_version,
+            "id": self.__make_now_timestamp_if_none(id),
+            "method": "public/get_order_book",
+            "params": {
+                "instrument_name": instrument_name,
+                "depth": depth
+            }
+        }
+        return msg
+
     def __make_get_last_trades_by_instrument_and_time(
             self,
             instrument_name,
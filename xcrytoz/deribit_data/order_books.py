@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+from typing import List, Union
+
+import numpy as np
+
+from ..common_utils import Converter, get_logger
+from ..tracing import traced
+from .batch_managers import BatchDownloader
+from .downloader import DeribitDownloader_Simple
+from .shared_structures import DeribitConstants, DeribitFields
+
+_LOGGER = get_logger(__name__)
+
+# constants from deribit data
+_cst = DeribitFields()
+_dcs = DeribitConstants()
+
+# NOTE:
+# an order book batch is a folder <batch>_<currency>_<kind>.book of .npy arrays plus attributes.json:
+#   books.npy     one record per order book (_BOOK_DTYPE): instrument, timestamps, ticker fields and
+#                 where its levels are in bids.npy / asks.npy
+#   bids.npy      (n levels, 2) int64: fixed point price, amount of every book's bids, book after book
+#   asks.npy      the same for asks
+#   instruments.json  the instruments as downloaded, read on demand
+# fixed point: price = int / price_scale, amount = int / amount_scale. the scales in attributes.json
+# are fine enough for every deribit tick and amount step, so the conversion is exact.
+
+_BOOK_DTYPE = np.dtype([
+    ('instrument', '<i4'),  # index into the instrument names
+    ('timestamp', '<i8'),
+    ('change_id', '<i8'),
+    ('bid_start', '<i8'),
+    ('n_bids', '<i4'),
+    ('ask_start', '<i8'),
+    ('n_asks', '<i4'),
+    ('mark_price', '<f8'),
+    ('mark_iv', '<f8'),
+    ('index_price', '<f8'),
+    ('underlying_price', '<f8'),
+])
+
+_PRICE_SCALE = 10 ** 8
+_AMOUNT_SCALE = 10 ** 6
+
+
+class OrderBookBatchDownloader(BatchDownloader):
+    ''' full depth snapshot of chains (public/get_order_book), stored as fixed point arrays. '''
+
+    def __init__(self, root_folder, timestamp, downloader: DeribitDownloader_Simple = None, depth=20):
+        dt = Converter.ms2dt(timestamp)
+        save_folder_name = dt.strftime(_dcs.YYYYMM)
+        batch_id = dt.strftime(_dcs.YYYYMMDDhhmmss)
+        super().__init__(root_folder, save_folder_name, batch_id, downloader)
+        self.depth = depth
+
+    def _execute_download(self, currency, kind):
+        return self.downloader.download_order_books(currency, kind, self.depth)
+
+    def _write_batch(self, data: dict, attributes: dict, currency: str, kind: str) -> str:
+        return write_order_book_batch(self._get_file_path(currency, kind, _dcs.order_book_extension), data, attributes)
+
+
+@traced()
+def write_order_book_batch(folder_path: str, data: dict, attributes: dict,
+                           price_scale=_PRICE_SCALE, amount_scale=_AMOUNT_SCALE) -> str:
+    ''' writes the data of download_order_books as an order book batch folder. the folder is written
+    next to its final place and renamed at the end, so readers never see a partial batch. an existing
+    batch is renamed aside first and removed last: while it is replaced, readers may find no batch for
+    an instant, and a crash then leaves the old one at <folder>.old rather than losing it. '''
+
+    order_books = data[_cst.order_books]
+    instrument_names = [ob[_cst.instrument_name] for ob in order_books]
+
+    books = np.zeros(len(order_books), dtype=_BOOK_DTYPE)
+    n_bids = np.array([len(ob[_cst.bids]) for ob in order_books], dtype=np.int64)
+    n_asks = np.array([len(ob[_cst.asks]) for ob in order_books], dtype=np.int64)
+    books['instrument'] = np.arange(len(order_books))
+    books['n_bids'], books['n_asks'] = n_bids, n_asks
+    books['bid_start'] = np.cumsum(n_bids) - n_bids
+    books['ask_start'] = np.cumsum(n_asks) - n_asks
+    for field in ['timestamp', 'change_id']:
+        books[field] = [ob.get(field, -1) for ob in order_books]
+    for field in ['mark_price', 'mark_iv', 'index_price', 'underlying_price']:
+        books[field] = [np.nan if ob.get(field) is None else ob[field] for ob in order_books]
+
+    def to_fixed_point(side: str) -> np.ndarray:
+        levels = np.array([level[:2] for ob in order_books for level in ob[side]], dtype=float).reshape(-1, 2)
+        return np.rint(levels * np.array([price_scale, amount_scale])).astype(np.int64)
+
+    tmp_path = folder_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, 'books.npy'), books)
+    np.save(os.path.join(tmp_path, _cst.bids + '.npy'), to_fixed_point(_cst.bids))
+    np.save(os.path.join(tmp_path, _cst.asks + '.npy'), to_fixed_point(_cst.asks))
+    with open(os.path.join(tmp_path, _dcs.attributes_file_name), 'w') as f:
+        json.dump(dict(attributes, price_scale=price_scale, amount_scale=amount_scale,
+                       instrument_names=instrument_names, missing=data['missing']), f, ensure_ascii=False)
+    with open(os.path.join(tmp_path, _cst.instruments + '.json'), 'w') as f:
+        json.dump(data[_cst.instruments], f, ensure_ascii=False)
+
+    old_path = folder_path + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(folder_path):
+        os.replace(folder_path, old_path)
+    os.replace(tmp_path, folder_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    return folder_path
+
+
+class OrderBookBatch:
+    ''' reader of an order book batch. the arrays are memory mapped, so opening a batch reads only
+    its attributes, and the levels of a book are views into the mapped files (no copy, no parse). '''
+
+    def __init__(self, folder_path: str):
+
+        self.folder_path = folder_path
+        with open(os.path.join(folder_path, _dcs.attributes_file_name), 'r') as f:
+            self.attributes: dict = json.load(f)
+
+        self.price_scale: int = self.attributes['price_scale']
+        self.amount_scale: int = self.attributes['amount_scale']
+        self.instrument_names: List[str] = self.attributes['instrument_names']
+        self.kw_index = {name: i for i, name in enumerate(self.instrument_names)}
+
+        self.books: np.ndarray = self.__load('books')
+        self.bids: np.ndarray = self.__load(_cst.bids)
+        self.asks: np.ndarray = self.__load(_cst.asks)
+
+    def __len__(self) -> int:
+        return len(self.books)
+
+    def get_book_index(self, instrument_name: str) -> int:
+        return self.kw_index[instrument_name]
+
+    def get_bids(self, instrument: Union[str, int]) -> np.ndarray:
+        ''' (n, 2) fixed point price, amount levels, best first. a read-only view. '''
+
+        book = self.books[self.__to_index(instrument)]
+        return self.bids[book['bid_start']:book['bid_start'] + book['n_bids']]
+
+    def get_asks(self, instrument: Union[str, int]) -> np.ndarray:
+        ''' (n, 2) fixed point price, amount levels, best first. a read-only view. '''
+
+        book = self.books[self.__to_index(instrument)]
+        return self.asks[book['ask_start']:book['ask_start'] + book['n_asks']]
+
+    def get_instruments(self) -> List[dict]:
+        with open(os.path.join(self.folder_path, _cst.instruments + '.json'), 'r') as f:
+            return json.load(f)
+
+    def to_float(self, levels: np.ndarray) -> np.ndarray:
+        ''' levels in prices and amounts (a copy). '''
+        return levels / np.array([self.price_scale, self.amount_scale], dtype=float)
+
+    def __load(self, name: str) -> np.ndarray:
+
+        path = os.path.join(self.folder_path, name + '.npy')
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # empty arrays cannot be mapped
+            return np.load(path)
+
+    def __to_index(self, instrument: Union[str, int]) -> int:
+        return self.kw_index[instrument] if isinstance(instrument, str) else int(instrument)
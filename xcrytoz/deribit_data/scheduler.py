@@ -0,0 +1,98 @@
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from ..common_utils import get_logger
+
+_LOGGER = get_logger(__name__)
+
+
+class PeriodicJob:
+    ''' a job fired on the wall clock grid offset_sec + n * period_sec (seconds since epoch).
+
+    fn is called with the scheduled time, not the actual start time, so that what it produces
+    (e.g. batch ids) stays on the grid. '''
+
+    def __init__(self, name: str, period_sec: float, fn: Callable[[float], None], offset_sec: float = 0.0):
+
+        if period_sec <= 0:
+            raise ValueError('period_sec must be positive: ' + str(period_sec))
+        self.name = name
+        self.period_sec = period_sec
+        self.fn = fn
+        self.offset_sec = offset_sec
+
+    def get_next_time(self, after_sec: float) -> float:
+        ''' first grid time strictly after after_sec. '''
+
+        n = (after_sec - self.offset_sec) // self.period_sec + 1
+        return self.offset_sec + n * self.period_sec
+
+
+class JobScheduler:
+    ''' runs periodic jobs in one long running process.
+
+    - drift free: fire times are on each job's grid, computed from the clock, never by adding
+      periods to finish times. a fire time missed while the job was still running is skipped.
+    - overlap protection: a job is never started while its previous run is still going.
+    - graceful shutdown: SIGINT/SIGTERM (or stop()) stop scheduling and wait for running jobs.
+
+    jobs run in their own threads, so state they keep (e.g. open connections) stays warm between runs. '''
+
+    def __init__(self, jobs: List[PeriodicJob]):
+
+        self.jobs = jobs
+        self.stop_event = threading.Event()
+        self.running: Dict[str, Future] = {}
+
+    def stop(self, *args) -> None:
+        _LOGGER.info('stopping scheduler')
+        self.stop_event.set()
+
+    def run(self) -> None:
+
+        # signals can only be handled in the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        now = time.time()
+        next_times = {job.name: job.get_next_time(now) for job in self.jobs}
+        kw_job = {job.name: job for job in self.jobs}
+
+        with ThreadPoolExecutor(max_workers=len(self.jobs), thread_name_prefix='job') as executor:
+
+            while not self.stop_event.is_set():
+
+                name = min(next_times, key=next_times.get)
+                scheduled = next_times[name]
+
+                # wakes up early on stop
+                if self.stop_event.wait(max(0.0, scheduled - time.time())):
+                    break
+
+                job = kw_job[name]
+                if name in self.running and not self.running[name].done():
+                    _LOGGER.warning('skipping ' + name + ' at ' + str(scheduled) + ': previous run still going')
+                else:
+                    self.running[name] = executor.submit(self.__run_job, job, scheduled)
+
+                next_times[name] = job.get_next_time(max(scheduled, time.time()))
+
+            _LOGGER.info('waiting for running jobs to finish')
+
+        _LOGGER.info('scheduler stopped')
+
+    @staticmethod
+    def __run_job(job: PeriodicJob, scheduled: float) -> None:
+
+        t_start = time.time()
+        _LOGGER.info('starting ' + job.name + ' scheduled at ' + str(scheduled))
+        try:
+            job.fn(scheduled)
+        except Exception as ex:
+            # keep the scheduler alive; the next run gets a fresh chance
+            _LOGGER.error('FAILED: ' + job.name + '. Error: ' + str(ex))
+        _LOGGER.info('finished ' + job.name + ' in ' + str(round(time.time() - t_start, 3)) + ' sec')
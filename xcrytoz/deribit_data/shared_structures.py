@@ -1,6 +1,8 @@
 from collections import namedtuple
 
 TickerBatchInfo = namedtuple('TickerBatchInfo', ['batch_timestamp', 'currency', 'kind', 'path'])
+LastTradeBatchInfo = namedtuple('LastTradeBatchInfo', ['start_timestamp', 'end_timestamp', 'currency', 'kind', 'path'])
+BackfillTask = namedtuple('BackfillTask', ['start_timestamp', 'end_timestamp', 'currency', 'kind'])
 
 
 class ConstantsBase():
@@ -17,27 +19,47 @@ class DeribitConstants(ConstantsBase):
     attributes_file_name = 'attributes.json'
     YYYYMMDDhhmmss = '%Y%m%d%H%M%S'
     YYYYMM = '%Y%m'
+    order_book_extension = '.book'
 
 
 class DeribitFields(ConstantsBase):
     # keys
 
+    amount = 'amount'
+    asks = 'asks'
+    best_ask_price = 'best_ask_price'
+    best_bid_price = 'best_bid_price'
+    bids = 'bids'
+    change_id = 'change_id'
     delta = 'delta'
+    direction = 'direction'
     expiration_timestamp = 'expiration_timestamp'
     greeks = 'greeks'
+    index_price = 'index_price'
     instruments = 'instruments'
     instrument_name = 'instrument_name'
+    iv = 'iv'
     mark_iv = 'mark_iv'
     mark_price = 'mark_price'
     option_type = 'option_type'
+    order_books = 'order_books'
+    price = 'price'
     result = 'result'
+    settlement_period = 'settlement_period'
     stats = 'stats'
     strike = 'strike'
     tickers = 'tickers'
+    timestamp = 'timestamp'
+    trade_id = 'trade_id'
+    trade_seq = 'trade_seq'
+    trades = 'trades'
     underlying_price = 'underlying_price'
 
     # values
+    buy = 'buy'
+    sell = 'sell'
     future = 'future'
     option = 'option'
+    perpetual = 'perpetual'
     call = 'call'
     put = 'put'
@@ -0,0 +1,123 @@
+from typing import List
+
+import numpy as np
+
+from ..tracing import traced
+from .shared_structures import DeribitFields
+
+# constants from deribit data
+_cst = DeribitFields()
+
+# NOTE:
+# one row per option ticker. option_type is 0 for calls and 1 for puts, so that rows sorted by
+# (expiration_timestamp, option_type, strike) have the calls of an expiry first, each by strike.
+# fields missing from a ticker (e.g. no bid) are NaN.
+_OPTION_DTYPE = np.dtype([
+    ('expiration_timestamp', '<i8'),
+    ('option_type', '<i1'),
+    ('strike', '<f8'),
+    ('timestamp', '<i8'),
+    ('underlying_price', '<f8'),
+    ('index_price', '<f8'),
+    ('mark_price', '<f8'),
+    ('mark_iv', '<f8'),
+    ('best_bid_price', '<f8'),
+    ('best_ask_price', '<f8'),
+    ('bid_iv', '<f8'),
+    ('ask_iv', '<f8'),
+    ('open_interest', '<f8'),
+    ('delta', '<f8'),
+    ('gamma', '<f8'),
+    ('vega', '<f8'),
+    ('theta', '<f8'),
+    ('volume', '<f8'),
+])
+
+_TICKER_FIELDS = ['timestamp', 'underlying_price', 'index_price', 'mark_price', 'mark_iv', 'best_bid_price',
+                  'best_ask_price', 'bid_iv', 'ask_iv', 'open_interest']
+_GREEK_FIELDS = ['delta', 'gamma', 'vega', 'theta']
+
+
+class OptionSnapshot:
+    ''' an option ticker batch as one structured array, sorted by (expiry, option type, strike).
+
+    the rows of an expiry, and of its calls or puts, are contiguous: expiry_offsets[i]:expiry_offsets[i+1]
+    are the rows of expirations[i], of which the puts start at put_offsets[i]. so the rows of any
+    expiry and option type are a slice (a view), found without grouping. '''
+
+    __slots__ = ['rows', 'instrument_names', 'expirations', 'expiry_offsets', 'put_offsets', 'missing',
+                 'kw_expiry']
+
+    s_call = 0
+    s_put = 1
+
+    def __init__(self, rows: np.ndarray, instrument_names: np.ndarray, missing: List[str] = None):
+        ''' rows and instrument names must be sorted already; use from_deribit. '''
+
+        self.rows: np.ndarray = rows
+        self.instrument_names: np.ndarray = instrument_names
+        self.missing: List[str] = [] if missing is None else missing
+
+        ex = rows['expiration_timestamp']
+        self.expirations, starts = np.unique(ex, return_index=True)
+        self.expiry_offsets: np.ndarray = np.append(starts, len(rows)).astype(np.int64)
+        # first put of each expiry (searching the option type codes within the expiry's rows)
+        self.put_offsets: np.ndarray = np.searchsorted(ex * 2 + rows['option_type'], self.expirations * 2 + 1)
+        self.kw_expiry = {int(e): i for i, e in enumerate(self.expirations)}
+
+    @classmethod
+    @traced()
+    def from_deribit(cls, deribit_option_data: dict) -> 'OptionSnapshot':
+        ''' from the data of an option ticker batch, as decoded from json. tickers without an instrument
+        are dropped. '''
+
+        kw_inst = {inst[_cst.instrument_name]: inst for inst in deribit_option_data[_cst.instruments]}
+        tickers = [t for t in deribit_option_data[_cst.tickers] if t[_cst.instrument_name] in kw_inst]
+        insts = [kw_inst[t[_cst.instrument_name]] for t in tickers]
+
+        rows = np.empty(len(tickers), dtype=_OPTION_DTYPE)
+        rows['expiration_timestamp'] = [inst[_cst.expiration_timestamp] for inst in insts]
+        rows['option_type'] = [inst[_cst.option_type] == _cst.put for inst in insts]
+        rows['strike'] = [inst[_cst.strike] for inst in insts]
+        # None becomes NaN
+        for f in _TICKER_FIELDS:
+            rows[f] = np.array([t.get(f) for t in tickers], dtype=float)
+        for f in _GREEK_FIELDS:
+            rows[f] = np.array([t[_cst.greeks].get(f) if _cst.greeks in t else None for t in tickers], dtype=float)
+        rows['volume'] = np.array([t[_cst.stats].get('volume') if _cst.stats in t else None for t in tickers],
+                                  dtype=float)
+
+        names = np.array([t[_cst.instrument_name] for t in tickers], dtype=object)
+        i_s = np.lexsort((rows['strike'], rows['option_type'], rows['expiration_timestamp']))
+
+        return cls(rows[i_s], names[i_s], deribit_option_data.get('missing', []))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get_expiry_slice(self, expiration_timestamp: int) -> slice:
+        i = self.kw_expiry[int(expiration_timestamp)]
+        return slice(self.expiry_offsets[i], self.expiry_offsets[i + 1])
+
+    def get_slice(self, expiration_timestamp: int, option_type: str) -> slice:
+        ''' rows of the calls or puts (_cst.call / _cst.put) of an expiry. '''
+
+        i = self.kw_expiry[int(expiration_timestamp)]
+        if option_type == _cst.put:
+            return slice(self.put_offsets[i], self.expiry_offsets[i + 1])
+        return slice(self.expiry_offsets[i], self.put_offsets[i])
+
+    def get_rows(self, expiration_timestamp: int, option_type: str = None) -> np.ndarray:
+        ''' a view of the rows of an expiry, all of them or of one option type. '''
+
+        if option_type is None:
+            return self.rows[self.get_expiry_slice(expiration_timestamp)]
+        return self.rows[self.get_slice(expiration_timestamp, option_type)]
+
+    def to_df(self):
+        ''' the rows as a data frame indexed by instrument name, option types as in deribit. '''
+
+        import pandas as pd
+        df = pd.DataFrame(self.rows, index=pd.Index(self.instrument_names, name=_cst.instrument_name))
+        df[_cst.option_type] = np.where(self.rows['option_type'] == self.s_put, _cst.put, _cst.call)
+        return df
@@ -0,0 +1,93 @@
+import json
+import os
+from typing import Iterator
+
+from ..common_utils import get_logger
+
+_LOGGER = get_logger(__name__)
+
+
+class SpillFile:
+    ''' append only json lines file holding a download as it arrives.
+
+    each record is flushed when appended, so after a crash the file holds everything received up to
+    the last complete line; a line cut short by the crash is dropped. '''
+
+    def __init__(self, path: str):
+
+        self.path = path
+        self.file = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def records(self) -> Iterator[dict]:
+        ''' records in the order they were appended, streamed from disk. '''
+
+        if not self.exists():
+            return
+
+        if self.file is not None:
+            self.file.flush()
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # cut short
+                yield json.loads(line)
+
+    def append(self, record: dict) -> None:
+
+        if self.file is None:
+            self.__drop_incomplete_line()
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self) -> None:
+        self.close()
+        if self.exists():
+            os.remove(self.path)
+
+    def __drop_incomplete_line(self) -> None:
+
+        if not self.exists():
+            return
+
+        with open(self.path, 'rb+') as f:
+            data_size = f.seek(0, os.SEEK_END)
+            # find the last newline from the end
+            pos = data_size
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                i = chunk.rfind(b'\n')
+                if i >= 0:
+                    pos = pos - step + i + 1
+                    break
+                pos -= step
+            if pos < data_size:
+                _LOGGER.warning('dropping ' + str(data_size - pos) + ' bytes of an incomplete line in ' + self.path)
+                f.truncate(pos)
+
+
+def iter_json_list(items: Iterator, level: int = 0) -> Iterator[str]:
+    ''' pieces of json.dumps(list(items), ensure_ascii=False, indent=4) nested at level, without
+    holding the list in memory. '''
+
+    pad = '    ' * (level + 1)
+    first = True
+    for item in items:
+        # json strings have no raw newlines, so every line can be indented as a whole
+        text = json.dumps(item, ensure_ascii=False, indent=4).replace('\n', '\n' + pad)
+        yield ('[\n' if first else ',\n') + pad + text
+        first = False
+
+    yield '[]' if first else '\n' + '    ' * level + ']'
@@ -4,8 +4,8 @@ from typing import List
 import pandas as pd
 
 from ..common_utils import get_logger
+from ..tracing import traced
 from .batch_managers import BatchFileManager
-from .db_manager import DBManager
 from .shared_structures import DeribitFields, TickerBatchInfo
 
 _LOGGER = get_logger(__name__)
@@ -16,6 +16,7 @@ _cst = DeribitFields()
 class ConverterToDF:
 
     @staticmethod
+    @traced()
     def tick_info_to_df(deribit_option_ticker_info: dict):
 
         df_instruments = pd.DataFrame(deribit_option_ticker_info[_cst.instruments])
@@ -47,7 +48,8 @@ def bulk_upload_ticker_batches(
     ticker_batch_infos = bdm.get_ticker_batch_file_infos()
     _LOGGER.info(f'There are {len(ticker_batch_infos)} batch files.')
 
-    # database manager
+    # database manager. imported here so that pymongo is only loaded when it is used.
+    from .db_manager import DBManager
     dbm = DBManager(db_name, host, port)
 
     ticker_batch_infos_to_add: List[TickerBatchInfo] = []
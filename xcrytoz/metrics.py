@@ -0,0 +1,139 @@
+import os
+import threading
+
+from .common_utils import get_logger
+
+_LOGGER = get_logger(__name__)
+
+# NOTE:
+# prometheus_client is imported when the metrics are first used, not at package import. if it is
+# not installed, the metrics are no-ops so that downloads keep working.
+
+
+class Metrics:
+    ''' ingest and storage metrics, registered in prometheus_client's default registry. '''
+
+    prefix = 'xcrytoz_'
+
+    # seconds
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    duration_buckets = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0)
+    write_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    # bytes
+    size_buckets = tuple(2.0 ** n for n in range(10, 31, 2))
+
+    def __init__(self):
+
+        import prometheus_client as pc
+
+        p = self.prefix
+        self.request_latency = pc.Histogram(
+            p + 'deribit_request_latency_seconds', 'round trip of one websocket request',
+            ['method'], buckets=self.latency_buckets)
+        self.messages = pc.Counter(
+            p + 'deribit_messages_total', 'websocket messages', ['direction'])
+        self.message_bytes = pc.Counter(
+            p + 'deribit_message_bytes_total', 'websocket message payload bytes', ['direction'])
+        self.missing_instruments = pc.Counter(
+            p + 'deribit_missing_instruments_total', 'instruments without a ticker', ['currency', 'kind'])
+        self.snapshot_duration = pc.Histogram(
+            p + 'batch_snapshot_duration_seconds', 'download time of one currency / kind batch',
+            ['currency', 'kind'], buckets=self.duration_buckets)
+        self.zip_write_duration = pc.Histogram(
+            p + 'batch_zip_write_seconds', 'time to write a batch zip',
+            ['currency', 'kind'], buckets=self.write_buckets)
+        self.zip_size = pc.Histogram(
+            p + 'batch_zip_size_bytes', 'size of a written batch zip',
+            ['currency', 'kind'], buckets=self.size_buckets)
+        self.batch_failures = pc.Counter(
+            p + 'batch_failures_total', 'failed batch downloads', ['currency', 'kind'])
+        self.db_inserts = pc.Counter(
+            p + 'db_inserts_total', 'documents inserted', ['collection'])
+        self.db_insert_duration = pc.Histogram(
+            p + 'db_insert_seconds', 'time of one insert', ['collection'], buckets=self.latency_buckets)
+
+    def observe_request(self, method: str, latency_sec: float, bytes_sent: int, bytes_received: int):
+        self.request_latency.labels(method).observe(latency_sec)
+        self.messages.labels('sent').inc()
+        self.messages.labels('received').inc()
+        self.message_bytes.labels('sent').inc(bytes_sent)
+        self.message_bytes.labels('received').inc(bytes_received)
+
+    def add_missing_instruments(self, currency: str, kind: str, n: int):
+        self.missing_instruments.labels(currency, kind).inc(n)
+
+    def observe_snapshot(self, currency: str, kind: str, duration_sec: float):
+        self.snapshot_duration.labels(currency, kind).observe(duration_sec)
+
+    def observe_zip_write(self, currency: str, kind: str, duration_sec: float, size_bytes: int):
+        self.zip_write_duration.labels(currency, kind).observe(duration_sec)
+        self.zip_size.labels(currency, kind).observe(size_bytes)
+
+    def add_batch_failure(self, currency: str, kind: str):
+        self.batch_failures.labels(currency, kind).inc()
+
+    def observe_db_insert(self, collection: str, duration_sec: float):
+        self.db_inserts.labels(collection).inc()
+        self.db_insert_duration.labels(collection).observe(duration_sec)
+
+
+class NoopMetrics:
+    ''' same interface as Metrics, doing nothing. '''
+
+    def observe_request(self, method: str, latency_sec: float, bytes_sent: int, bytes_received: int):
+        pass
+
+    def add_missing_instruments(self, currency: str, kind: str, n: int):
+        pass
+
+    def observe_snapshot(self, currency: str, kind: str, duration_sec: float):
+        pass
+
+    def observe_zip_write(self, currency: str, kind: str, duration_sec: float, size_bytes: int):
+        pass
+
+    def add_batch_failure(self, currency: str, kind: str):
+        pass
+
+    def observe_db_insert(self, collection: str, duration_sec: float):
+        pass
+
+
+_METRICS = None
+# the metrics register in a global registry, so they must be created once even if threads race here
+_METRICS_LOCK = threading.Lock()
+
+
+def get_metrics():
+    ''' the process wide metrics. no-ops if prometheus_client is missing or XCRYTOZ_METRICS=0. '''
+
+    global _METRICS
+    if _METRICS is None:
+        with _METRICS_LOCK:
+            if _METRICS is None:
+                if os.environ.get('XCRYTOZ_METRICS', '1') == '0':
+                    _METRICS = NoopMetrics()
+                else:
+                    try:
+                        _METRICS = Metrics()
+                    except ImportError:
+                        _LOGGER.warning('prometheus_client is not installed. metrics are disabled.')
+                        _METRICS = NoopMetrics()
+    return _METRICS
+
+
+def start_metrics_server(port: int = 8000, addr: str = '0.0.0.0') -> None:
+    ''' serves /metrics over http from a background thread. '''
+
+    import prometheus_client as pc
+    get_metrics()
+    pc.start_http_server(port, addr)
+    _LOGGER.info('serving metrics on ' + addr + ':' + str(port))
+
+
+def write_metrics_textfile(file_path: str) -> None:
+    ''' writes the metrics for node_exporter's textfile collector (atomically, as it requires). '''
+
+    import prometheus_client as pc
+    get_metrics()
+    pc.write_to_textfile(file_path, pc.REGISTRY)
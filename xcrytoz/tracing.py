@@ -0,0 +1,161 @@
+import atexit
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable
+
+# NOTE:
+# opt-in timing spans for hot paths. enable with the environment variables
+#   XCRYTOZ_TRACE=1                      emit spans
+#   XCRYTOZ_TRACE_FILE=<path>            json lines go there (stderr otherwise)
+#   XCRYTOZ_TRACE_SAMPLE=<0..1>          fraction of spans emitted (default 1)
+#   XCRYTOZ_PROFILE_SAMPLE=<0..1>        fraction of spans run under cProfile (default 0)
+#   XCRYTOZ_PROFILE_DIR=<path>           where .prof files go (default current folder)
+# or call configure_tracing. when disabled, a traced function costs one flag check.
+
+
+class _TracingState:
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.profile_sample_rate = 0.0
+        self.profile_dir = '.'
+        self.logger: logging.Logger = None
+        self.listener: QueueListener = None
+
+
+_STATE = _TracingState()
+_SPAN_IDS = itertools.count(1)
+_CURRENT_SPAN: ContextVar = ContextVar('xcrytoz_current_span', default=None)
+_PROFILING = threading.local()
+
+
+def configure_tracing(enabled=True, file_path: str = None, sample_rate=1.0,
+                      profile_sample_rate=0.0, profile_dir='.') -> None:
+    ''' (re)configures tracing. spans are written as json lines by a background thread, so the
+    traced code only puts records on a queue. '''
+
+    stop_tracing()
+
+    _STATE.sample_rate = sample_rate
+    _STATE.profile_sample_rate = profile_sample_rate
+    _STATE.profile_dir = profile_dir
+
+    if enabled:
+        handler = logging.FileHandler(file_path) if file_path else logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+        span_queue = queue.SimpleQueue()
+        logger = logging.getLogger('xcrytoz.tracing.spans')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.handlers = [QueueHandler(span_queue)]
+
+        _STATE.listener = QueueListener(span_queue, handler)
+        _STATE.listener.start()
+        _STATE.logger = logger
+
+    _STATE.enabled = enabled
+
+
+def stop_tracing() -> None:
+    ''' disables tracing and flushes the spans still queued. '''
+
+    _STATE.enabled = False
+    if _STATE.listener is not None:
+        _STATE.listener.stop()
+        for h in _STATE.listener.handlers:
+            h.close()
+        _STATE.listener = None
+
+
+def traced(name: str = None) -> Callable:
+    ''' decorator timing each call of the function as a span. '''
+
+    def decorator(fn: Callable) -> Callable:
+
+        span_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _STATE.enabled:
+                return fn(*args, **kwargs)
+            return _run_span(span_name, fn, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _run_span(span_name: str, fn: Callable, args, kwargs):
+
+    span_id = next(_SPAN_IDS)
+    parent_id = _CURRENT_SPAN.get()
+    token = _CURRENT_SPAN.set(span_id)
+
+    profiler = None
+    if _STATE.profile_sample_rate > 0 and not getattr(_PROFILING, 'active', False) \
+            and random.random() < _STATE.profile_sample_rate:
+        import cProfile
+        profiler = cProfile.Profile()
+        _PROFILING.active = True
+
+    error = None
+    t_wall = time.time()
+    t_start = time.perf_counter()
+    try:
+        if profiler is not None:
+            return profiler.runcall(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+    except Exception as ex:
+        error = type(ex).__name__ + ': ' + str(ex)
+        raise
+    finally:
+        duration = time.perf_counter() - t_start
+        _CURRENT_SPAN.reset(token)
+
+        profile_path = None
+        if profiler is not None:
+            _PROFILING.active = False
+            profile_path = os.path.join(_STATE.profile_dir,
+                                        span_name.replace('.', '_') + '_' + str(os.getpid()) + '_'
+                                        + str(span_id) + '.prof')
+            profiler.dump_stats(profile_path)
+
+        if _STATE.enabled and random.random() < _STATE.sample_rate:
+            record = {'span': span_name, 'span_id': span_id, 'parent_id': parent_id,
+                      'start': t_wall, 'duration_sec': duration,
+                      'pid': os.getpid(), 'thread': threading.current_thread().name}
+            if error is not None:
+                record['error'] = error
+            if profile_path is not None:
+                record['profile'] = profile_path
+            _STATE.logger.info(json.dumps(record))
+
+
+def _configure_from_env() -> None:
+
+    if os.environ.get('XCRYTOZ_TRACE', '0') in ('', '0'):
+        return
+
+    configure_tracing(
+        enabled=True,
+        file_path=os.environ.get('XCRYTOZ_TRACE_FILE'),
+        sample_rate=float(os.environ.get('XCRYTOZ_TRACE_SAMPLE', 1.0)),
+        profile_sample_rate=float(os.environ.get('XCRYTOZ_PROFILE_SAMPLE', 0.0)),
+        profile_dir=os.environ.get('XCRYTOZ_PROFILE_DIR', '.'))
+
+
+# spans still queued at exit are written
+atexit.register(stop_tracing)
+_configure_from_env()